@@ -1,33 +1,66 @@
 import os
 import json
-import openai
-import re
 import yaml
 import asyncio
+import time
 from pathlib import Path
 from json import JSONDecodeError
 from datetime import datetime
 from dotenv import load_dotenv
 
-from jinja2 import Environment, FileSystemLoader
 from logging_util import get_logger
+from template_registry import get_template_registry
+from llm_cache import LLMCache
+from llm_client import LLMClient, OPENAI_API_BASE
+from llm_replay import RecordingLLMClient, ReplayLLMClient, LLMReplayer
+from deployment_router import Deployment, load_deployments
+from rate_limiter import RateLimitScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from dependency_resolver import resolve_python_packages
+from rewrite_policy import RewritePolicy
+from function_registry import FunctionRegistry, FunctionCallResult
+from streaming_json import StreamingJsonParser
+from local_repair import RepairStats, repair_json_loads, repair_yaml_loads
+from folder_reader import read_folder
+from artifact_writer import ArtifactWriter, relative_path_in_folder
+from sharded_generation import ShardedRowGenerator
+from stage_graph import StageGraph
+from snapshot_cache import SnapshotCache, file_signature, unified_diff, diff_folder_contents
 import function_calls
-from token_utils import num_tokens_from_messages, num_tokens_from_functions, num_tokens_from_completions
+from token_utils import get_token_counter, get_approximate_token_counter
+from history_manager import ConversationHistory, context_window_for_model
 
 logger = get_logger()
 
 class CopilotContext:
-    def __init__(self) -> None:
+    '''
+    llm_client, rate_limit_scheduler and llm_cache can be shared by many contexts, such as the sessions of the server,
+    they are created from the environment variables if they are not given
+    '''
+    def __init__(self, llm_client=None, rate_limit_scheduler=None, llm_cache=None) -> None:
         self.script_directory = os.path.dirname(os.path.abspath(__file__))
         load_dotenv(os.path.join(self.script_directory, 'pfcopilot.env'))
         self.use_aoai = os.environ.get("AOAI_BY_DEFAULT", "true").lower() == "true"
         self.aoai_key = os.environ.get("AOAI_API_KEY")
         self.aoai_deployment = os.environ.get("AOAI_DEPLOYMENT")
         self.aoai_api_base = os.environ.get("AOAI_API_BASE")
+        # AOAI_DEPLOYMENTS is a json list of deployments to route the requests across, it replaces the single deployment above
+        self.aoai_deployments_error = None
+        try:
+            self.aoai_deployments = load_deployments(os.environ.get("AOAI_DEPLOYMENTS"), self.aoai_key, self.aoai_api_base, self.aoai_deployment)
+        except ValueError as ex:
+            self.aoai_deployments = []
+            self.aoai_deployments_error = str(ex)
+        if self.aoai_deployments and not self.aoai_deployment:
+            self.aoai_deployment = self.aoai_deployments[0].name
 
         self.openai_key = os.environ.get("OPENAI_API_KEY")
         self.openai_model = os.environ.get("OPENAI_MODEL")
 
+        # live calls the endpoints, record also appends every request and response to LLM_RECORDING_FILE, replay serves
+        # the responses from LLM_RECORDING_FILE without any endpoint, with the recorded delays scaled by LLM_REPLAY_TIME_SCALE
+        self.llm_backend = os.environ.get("LLM_BACKEND", "live").lower()
+        self.llm_recording_file = os.environ.get("LLM_RECORDING_FILE") or os.path.join(self.script_directory, 'llm_recording.jsonl')
+
         self.completion_tokens = 0
         self.prompt_tokens = 0
         self.last_completion_tokens = 0
@@ -35,24 +68,73 @@ class CopilotContext:
 
         self.flow_folder = None
         self.flow_description = None
+        # the pinned message with the description of the current flow, only the last read flow is kept
+        self._flow_description_message = None
         self.flow_yaml = None
 
-        jinja_env = Environment(loader=FileSystemLoader(self.script_directory), variable_start_string='[[', variable_end_string=']]')
-        self.copilot_instruction_template = jinja_env.get_template('prompts/copilot_instruction.jinja2')
-        self.rewrite_user_input_template = jinja_env.get_template('prompts/rewrite_user_input.jinja2')
-        self.refine_python_code_template = jinja_env.get_template('prompts/refine_python_code.jinja2')
-        self.find_python_package_template = jinja_env.get_template('prompts/find_python_package.jinja2')
-        self.summarize_flow_name_template = jinja_env.get_template('prompts/summarize_flow_name.jinja2')
-        self.understand_flow_template = jinja_env.get_template('prompts/understand_flow_instruction.jinja2')
-        self.json_string_fixer_template = jinja_env.get_template('prompts/json_string_fixer.jinja2')
-        self.yaml_string_fixer_template = jinja_env.get_template('prompts/yaml_string_fixer.jinja2')
-        self.function_call_instruction_template = jinja_env.get_template('prompts/function_call_instruction.jinja2')
-        self.gen_sample_inputs_template = jinja_env.get_template('prompts/gen_sample_data.jinja2')
-        self.gen_eval_flow_inputs_template = jinja_env.get_template('prompts/gen_eval_flow_inputs.jinja2')
-        self.gen_eval_flow_functions = jinja_env.get_template('prompts/gen_eval_flow_functions.jinja2')
-
-        self.system_instruction = self.copilot_instruction_template.render()
-        self.messages = []
+        # pooled client for all llm calls, OPENAI_API_BASE can point to a local openai compatible server
+        self._owns_llm_client = llm_client is None
+        self.llm_client = llm_client or self.create_llm_client()
+
+        # requests and tokens per minute budgets of the deployment, 0 means unlimited. throttled requests are retried with backoff
+        self.rate_limit_scheduler = rate_limit_scheduler or self.create_rate_limit_scheduler()
+        # completion tokens reserved in the tokens per minute budget before the actual usage is known
+        self.completion_token_estimate = int(os.environ.get("LLM_COMPLETION_TOKEN_ESTIMATE", "512"))
+
+        # max number of python nodes refined concurrently when dumping a flow
+        self.python_node_concurrency = int(os.environ.get("PYTHON_NODE_CONCURRENCY", "4"))
+
+        # sample inputs are generated in shards of this size, at most SAMPLE_INPUTS_CONCURRENCY shards at a time
+        self.sample_inputs_shard_size = int(os.environ.get("SAMPLE_INPUTS_SHARD_SIZE", "20"))
+        self.sample_inputs_concurrency = int(os.environ.get("SAMPLE_INPUTS_CONCURRENCY", "4"))
+        self.sample_inputs_max_top_up_rounds = int(os.environ.get("SAMPLE_INPUTS_MAX_TOP_UP_ROUNDS", "3"))
+
+        # cache for deterministic helper calls, set LLM_CACHE_ENABLED to false to bypass it
+        self.llm_cache = llm_cache or self.create_llm_cache()
+
+        # when to rewrite user input with the conversation history: always, auto or speculative
+        self.rewrite_policy = RewritePolicy(os.environ.get("REWRITE_USER_INPUT_MODE", "auto").lower())
+        self.repair_stats = RepairStats()
+
+        # templates are compiled once per process and renders are memoized, TEMPLATE_DEV_MODE reloads changed templates
+        template_bytecode_cache = os.environ.get("TEMPLATE_BYTECODE_CACHE", "true").lower() == "true"
+        self.template_registry = get_template_registry(
+            self.script_directory,
+            os.path.join(self.script_directory, '.jinja_cache') if template_bytecode_cache else None,
+            os.environ.get("TEMPLATE_DEV_MODE", "false").lower() == "true")
+        templates = self.template_registry
+        self.copilot_instruction_template = templates.get('prompts/copilot_instruction.jinja2')
+        self.rewrite_user_input_template = templates.get('prompts/rewrite_user_input.jinja2')
+        self.refine_python_code_template = templates.get('prompts/refine_python_code.jinja2')
+        self.find_python_package_template = templates.get('prompts/find_python_package.jinja2')
+        self.summarize_flow_name_template = templates.get('prompts/summarize_flow_name.jinja2')
+        self.understand_flow_template = templates.get('prompts/understand_flow_instruction.jinja2')
+        self.json_string_fixer_template = templates.get('prompts/json_string_fixer.jinja2')
+        self.yaml_string_fixer_template = templates.get('prompts/yaml_string_fixer.jinja2')
+        self.function_call_instruction_template = templates.get('prompts/function_call_instruction.jinja2')
+        self.gen_sample_inputs_template = templates.get('prompts/gen_sample_data.jinja2')
+        self.gen_eval_flow_inputs_template = templates.get('prompts/gen_eval_flow_inputs.jinja2')
+        self.gen_eval_flow_functions = templates.get('prompts/gen_eval_flow_functions.jinja2')
+
+        self.token_counter = get_token_counter()
+        # the rate limit estimates and the read_local_folder budget only need rough counts, they can use the approximate counter
+        self.budget_token_counter = get_approximate_token_counter() if os.environ.get("APPROXIMATE_TOKEN_COUNTING", "false").lower() == "true" else self.token_counter
+
+        # token limits of the chat history, HISTORY_TOKEN_BUDGET further limits the history under the model context window
+        self.context_window = int(os.environ.get("MODEL_CONTEXT_WINDOW") or context_window_for_model(self.aoai_deployment if self.use_aoai else self.openai_model))
+        self.history_token_budget = int(os.environ.get("HISTORY_TOKEN_BUDGET") or 0) or None
+        self.completion_token_reserve = int(os.environ.get("COMPLETION_TOKEN_RESERVE", "1024"))
+        self.messages = self._new_history()
+
+        # size limits of read_local_folder, the token limit defaults to half of the context window
+        self.read_folder_max_file_bytes = int(os.environ.get("READ_FOLDER_MAX_FILE_BYTES", "100000"))
+        self.read_folder_max_total_bytes = int(os.environ.get("READ_FOLDER_MAX_TOTAL_BYTES", "400000"))
+        self.read_folder_max_total_tokens = int(os.environ.get("READ_FOLDER_MAX_TOTAL_TOKENS") or 0)
+
+        # file contents keyed by path, mtime and size to skip re-reading unchanged files,
+        # and the contents already sent to the model to only send what changed since the last read
+        self.file_snapshots = SnapshotCache(max_entries=int(os.environ.get("FILE_SNAPSHOT_CACHE_SIZE", "1024")))
+        self.sent_snapshots = SnapshotCache()
 
         self.copilot_general_function_calls = [
             function_calls.dump_flow,
@@ -65,38 +147,135 @@ class CopilotContext:
             function_calls.upsert_flow_files
         ]
 
+        # max number of model requests in one user turn, bounds runaway function call loops
+        self.max_model_steps = int(os.environ.get("MAX_MODEL_STEPS", "10"))
+        self.function_registry = FunctionRegistry()
+        self._register_functions()
+
+        # array arguments handled element by element while the function call is still streaming
+        self.streamed_function_arrays = {
+            'dump_flow': ['python_functions']
+        }
+        # bounds the python nodes refined at a time, including the refine calls prefetched while dump_flow streams
+        self._python_node_semaphore = asyncio.Semaphore(max(1, self.python_node_concurrency))
+        self._prefetched_tasks = {}
+        # python node names and paths of the streamed flow yaml, None until the flow yaml has been streamed
+        self._streamed_python_nodes = None
+        self._pending_python_functions = []
+
+    def create_llm_client(self):
+        client_args = dict(
+            use_aoai=self.use_aoai,
+            max_concurrency=int(os.environ.get("LLM_MAX_CONCURRENCY", "8")),
+            max_connections=int(os.environ.get("LLM_MAX_CONNECTIONS", "16")),
+            keepalive_timeout=float(os.environ.get("LLM_KEEPALIVE_TIMEOUT", "30")),
+            connect_timeout=float(os.environ.get("LLM_CONNECT_TIMEOUT", "10")),
+            request_timeout=float(os.environ.get("LLM_REQUEST_TIMEOUT", "600")))
+        if self.llm_backend == 'replay':
+            replayer = LLMReplayer.load(self.llm_recording_file, float(os.environ.get("LLM_REPLAY_TIME_SCALE", "1")))
+            return ReplayLLMClient(replayer, **client_args)
+
+        if self.use_aoai:
+            deployments = self.aoai_deployments
+        else:
+            deployments = [Deployment(os.environ.get("OPENAI_API_BASE") or OPENAI_API_BASE, self.openai_key, self.openai_model)] if self.openai_key and self.openai_model else []
+        if self.llm_backend == 'record':
+            return RecordingLLMClient(deployments, self.llm_recording_file, **client_args)
+        return LLMClient(deployments, **client_args)
+
+    def create_rate_limit_scheduler(self):
+        return RateLimitScheduler(
+            requests_per_minute=int(os.environ.get("LLM_REQUESTS_PER_MINUTE", "0")),
+            tokens_per_minute=int(os.environ.get("LLM_TOKENS_PER_MINUTE", "0")),
+            max_retries=int(os.environ.get("LLM_MAX_RETRIES", "5")),
+            base_delay=float(os.environ.get("LLM_RETRY_BASE_DELAY", "1")),
+            max_delay=float(os.environ.get("LLM_RETRY_MAX_DELAY", "60")))
+
+    def create_llm_cache(self):
+        return LLMCache(
+            os.path.join(self.script_directory, 'llm_cache.db'),
+            max_entries=int(os.environ.get("LLM_CACHE_MAX_ENTRIES", "2000")),
+            max_age_days=float(os.environ.get("LLM_CACHE_MAX_AGE_DAYS", "30")),
+            # cache hits would be missing from a recording, and would hide the recorded responses in a replay
+            enabled=os.environ.get("LLM_CACHE_ENABLED", "true").lower() == "true" and self.llm_backend == 'live')
+
+    @property
+    def system_instruction(self):
+        return self.copilot_instruction_template.render()
+
+    async def warmup(self):
+        '''
+        load the tokenizer, compile the templates and connect to the llm endpoints in the background,
+        so that the first turn does not pay for the initialization
+        '''
+        start_time = time.perf_counter()
+        timings = {}
+
+        async def timed(name, coroutine):
+            step_start_time = time.perf_counter()
+            try:
+                await coroutine
+            except Exception as ex:
+                logger.warning(f'warmup step {name} failed: {ex}')
+            timings[name] = time.perf_counter() - step_start_time
+
+        await asyncio.gather(
+            timed('tokenizer', asyncio.to_thread(self.token_counter.warmup)),
+            timed('templates', asyncio.to_thread(self.template_registry.compile_all)),
+            timed('llm connections', self.llm_client.warmup()))
+        logger.info(f'warmup took {time.perf_counter() - start_time:.2f}s, ' + ', '.join(f'{name}: {duration:.2f}s' for name, duration in timings.items()))
+        return timings
+
     @property
     def total_money_cost(self):
         return self.prompt_tokens * 0.000003 + self.completion_tokens * 0.00000004
 
     def check_env(self):
+        if self.llm_backend == 'replay':
+            return True, ""
         if self.use_aoai:
-            if not self.aoai_key or not self.aoai_deployment or not self.aoai_api_base:
+            if self.aoai_deployments_error:
+                return False, f"You configured to use AOAI, but AOAI_DEPLOYMENTS is invalid: {self.aoai_deployments_error}"
+            if not self.aoai_deployments:
                 return False, "You configured to use AOAI, but one or more of the following environment variables were not set: AOAI_API_KEY, AOAI_DEPLOYMENT, AOAI_API_BASE"
             else:
-                openai.api_key = self.aoai_key
-                openai.api_type = "azure"
-                openai.api_base = self.aoai_api_base
-                openai.api_version = "2023-07-01-preview"
                 return True, ""
         else:
             if not self.openai_key or not self.openai_model:
                 return False, "You configured to use OPENAI, but one or more of the following environment variables were not set: OPENAI_API_KEY, OPENAI_API_KEY"
             else:
-                openai.api_key = self.openai_key
                 return True, ""
 
+    async def close(self):
+        if self._owns_llm_client:
+            await self.llm_client.close()
+
+    def _new_history(self):
+        history = ConversationHistory(self.token_counter, self.context_window, self.history_token_budget, self.completion_token_reserve)
+        history.on_evict = self._on_history_evicted
+        return history
+
+    def _on_history_evicted(self, messages):
+        # the model no longer sees the evicted file contents, send the whole content on the next read
+        if any(message['role'] == 'function' for message in messages):
+            self.sent_snapshots.clear()
+
     def reset(self):
-        self.messages = []
+        self.messages = self._new_history()
+        self.sent_snapshots.clear()
         self.flow_folder = None
         self.flow_yaml = None
         self.flow_description = None
+        self._flow_description_message = None
         self.completion_tokens = 0
         self.prompt_tokens = 0
         self.last_completion_tokens = 0
         self.last_prompt_tokens = 0
 
-    async def _ask_openai_async(self, messages=[], functions=None, function_call=None, stream=False):
+    async def _ask_openai_async(self, messages=[], functions=None, function_call=None, stream=False, cacheable=False, *, priority):
+        '''
+        priority is PRIORITY_INTERACTIVE for the calls the user is waiting on before the first token of the answer, PRIORITY_BACKGROUND otherwise
+        '''
         request_args_dict = {
             "messages": messages,
             "stream": stream,
@@ -109,14 +288,27 @@ class CopilotContext:
         if functions and function_call:
             request_args_dict['function_call'] = function_call
 
-        if self.use_aoai:
-            request_args_dict['engine'] = self.aoai_deployment
-        else:
-            request_args_dict['model'] = self.openai_model
+        request_args_dict.update(self.llm_client.model_args())
 
-        response = await openai.ChatCompletion.acreate(**request_args_dict)
+        if cacheable and not stream:
+            async def create_response():
+                response = await self._create_chat_completion(request_args_dict, priority)
+                return response.to_dict_recursive()
+            cached_response = await self.llm_cache.get_or_create(request_args_dict, create_response)
+            from openai.openai_object import OpenAIObject
+            return OpenAIObject.construct_from(cached_response)
 
-        if not stream:
+        return await self._create_chat_completion(request_args_dict, priority)
+
+    async def _create_chat_completion(self, request_args_dict, priority):
+        estimated_tokens = self.budget_token_counter.count_messages(request_args_dict['messages']) + \
+            self.budget_token_counter.count_functions(request_args_dict.get('functions')) + self.completion_token_estimate
+        response, wait_seconds = await self.rate_limit_scheduler.run(
+            lambda: self.llm_client.chat_completion(request_args_dict, estimated_tokens, priority), estimated_tokens, priority)
+        if wait_seconds > 0.1:
+            logger.info(f'llm request waited {wait_seconds:.2f}s for the rate limits')
+
+        if not request_args_dict['stream']:
             response_ms = response.response_ms
             prompt_tokens = response.usage.prompt_tokens
             completion_tokens = response.usage.completion_tokens
@@ -127,6 +319,8 @@ class CopilotContext:
             self.last_completion_tokens += completion_tokens
             self.last_prompt_tokens += prompt_tokens
 
+            self.rate_limit_scheduler.record_usage(estimated_tokens, total_tokens)
+
             logger.info(f'Get response from ChatGPT in {response_ms} ms!')
             logger.info(f'total tokens:{total_tokens}\tprompt tokens:{prompt_tokens}\tcompletion tokens:{completion_tokens}')
 
@@ -151,11 +345,12 @@ class CopilotContext:
             logger.error(ex)
             raise ex
 
-    async def _rewrite_user_input(self, user_input):
-        # construct conversation message, only keep the last four messages for user and assistant
+    async def _rewrite_user_input(self, user_input, history):
+        # construct conversation message, only keep the last four messages for user and assistant.
+        # history are the messages before the user input, the input itself must not take the place of an earlier turn
         cur_len = 0
         conversation_message_array = []
-        for message in reversed(self.messages):
+        for message in reversed(history):
             role = message['role']
             if role != 'system' and role != 'function' and cur_len < 4:
                 cur_len += 1
@@ -171,7 +366,8 @@ class CopilotContext:
             {'role':'system', 'content': rewrite_user_input_instruction},
             {'role':'user', 'content': user_input}
         ]
-        response = await self._ask_openai_async(messages=chat_message)
+        # the main request of the turn waits for the rewrite
+        response = await self._ask_openai_async(messages=chat_message, priority=PRIORITY_INTERACTIVE)
         message = getattr(response.choices[0].message, "content", "")
         logger.info(f"rewrite_user_input: {message}")
         return message
@@ -183,22 +379,39 @@ class CopilotContext:
             {'role':'user', 'content': python_code}
         ]
 
-        response = await self._ask_openai_async(messages=chat_message)
+        response = await self._ask_openai_async(messages=chat_message, cacheable=True, priority=PRIORITY_BACKGROUND)
         message = getattr(response.choices[0].message, "content", "")
         return message
 
-    async def _find_dependent_python_packages(self, python_code):
+    async def _refine_python_node(self, python_code):
+        async with self._python_node_semaphore:
+            return await self._refine_python_code(python_code)
+
+    async def _find_dependent_python_packages(self, python_code, local_modules=()):
+        resolved = resolve_python_packages(python_code, local_modules)
+        if resolved is None:
+            logger.info('Failed to parse python code, find dependent python packages with llm')
+            return await self._find_dependent_python_packages_by_llm(python_code)
+
+        packages, unresolved_modules = resolved
+        if unresolved_modules:
+            logger.info(f'Cannot resolve python packages locally for {unresolved_modules}, find them with llm')
+            import_statements = '\n'.join(f'import {module_name}' for module_name in sorted(unresolved_modules))
+            packages.update(await self._find_dependent_python_packages_by_llm(import_statements))
+        return list(packages)
+
+    async def _find_dependent_python_packages_by_llm(self, python_code):
         find_dependent_python_packages_instruction = self.find_python_package_template.render()
         chat_message = [
             {'role':'system', 'content': find_dependent_python_packages_instruction},
             {'role':'user', 'content': python_code}
         ]
 
-        response = await self._ask_openai_async(messages=chat_message)
+        response = await self._ask_openai_async(messages=chat_message, cacheable=True, priority=PRIORITY_BACKGROUND)
         message = getattr(response.choices[0].message, "content", "").replace(' ', '')
         packages = []
         for p in message.split(','):
-            if p != 'None':
+            if p and p != 'None':
                 packages.append(p)
         return packages
 
@@ -209,7 +422,7 @@ class CopilotContext:
             {'role':'user', 'content': flow_description}
         ]
 
-        response = await self._ask_openai_async(messages=chat_message)
+        response = await self._ask_openai_async(messages=chat_message, cacheable=True, priority=PRIORITY_BACKGROUND)
         message = getattr(response.choices[0].message, "content", "")
         return message
 
@@ -219,7 +432,7 @@ class CopilotContext:
             chat_message = [
                 {'role':'system', 'content': fix_json_string_instruction},
             ]
-            response = await self._ask_openai_async(messages=chat_message)
+            response = await self._ask_openai_async(messages=chat_message, cacheable=True, priority=PRIORITY_BACKGROUND)
             message = getattr(response.choices[0].message, "content", "")
             return json.loads(message)
         except JSONDecodeError as ex:
@@ -234,7 +447,7 @@ class CopilotContext:
             chat_message = [
                 {'role':'system', 'content': fix_yaml_string_instruction},
             ]
-            response = await self._ask_openai_async(messages=chat_message)
+            response = await self._ask_openai_async(messages=chat_message, cacheable=True, priority=PRIORITY_BACKGROUND)
             message = getattr(response.choices[0].message, "content", "")
             return yaml.safe_load(message)
         except yaml.MarkedYAMLError as ex:
@@ -247,25 +460,42 @@ class CopilotContext:
         try:
             return yaml.safe_load(yaml_string)
         except yaml.MarkedYAMLError as ex:
+            try:
+                parsed_yaml = repair_yaml_loads(yaml_string)
+                self.repair_stats.yaml_repaired += 1
+                return parsed_yaml
+            except yaml.YAMLError:
+                self.repair_stats.yaml_failed += 1
+                logger.error(f'Failed to repair yaml string {yaml_string} locally')
             return await self._fix_yaml_string_and_loads(yaml_string, str(ex))
 
     async def _smart_json_loads(self, json_string):
         try:
             return json.loads(json_string)
         except JSONDecodeError as ex:
-            pattern = r'\\\n'
-            updated_function_call = re.sub(pattern, r'\\n', str(json_string))
-            if updated_function_call == json_string:
+            try:
+                parsed_json = repair_json_loads(json_string)
+                self.repair_stats.json_repaired += 1
+                return parsed_json
+            except JSONDecodeError:
+                self.repair_stats.json_failed += 1
                 logger.error(f'Failed to load json string {json_string}')
-                return await self._fix_json_string_and_loads(json_string, str(ex))
-            else:
-                return await self._smart_json_loads(updated_function_call)
+            return await self._fix_json_string_and_loads(json_string, str(ex))
 
     async def ask_gpt_async(self, content, print_info_func):
         self.last_prompt_tokens = 0
         self.last_tokens = 0
 
-        rewritten_user_intent = await self._rewrite_user_input(content)
+        rewrite_path = self.rewrite_policy.choose_path(content, self.messages)
+        history = list(self.messages)
+        if rewrite_path == 'rewrite':
+            start_time = time.perf_counter()
+            rewritten_user_intent = await self._rewrite_user_input(content, history)
+            self.rewrite_policy.record_rewrite((time.perf_counter() - start_time) * 1000)
+        else:
+            rewritten_user_intent = content
+            if rewrite_path == 'skip':
+                self.rewrite_policy.record_skip()
         potential_function_calls = self.copilot_general_function_calls
 
         if self.flow_yaml:
@@ -286,12 +516,19 @@ class CopilotContext:
 
         self.messages.append({'role':'user', 'content':rewritten_user_intent})
         self.messages.append({'role':'system', 'content': self.function_call_instruction_template.render(functions=','.join([f['name'] for f in potential_function_calls]))})
+        self.messages.fit(self.token_counter.count_functions(potential_function_calls))
 
-        prompt_tokens = num_tokens_from_messages(self.messages) + num_tokens_from_functions(potential_function_calls)
+        prompt_tokens = self.messages.num_tokens + self.token_counter.count_functions(potential_function_calls)
         self.prompt_tokens += prompt_tokens
         self.last_prompt_tokens += prompt_tokens
-        response = await self._ask_openai_async(messages=self.messages, functions=potential_function_calls, function_call='auto', stream=True)
-        await self.parse_gpt_response(response, print_info_func)
+        if rewrite_path == 'speculative':
+            response = await self._ask_with_speculative_rewrite(content, history, len(self.messages) - 2, potential_function_calls)
+        else:
+            response = await self._ask_openai_async(messages=self.messages, functions=potential_function_calls, function_call='auto', stream=True, priority=PRIORITY_INTERACTIVE)
+        try:
+            await self.parse_gpt_response(response, print_info_func)
+        finally:
+            self._clear_streamed_function_state()
 
         # clear function message if we have already got the flow
         if self.flow_yaml:
@@ -301,132 +538,257 @@ class CopilotContext:
         self._clear_system_message()
 
         logger.info(f'answer finished. completion tokens: {self.completion_tokens}, prompt tokens: {self.prompt_tokens}, last completion tokens: {self.last_completion_tokens}, last prompt tokens: {self.last_prompt_tokens}')
+        logger.info(self.llm_cache.stats_message())
+        logger.info(self.rewrite_policy.stats_message())
+        logger.info(self.repair_stats.stats_message())
+        logger.info(self.rate_limit_scheduler.stats_message())
+        logger.info(self.llm_client.stats_message())
+        logger.info(self.llm_client.router.stats_message())
+        logger.info(self.template_registry.stats_message())
+
+    async def _ask_with_speculative_rewrite(self, content, history, user_message_index, functions):
+        '''
+        send the main request with the original user input while rewriting the user input in parallel,
+        restart the main request with the rewritten user input only if it differs materially from the original one.
+        history are the messages before the user input, the rewrite is based on them.
+        '''
+        start_time = time.perf_counter()
+        response_task = asyncio.create_task(self._ask_openai_async(messages=list(self.messages), functions=functions, function_call='auto', stream=True, priority=PRIORITY_INTERACTIVE))
+        try:
+            rewritten_user_intent = await self._rewrite_user_input(content, history)
+        except Exception:
+            response_task.cancel()
+            raise
+        rewrite_latency_ms = (time.perf_counter() - start_time) * 1000
+
+        if not self.rewrite_policy.differs_materially(content, rewritten_user_intent):
+            self.rewrite_policy.record_speculation(rewrite_latency_ms, restarted=False)
+            return await response_task
+
+        logger.info(f'rewritten user input differs from the original one, restart the request. rewritten: {rewritten_user_intent}')
+        self.rewrite_policy.record_speculation(rewrite_latency_ms, restarted=True)
+        if response_task.done() and not response_task.cancelled() and response_task.exception() is None:
+            await response_task.result().aclose()
+        else:
+            response_task.cancel()
+
+        self.messages[user_message_index] = {'role':'user', 'content':rewritten_user_intent}
+        self.messages.fit(self.token_counter.count_functions(functions))
+        prompt_tokens = self.messages.num_tokens + self.token_counter.count_functions(functions)
+        self.prompt_tokens += prompt_tokens
+        self.last_prompt_tokens += prompt_tokens
+        return await self._ask_openai_async(messages=self.messages, functions=functions, function_call='auto', stream=True, priority=PRIORITY_INTERACTIVE)
 
     async def parse_gpt_response(self, response, print_info_func):
-        role = "assistant"
-        message = ""
-        function_call = ""
-        function_name = ""
-        early_stop = False
-        next_possible_function_calls = None
-        function_call_choice = 'auto'
-
-        async for chunk in response:
-            if 'choices' in chunk and len(chunk['choices']) > 0:
-                delta = chunk.choices[0]['delta']
-                if 'content' in delta:
-                    cur_message = delta['content']
-                    message += cur_message
-                    print_info_func(cur_message)
-                if 'function_call' in delta:
-                    if "name" in delta.function_call:
-                        function_name = delta.function_call["name"]
-                    if "arguments" in delta.function_call:
-                        function_call+= delta.function_call["arguments"]
-                if 'role' in delta:
-                    role = delta['role']
-                finish_reason = chunk.choices[0].finish_reason
-
-        if message:
-            self.messages.append({'role':role, 'content':message})
-
-        completion_tokens = num_tokens_from_completions(message + function_call)
-        self.completion_tokens += completion_tokens
-        self.last_completion_tokens += completion_tokens
-
-        if function_call != "":
-            if function_name == 'dump_flow':
-                function_arguments = await self._smart_json_loads(function_call)
-                flow_folder = await self.dump_flow(**function_arguments, print_info_func=print_info_func)
-                self.messages.append({"role": "function", "name": function_name, "content": f'{flow_folder}'})
-                early_stop = True
-            elif function_name == 'read_local_file':
-                function_arguments = await self._smart_json_loads(function_call)
-                file_content = self.read_local_file(**function_arguments, print_info_func=print_info_func)
-                if not file_content:
-                    print_info_func('\nyou ask me to read code from a file, but the file does not exists')
-                    early_stop = True
-                else:
-                    self.messages.append({"role": "function", "name": function_name, "content":file_content})
-                    self.messages.append({"role": "system", "content": "You have read the file content, understand it first and then determine your next step."})
-                    next_possible_function_calls = [function_calls.dump_flow, function_calls.upsert_flow_files]
-            elif function_name == 'read_local_folder':
-                function_arguments = await self._smart_json_loads(function_call)
-                files_content = self.read_local_folder(**function_arguments, print_info_func=print_info_func)
-                if not files_content:
-                    print_info_func('\nyou ask me to read code from a folder, but the folder does not exists')
-                    early_stop = True
-                else:
-                    self.messages.append({"role": "function", "name": function_name, "content":files_content})
-                    self.messages.append({"role": "system", "content": "You have read all the files in the folder, understand it first and then determine your next step."})
-                    next_possible_function_calls = [function_calls.dump_flow, function_calls.upsert_flow_files]
-            elif function_name == 'dump_sample_inputs':
-                function_arguments = await self._smart_json_loads(function_call)
-                sample_input_file = await self.dump_sample_inputs(**function_arguments, target_folder=self.flow_folder, print_info_func=print_info_func)
-                self.messages.append({"role": "function", "name": function_name, "content": f"{sample_input_file}"})
-                early_stop = True
-            elif function_name == 'dump_evaluation_flow':
-                function_arguments = await self._smart_json_loads(function_call)
-                evaluation_flow_folder = await self.dump_evaluation_flow(**function_arguments, print_info_func=print_info_func)
-                self.messages.append({"role": "function", "name": function_name, "content": f"{evaluation_flow_folder}"})
-            elif function_name == 'read_flow_from_local_file':
-                function_arguments = await self._smart_json_loads(function_call)
-                file_content = self.read_flow_from_local_file(**function_arguments, print_info_func=print_info_func)
-                if not file_content:
-                    print_info_func('\nyou ask me to read flow from a file, but the file does not exists')
-                    early_stop = True
-                else:
-                    self.flow_folder = os.path.dirname(function_arguments['path'])
-                    self.messages.append({"role": "function", "name": function_name, "content":file_content})
-                    next_possible_function_calls = [function_calls.dump_flow_definition_and_description]
-                    function_call_choice = {'name':'dump_flow_definition_and_description'}
-            elif function_name == 'read_flow_from_local_folder':
-                function_arguments = await self._smart_json_loads(function_call)
-                self.flow_folder = function_arguments['path']
-                files_content = self.read_flow_from_local_folder(**function_arguments, print_info_func=print_info_func)
-                if not files_content:
-                    print_info_func('\nyou ask me to read flow from a folder, but the folder does not exists')
-                    early_stop = True
+        '''
+        consume the streaming response and run the function call it asks for, then ask the model again,
+        until the model stops, a function call ends the turn or max_model_steps is reached
+        '''
+        for step in range(1, self.max_model_steps + 1):
+            step_start_time = time.perf_counter()
+            role, message, function_name, function_call, finish_reason = await self._read_streaming_response(response, print_info_func)
+
+            if message:
+                self.messages.append({'role':role, 'content':message})
+
+            completion_tokens = self.token_counter.count_completion(message + function_call)
+            self.completion_tokens += completion_tokens
+            self.last_completion_tokens += completion_tokens
+
+            result = FunctionCallResult()
+            if function_call != "":
+                if function_name in self.function_registry:
+                    function_arguments = await self._smart_json_loads(function_call)
+                    result = await self.function_registry.dispatch(function_name, function_arguments, print_info_func)
                 else:
-                    self.messages.append({"role": "function", "name": function_name, "content":files_content})
-                    next_possible_function_calls = [function_calls.dump_flow_definition_and_description]
-                    function_call_choice = {'name':'dump_flow_definition_and_description'}
-            elif function_name == 'dump_flow_definition_and_description':
-                function_arguments = await self._smart_json_loads(function_call)
-                self.dump_flow_definition_and_description(**function_arguments, print_info_func=print_info_func)
-                self.messages.append({"role": "function", "name": function_name, "content": ""})
-                next_possible_function_calls = [function_calls.dump_sample_inputs, function_calls.dump_evaluation_flow, function_calls.upsert_flow_files]
-            elif function_name == 'upsert_flow_files':
-                function_arguments = await self._smart_json_loads(function_call)
-                await self.upsert_flow_files(**function_arguments, print_info_func=print_info_func)
-                self.messages.append({"role": "function", "name": function_name, "content": ""})
-                early_stop = True
-            else:
-                logger.info(f'GPT try to call unavailable function: {function_name}')
-                self.messages.append({"role": "system", "content":"do not try to call functions that does not exist! Call the function that exists!"})
+                    logger.info(f'GPT try to call unavailable function: {function_name}')
+                    self.messages.append({"role": "system", "content":"do not try to call functions that does not exist! Call the function that exists!"})
+
+            logger.info(f'model step {step} finished in {(time.perf_counter() - step_start_time) * 1000:.0f} ms. function call: {function_name or None}, finish reason: {finish_reason}')
+            if finish_reason == 'stop' or result.early_stop:
+                return
 
-        if finish_reason != 'stop' and not early_stop:
-            prompt_tokens = num_tokens_from_messages(self.messages) + num_tokens_from_functions(next_possible_function_calls)
+            if step == self.max_model_steps:
+                logger.warning(f'reached max model steps {self.max_model_steps} in one user turn, stop asking the model')
+                print_info_func(f'\nI have taken {self.max_model_steps} steps for your request and stopped here, please tell me how to continue.')
+                return
+
+            self.messages.fit(self.token_counter.count_functions(result.next_functions))
+            prompt_tokens = self.messages.num_tokens + self.token_counter.count_functions(result.next_functions)
             self.prompt_tokens += prompt_tokens
             self.last_prompt_tokens += prompt_tokens
-            new_response = await self._ask_openai_async(messages=self.messages, functions=next_possible_function_calls, function_call=function_call_choice, stream=True)
-            await self.parse_gpt_response(new_response, print_info_func)
+            response = await self._ask_openai_async(messages=self.messages, functions=result.next_functions, function_call=result.function_call, stream=True, priority=PRIORITY_INTERACTIVE)
+
+    async def _read_streaming_response(self, response, print_info_func):
+        role = "assistant"
+        message_chunks = []
+        function_call_chunks = []
+        function_name = ""
+        finish_reason = None
+        arguments_parser = None
+
+        try:
+            async for chunk in response:
+                if 'choices' in chunk and len(chunk['choices']) > 0:
+                    delta = chunk.choices[0]['delta']
+                    if 'content' in delta and delta['content']:
+                        cur_message = delta['content']
+                        message_chunks.append(cur_message)
+                        print_info_func(cur_message)
+                    if 'function_call' in delta:
+                        if "name" in delta.function_call:
+                            function_name = delta.function_call["name"]
+                            if function_name in self.streamed_function_arrays:
+                                arguments_parser = StreamingJsonParser(self.streamed_function_arrays[function_name])
+                        if "arguments" in delta.function_call:
+                            function_call_chunks.append(delta.function_call["arguments"])
+                            if arguments_parser and not arguments_parser.failed:
+                                for event in arguments_parser.feed(delta.function_call["arguments"]):
+                                    await self._on_streamed_function_argument(function_name, event, print_info_func)
+                    if 'role' in delta:
+                        role = delta['role']
+                    finish_reason = chunk.choices[0].finish_reason
+        finally:
+            # release the stream even if a handler fails mid-stream, otherwise its concurrency slot leaks
+            if hasattr(response, 'aclose'):
+                await response.aclose()
+
+        if arguments_parser and arguments_parser.failed:
+            logger.info(f'Failed to parse streaming arguments of {function_name}, fall back to parse the whole arguments')
+        return role, ''.join(message_chunks), function_name, ''.join(function_call_chunks), finish_reason
+
+    async def _on_streamed_function_argument(self, function_name, event, print_info_func):
+        '''
+        start the llm calls which only depend on the function call arguments completed so far while the rest of the call is still streaming.
+        nothing is written here, the files are written by the function itself once the stream is closed
+        '''
+        if function_name == 'dump_flow':
+            if event.key == 'explaination' and event.value and not self.flow_folder:
+                self._prefetch(('summarize_flow_name', event.value), lambda: self._summarize_flow_name(event.value))
+            elif event.key == 'flow_yaml' and isinstance(event.value, str):
+                self._streamed_python_nodes = self._find_python_nodes(event.value)
+                pending_python_functions, self._pending_python_functions = self._pending_python_functions, []
+                for python_function in pending_python_functions:
+                    self._prefetch_refine_python_code(python_function)
+            elif event.key == 'python_functions' and event.index is not None and isinstance(event.value, dict):
+                if self._streamed_python_nodes is None:
+                    self._pending_python_functions.append(event.value)
+                else:
+                    self._prefetch_refine_python_code(event.value)
+
+    @staticmethod
+    def _find_python_nodes(flow_yaml):
+        try:
+            parsed_flow_yaml = yaml.safe_load(flow_yaml)
+            return {key for node in parsed_flow_yaml['nodes'] if node.get('type') == 'python' for key in (node['name'], node['source']['path'])}
+        except Exception:
+            # the yaml needs to be repaired first, the python functions are refined after the stream then
+            return set()
+
+    def _prefetch_refine_python_code(self, python_function):
+        # only the python functions of the nodes in the flow are refined by dump_flow
+        if python_function.get('name') in self._streamed_python_nodes and python_function.get('content'):
+            python_code = python_function['content']
+            self._prefetch(('refine_python_code', python_code), lambda: self._refine_python_node(python_code))
+
+    def _prefetch(self, key, coroutine_func):
+        if key not in self._prefetched_tasks:
+            self._prefetched_tasks[key] = asyncio.create_task(coroutine_func())
+
+    async def _run_prefetched(self, key, coroutine_func):
+        task = self._prefetched_tasks.pop(key, None)
+        return await task if task is not None else await coroutine_func()
+
+    def _clear_streamed_function_state(self):
+        for task in self._prefetched_tasks.values():
+            task.cancel()
+        self._prefetched_tasks = {}
+        self._streamed_python_nodes = None
+        self._pending_python_functions = []
+
+    def _register_functions(self):
+        after_read_local_code = [function_calls.dump_flow, function_calls.upsert_flow_files]
+        after_read_flow = [function_calls.dump_flow_definition_and_description]
+        after_understand_flow = [function_calls.dump_sample_inputs, function_calls.dump_evaluation_flow, function_calls.upsert_flow_files]
+        understand_flow_call = {'name':'dump_flow_definition_and_description'}
+
+        self.function_registry.register(function_calls.dump_flow, self._handle_dump_flow, early_stop=True)
+        self.function_registry.register(function_calls.read_local_file, self._handle_read_local_file, next_functions=after_read_local_code)
+        self.function_registry.register(function_calls.read_local_folder, self._handle_read_local_folder, next_functions=after_read_local_code)
+        self.function_registry.register(function_calls.dump_sample_inputs, self._handle_dump_sample_inputs, early_stop=True)
+        self.function_registry.register(function_calls.dump_evaluation_flow, self._handle_dump_evaluation_flow)
+        self.function_registry.register(function_calls.read_flow_from_local_file, self._handle_read_flow_from_local_file, next_functions=after_read_flow, function_call=understand_flow_call)
+        self.function_registry.register(function_calls.read_flow_from_local_folder, self._handle_read_flow_from_local_folder, next_functions=after_read_flow, function_call=understand_flow_call)
+        self.function_registry.register(function_calls.dump_flow_definition_and_description, self._handle_dump_flow_definition_and_description, next_functions=after_understand_flow)
+        self.function_registry.register(function_calls.upsert_flow_files, self._handle_upsert_flow_files, early_stop=True)
+
+    # region function handlers
+    async def _handle_dump_flow(self, function_arguments, print_info_func):
+        flow_folder = await self.dump_flow(**function_arguments, print_info_func=print_info_func)
+        self.messages.append({"role": "function", "name": "dump_flow", "content": f'{flow_folder}'})
+
+    async def _handle_read_local_file(self, function_arguments, print_info_func):
+        file_content = await self.read_local_file(**function_arguments, print_info_func=print_info_func)
+        if not file_content:
+            print_info_func('\nyou ask me to read code from a file, but the file does not exists')
+            return FunctionCallResult(early_stop=True)
+        self.messages.append({"role": "function", "name": "read_local_file", "content":file_content})
+        self.messages.append({"role": "system", "content": "You have read the file content, understand it first and then determine your next step."})
+
+    async def _handle_read_local_folder(self, function_arguments, print_info_func):
+        files_content = await self.read_local_folder(**function_arguments, print_info_func=print_info_func)
+        if not files_content:
+            print_info_func('\nyou ask me to read code from a folder, but the folder does not exists')
+            return FunctionCallResult(early_stop=True)
+        self.messages.append({"role": "function", "name": "read_local_folder", "content":files_content})
+        self.messages.append({"role": "system", "content": "You have read all the files in the folder, understand it first and then determine your next step."})
+
+    async def _handle_dump_sample_inputs(self, function_arguments, print_info_func):
+        sample_input_file = await self.dump_sample_inputs(**function_arguments, target_folder=self.flow_folder, print_info_func=print_info_func)
+        self.messages.append({"role": "function", "name": "dump_sample_inputs", "content": f"{sample_input_file}"})
+
+    async def _handle_dump_evaluation_flow(self, function_arguments, print_info_func):
+        evaluation_flow_folder = await self.dump_evaluation_flow(**function_arguments, print_info_func=print_info_func)
+        self.messages.append({"role": "function", "name": "dump_evaluation_flow", "content": f"{evaluation_flow_folder}"})
+
+    async def _handle_read_flow_from_local_file(self, function_arguments, print_info_func):
+        file_content = await self.read_flow_from_local_file(**function_arguments, print_info_func=print_info_func)
+        if not file_content:
+            print_info_func('\nyou ask me to read flow from a file, but the file does not exists')
+            return FunctionCallResult(early_stop=True)
+        self.flow_folder = os.path.dirname(function_arguments['path'])
+        self.messages.append({"role": "function", "name": "read_flow_from_local_file", "content":file_content})
+
+    async def _handle_read_flow_from_local_folder(self, function_arguments, print_info_func):
+        self.flow_folder = function_arguments['path']
+        files_content = await self.read_flow_from_local_folder(**function_arguments, print_info_func=print_info_func)
+        if not files_content:
+            print_info_func('\nyou ask me to read flow from a folder, but the folder does not exists')
+            return FunctionCallResult(early_stop=True)
+        self.messages.append({"role": "function", "name": "read_flow_from_local_folder", "content":files_content})
+
+    def _handle_dump_flow_definition_and_description(self, function_arguments, print_info_func):
+        self.dump_flow_definition_and_description(**function_arguments, print_info_func=print_info_func)
+        self.messages.append({"role": "function", "name": "dump_flow_definition_and_description", "content": ""})
+
+    async def _handle_upsert_flow_files(self, function_arguments, print_info_func):
+        await self.upsert_flow_files(**function_arguments, print_info_func=print_info_func)
+        self.messages.append({"role": "function", "name": "upsert_flow_files", "content": ""})
+    # endregion
 
     def _clear_function_message(self):
         '''
         clear some function message from messages to reduce chat history size
         '''
-        for message in self.messages:
-            if message['role'] == 'function' and message['name'] in ['read_local_file', 'read_local_folder', 'read_flow_from_local_file', 'read_flow_from_local_folder', 'upsert_flow_files']:
-                self.messages.remove(message)
+        cleared_functions = ['read_local_file', 'read_local_folder', 'read_flow_from_local_file', 'read_flow_from_local_folder', 'upsert_flow_files']
+        self.messages.remove_where(lambda message: message['role'] == 'function' and message['name'] in cleared_functions)
+        self.sent_snapshots.clear()
 
     def _clear_system_message(self):
         '''
         clear some system message from messages to reduce chat history size
         '''
-        for message in self.messages:
-            if message['role'] == 'system' and message['content'].startswith("You can also calling the functions listed in [FUNCTIONS] directly on behalf of the user"):
-                self.messages.remove(message)
+        self.messages.remove_where(lambda message: message['role'] == 'system' and message['content'].startswith("You can also call the functions listed in [FUNCTIONS] directly on behalf of the user"))
 
     # region functions
     async def dump_flow(self, print_info_func, flow_yaml, explaination=None, python_functions=None, prompts=None, flow_inputs_schema=None, flow_outputs_schema=None, reasoning=None, **kwargs):
@@ -435,149 +797,160 @@ class CopilotContext:
 
         if not self.flow_folder:
             timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            flow_name = await self._summarize_flow_name(explaination) if explaination else 'flow_generated'
+            flow_name = await self._run_prefetched(('summarize_flow_name', explaination), lambda: self._summarize_flow_name(explaination)) if explaination else 'flow_generated'
             self.flow_folder = f'flow_{flow_name}_{timestamp}'
 
         target_folder = self.flow_folder
-
-        if not os.path.exists(target_folder):
-            os.mkdir(target_folder)
-            logger.info(f'Create flow folder:{target_folder}')
-
-        parsed_flow_yaml = await self._safe_load_flow_yaml(flow_yaml)
-        python_nodes_path_dict = {}
-        python_path_nodes_dict = {}
-        llm_nodes_path_dict = {}
-        llm_path_nodes_dict = {}
-        for node in parsed_flow_yaml['nodes']:
-            if node['type'] == 'python':
-                python_nodes_path_dict[node['name']] = node['source']['path']
-                python_path_nodes_dict[node['source']['path']] = node['name']
-            elif node['type'] == 'llm':
-                llm_nodes_path_dict[node['name']] = node['source']['path']
-                llm_path_nodes_dict[node['source']['path']] = node['name']
-
-        logger.info('Dumping flow.dag.yaml')
-        with open(f'{target_folder}\\flow.dag.yaml', 'w', encoding="utf-8") as f:
-            yaml.dump(parsed_flow_yaml, f, allow_unicode=True, sort_keys=False, indent=2)
-
-        if explaination:
-            logger.info('Dumping flow.explaination.txt')
-            with open(f'{target_folder}\\flow.explaination.txt', 'w', encoding="utf-8") as f:
-                f.write(explaination)
+        # nothing is written to the flow folder unless every file of the flow is generated
+        async with ArtifactWriter(target_folder) as artifact_writer:
+            parsed_flow_yaml = await self._safe_load_flow_yaml(flow_yaml)
+            python_nodes_path_dict = {}
+            python_path_nodes_dict = {}
+            llm_nodes_path_dict = {}
+            llm_path_nodes_dict = {}
+            for node in parsed_flow_yaml['nodes']:
+                if node['type'] == 'python':
+                    python_nodes_path_dict[node['name']] = node['source']['path']
+                    python_path_nodes_dict[node['source']['path']] = node['name']
+                elif node['type'] == 'llm':
+                    llm_nodes_path_dict[node['name']] = node['source']['path']
+                    llm_path_nodes_dict[node['source']['path']] = node['name']
+
+            logger.info('Dumping flow.dag.yaml')
+            await artifact_writer.write('flow.dag.yaml', yaml.dump(parsed_flow_yaml, allow_unicode=True, sort_keys=False, indent=2))
+
+            if explaination:
+                logger.info('Dumping flow.explaination.txt')
+                await artifact_writer.write('flow.explaination.txt', explaination)
                 self.flow_description = explaination
 
-        requirement_python_packages = set()
-        if python_functions and len(python_functions) > 0:
-            logger.info('Dumping python functions')
-            for func in python_functions:
-                python_node_name = func['name']
-                python_code = func['content']
-                python_file_name = None
-                if python_node_name in python_path_nodes_dict:
-                    python_file_name = python_path_nodes_dict[python_node_name]['source']['path']
-                elif python_node_name in python_nodes_path_dict:
-                    python_file_name = python_nodes_path_dict[python_node_name]
-                if python_file_name:
-                    with open(f'{target_folder}\\{python_file_name}', 'w', encoding="utf-8") as f:
-                        refined_codes = await self._refine_python_code(python_code)
-                        f.write(refined_codes)
-                        python_packages = await self._find_dependent_python_packages(refined_codes)
-                        requirement_python_packages.update(python_packages)
-                else:
-                    logger.info(f'python function for {python_node_name} is not used in the flow, skip dumping it')
-
-        if prompts and len(prompts) > 0:
-            logger.info('Dumping prompts')
-            for prompt in prompts:
-                prompt_node_name = prompt['name']
-                prompt_content = prompt['content']
-                prompt_file_name = None
-                if prompt_node_name in llm_path_nodes_dict:
-                    prompt_file_name = llm_path_nodes_dict[prompt_node_name]['source']['path']
-                elif prompt_node_name in llm_nodes_path_dict:
-                    prompt_file_name = llm_nodes_path_dict[prompt_node_name]
-                if prompt_file_name:
-                    with open(f'{target_folder}\\{prompt_file_name}', 'w', encoding="utf-8") as f:
-                        f.write(prompt_content)
-                else:
-                    logger.info(f'Prompt {prompt_node_name} is not used in the flow, skip dumping it')
+            requirement_python_packages = set()
+            if python_functions and len(python_functions) > 0:
+                logger.info('Dumping python functions')
+                python_files = []
+                for func in python_functions:
+                    python_node_name = func['name']
+                    python_code = func['content']
+                    python_file_name = None
+                    if python_node_name in python_path_nodes_dict:
+                        python_file_name = python_node_name
+                    elif python_node_name in python_nodes_path_dict:
+                        python_file_name = python_nodes_path_dict[python_node_name]
+                    if python_file_name:
+                        python_files.append((python_file_name, python_code))
+                    else:
+                        logger.info(f'python function for {python_node_name} is not used in the flow, skip dumping it')
+                requirement_python_packages = await self._dump_python_files(python_files, artifact_writer)
+
+            if prompts and len(prompts) > 0:
+                logger.info('Dumping prompts')
+                for prompt in prompts:
+                    prompt_node_name = prompt['name']
+                    prompt_content = prompt['content']
+                    prompt_file_name = None
+                    if prompt_node_name in llm_path_nodes_dict:
+                        prompt_file_name = prompt_node_name
+                    elif prompt_node_name in llm_nodes_path_dict:
+                        prompt_file_name = llm_nodes_path_dict[prompt_node_name]
+                    if prompt_file_name:
+                        await artifact_writer.write(prompt_file_name, prompt_content)
+                    else:
+                        logger.info(f'Prompt {prompt_node_name} is not used in the flow, skip dumping it')
 
-        if requirement_python_packages and len(requirement_python_packages) > 0:
-            logger.info('Dumping requirements.txt')
-            with open(f'{target_folder}\\requirements.txt', 'w', encoding="utf-8") as f:
-                f.write('\n'.join(requirement_python_packages))
+            if requirement_python_packages and len(requirement_python_packages) > 0:
+                logger.info('Dumping requirements.txt')
+                await artifact_writer.write('requirements.txt', '\n'.join(sorted(requirement_python_packages)))
 
         print_info_func(f'\nfinish dumping flow to folder:{self.flow_folder}')
         return self.flow_folder
 
-    def read_local_file(self, print_info_func, path=None, file_path=None, reasoning=None, **kwargs):
+    async def read_local_file(self, print_info_func, path=None, file_path=None, reasoning=None, **kwargs):
         if reasoning is not None:
             logger.info(f'function call read_local_file reasoning: {reasoning}')
 
         path = path if path else file_path
         if os.path.isdir(path):
-            return self.read_local_folder(path=path, print_info_func=print_info_func)
+            return await self.read_local_folder(path=path, print_info_func=print_info_func)
 
         if not os.path.exists(path):
             logger.info(f'{path} does not exists')
             return
         else:
             logger.info(f'read content from file:{path}')
-            with open(path, 'r', encoding="utf-8") as f:
-                return f.read()
-
-    def read_local_folder(self, print_info_func, path=None, file_path=None, included_file_types=['.py'], reasoning=None, **kwargs):
+            signature = file_signature(path)
+            snapshot = self.file_snapshots.get(path, signature)
+            if snapshot is not None:
+                file_content = snapshot[1]
+            else:
+                file_content = await asyncio.to_thread(Path(path).read_text, encoding="utf-8")
+                self.file_snapshots.put(path, signature, file_content)
+
+            last_sent = self.sent_snapshots.get(('file', path))
+            self.sent_snapshots.put(('file', path), signature, file_content)
+            if last_sent is None:
+                return file_content
+            if last_sent[1] == file_content:
+                logger.info(f'file {path} is unchanged since last read')
+                return f'The file {path} is unchanged since you last read it, refer to its content in the previous messages.'
+            logger.info(f'file {path} changed since last read, send the diff')
+            return f'The file {path} changed since you last read it, here is the unified diff:\n' + unified_diff(last_sent[1], file_content, os.path.basename(path))
+
+    async def read_local_folder(self, print_info_func, path=None, file_path=None, included_file_types=['.py'], reasoning=None, **kwargs):
         if reasoning is not None:
             logger.info(f'function call read_local_folder reasoning: {reasoning}')
 
         path = path if path else file_path
         if os.path.isfile(path):
-            return self.read_local_file(path=path, print_info_func=print_info_func)
+            return await self.read_local_file(path=path, print_info_func=print_info_func)
 
         if not os.path.exists(path):
             logger.info(f'{path} does not exists')
             return
         else:
             logger.info(f'read content from folder:{path}')
-            file_contents_dict = {}
-
-            for root, _, files in os.walk(path):
-                for file_name in files:
-                    file_ext = Path(file_name).suffix
-                    if not file_ext in included_file_types:
-                        continue
-                    subfolder_name = os.path.relpath(root, start=path)
-                    if subfolder_name == '.':
-                        subfolder_name = ''  # Use an empty string for files in the root folder
-                    else:
-                        subfolder_name += '/'  # Add a slash to separate subfolder name and file name
-                    file_path = os.path.join(root, file_name)
-                    with open(file_path, 'r', encoding='utf-8') as file:
-                        file_content = file.read()
-                        key = subfolder_name + file_name
-                        file_contents_dict[key] = file_content
-            return json.dumps(file_contents_dict)
-
-    def read_flow_from_local_folder(self, path, print_info_func, reasoning=None, **kwargs):
+            file_contents_dict, report = await asyncio.to_thread(
+                read_folder,
+                path,
+                included_file_types,
+                max_file_bytes=self.read_folder_max_file_bytes,
+                max_total_bytes=self.read_folder_max_total_bytes,
+                max_total_tokens=self.read_folder_max_total_tokens or self.context_window // 2,
+                count_tokens=self.budget_token_counter.count_text,
+                file_cache=self.file_snapshots)
+
+            snapshot_key = ('folder', path, tuple(included_file_types))
+            last_sent = self.sent_snapshots.get(snapshot_key)
+            self.sent_snapshots.put(snapshot_key, None, file_contents_dict)
+            if last_sent is None:
+                folder_content = {'files': file_contents_dict}
+            elif last_sent[1] == file_contents_dict:
+                logger.info(f'folder {path} is unchanged since last read')
+                folder_content = {'unchanged_since_last_read': True}
+            else:
+                logger.info(f'folder {path} changed since last read, send the changes')
+                folder_content = {'changes_since_last_read': diff_folder_contents(last_sent[1], file_contents_dict)}
+            folder_content.update({k: v for k, v in report.items() if v})
+            return json.dumps(folder_content)
+
+    async def read_flow_from_local_folder(self, path, print_info_func, reasoning=None, **kwargs):
         if reasoning is not None:
             logger.info(f'function call read_flow_from_local_folder reasoning: {reasoning}')
 
         if os.path.isfile(path):
-            return self.read_local_file(path=path, print_info_func=print_info_func)
+            return await self.read_local_file(path=path, print_info_func=print_info_func)
         logger.info(f'read existing flow from folder:{path}')
         self.flow_folder = path
-        return self.read_local_folder(path=path, print_info_func=print_info_func, included_file_types=['.yaml'])
+        return await self.read_local_folder(path=path, print_info_func=print_info_func, included_file_types=['.yaml'])
 
-    def read_flow_from_local_file(self, path, print_info_func, reasoning=None, **kwargs):
+    async def read_flow_from_local_file(self, path, print_info_func, reasoning=None, **kwargs):
         if reasoning is not None:
             logger.info(f'function call read_flow_from_local_file reasoning: {reasoning}')
 
         if os.path.isdir(path):
-            return self.read_flow_from_local_folder(path, print_info_func)
+            return await self.read_flow_from_local_folder(path, print_info_func)
         logger.info(f'read existing flow from file:{path}')
         self.flow_folder = os.path.dirname(path)
-        return self.read_local_file(path=path, print_info_func=print_info_func)
+        return await self.read_local_file(path=path, print_info_func=print_info_func)
 
     async def dump_sample_inputs(self, file_name, total_count, extra_requirements, target_folder, print_info_func, reasoning=None, **kwargs):
         if reasoning is not None:
@@ -587,55 +960,83 @@ class CopilotContext:
             print_info_func(f'\nBefore generate the sample inputs, please generate or provide the flow first')
             return
 
-        sample_inputs_file = f'{target_folder}\\{file_name}'
+        sample_inputs_file = os.path.join(target_folder, file_name)
         if not total_count or total_count < 1 or total_count > 1000:
             logger.info(f'invalid sample inputs count: {total_count}, Set to default 5')
             total_count = 5
 
         system_instruction = self.gen_sample_inputs_template.render(flow_yaml=self.flow_yaml)
-        user_input = f"Generate bulktest data with {total_count} items for the flow and then dump the data to my local disk for me."
-        if extra_requirements:
-            user_input += extra_requirements
-
-        messages = [
-            {"role": "system", "content": system_instruction},
-            {"role": "user", "content": user_input},
-            ]
-        
-        response = await self._ask_openai_async(messages=messages, functions=[function_calls.generate_sample_inputs], function_call={"name": "generate_sample_inputs"})
-        function_call = getattr(response.choices[0].message.function_call, "arguments", "") if hasattr(response.choices[0].message, 'function_call') else ""
-        function_arguments = await self._smart_json_loads(function_call)
-        sample_inputs = function_arguments['sample_inputs']
 
-        if sample_inputs is None:
+        def build_messages(count, shard_index, round_index):
+            user_input = f"Generate bulktest data with {count} items for the flow and then dump the data to my local disk for me."
+            if count < total_count or round_index > 0:
+                user_input += f" This is batch {shard_index + 1} of round {round_index + 1} of a larger data set, make the items diverse and avoid common examples."
+            if extra_requirements:
+                user_input += extra_requirements
+            return [
+                {"role": "system", "content": system_instruction},
+                {"role": "user", "content": user_input},
+                ]
+
+        artifact_writer = ArtifactWriter(target_folder)
+        async with artifact_writer:
+            generated_count = await self._generate_jsonl_rows(
+                total_count, build_messages, function_calls.generate_sample_inputs, 'sample_inputs',
+                artifact_writer, file_name, lambda done, total: print_info_func(f'\nGenerated {done}/{total} sample inputs'))
+
+        if generated_count == 0:
             print_info_func('\nFailed to generate inputs for your flow, please try again')
         else:
-            with open(sample_inputs_file, 'w', encoding="utf-8") as f:
-                for sample_input in sample_inputs:
-                    if sample_input is None:
-                        continue
-                    else:
-                        sample_input = await self._smart_json_loads(sample_input) if type(sample_input) == str else sample_input
-                        sample_input = json.dumps(sample_input)
-                    f.write(sample_input + '\n')
-            print_info_func(f'\nGenerated {len(sample_inputs)} sample inputs for your flow. And dump them into {target_folder}\\flow.sample_inputs.jsonl')
+            print_info_func(f'\nGenerated {generated_count} sample inputs for your flow. And dump them into {sample_inputs_file}')
 
         return sample_inputs_file
 
-    async def dump_evaluation_inputs(self, evaluation_inputs, eval_flow_folder, print_info_func, **kwargs):
-        evaluation_test_data_name = 'evaluation_test_data.jsonl'
-
-        with open(f'{eval_flow_folder}\\{evaluation_test_data_name}', 'w', encoding="utf-8") as f:
-            for sample_input in evaluation_inputs:
-                if sample_input is None:
+    async def _generate_jsonl_rows(self, total_count, build_messages, function, rows_key, artifact_writer, file_name, on_progress=None):
+        '''
+        generate total_count unique rows with function in concurrent shards, and append each shard to file_name of artifact_writer as soon as it finishes.
+        build_messages(count, shard_index, round_index) returns the messages of a shard, return the number of rows generated
+        '''
+        async def generate_shard(count, shard_index, round_index):
+            messages = build_messages(count, shard_index, round_index)
+            response = await self._ask_openai_async(messages=messages, functions=[function], function_call={"name": function['name']}, priority=PRIORITY_BACKGROUND)
+            function_call = getattr(response.choices[0].message.function_call, "arguments", "") if hasattr(response.choices[0].message, 'function_call') else ""
+            function_arguments = await self._smart_json_loads(function_call)
+            rows = []
+            for row in function_arguments.get(rows_key) or []:
+                if row is None:
                     continue
-                else:
-                    sample_input = await self._smart_json_loads(sample_input) if type(sample_input) == str else sample_input
-                    sample_input = json.dumps(sample_input)
-                f.write(sample_input + '\n')
+                rows.append(await self._smart_json_loads(row) if type(row) == str else row)
+            return rows
 
-        print_info_func(f'\nGenerated {len(evaluation_inputs)} sample evaluation inputs for your flow. And dump them into {eval_flow_folder}\\{evaluation_test_data_name}')
+        async def write_rows(rows):
+            await artifact_writer.append_lines(file_name, [json.dumps(row) for row in rows])
 
+        generator = ShardedRowGenerator(
+            generate_shard, write_rows,
+            shard_size=self.sample_inputs_shard_size,
+            concurrency=self.sample_inputs_concurrency,
+            max_top_up_rounds=self.sample_inputs_max_top_up_rounds,
+            on_progress=on_progress)
+        return await generator.generate(total_count)
+
+    async def _generate_evaluation_inputs(self, total_count, eval_flow_folder, artifact_writer, print_info_func):
+        evaluation_test_data_name = 'evaluation_test_data.jsonl'
+        system_instruction = self.gen_eval_flow_inputs_template.render(flow_yaml=self.flow_yaml)
+
+        def build_messages(count, shard_index, round_index):
+            user_input = f"Generate evaluation evalution input for me with {count} items"
+            if count < total_count or round_index > 0:
+                user_input += f". This is batch {shard_index + 1} of round {round_index + 1} of a larger data set, make the items diverse and avoid common examples."
+            return [
+                {"role": "system", "content": system_instruction},
+                {"role": "user", "content": user_input},
+                ]
+
+        generated_count = await self._generate_jsonl_rows(
+            total_count, build_messages, function_calls.dump_evaluation_input, 'evaluation_inputs',
+            artifact_writer, evaluation_test_data_name, lambda done, total: print_info_func(f'\nGenerated {done}/{total} evaluation inputs'))
+        print_info_func(f'\nGenerated {generated_count} sample evaluation inputs for your flow. And dump them into {os.path.join(eval_flow_folder, evaluation_test_data_name)}')
+        return generated_count
 
     async def dump_evaluation_flow(self, evaluation_flow_folder, target_output, total_count, print_info_func, reasoning=None, **kwargs):
         if reasoning is not None:
@@ -646,7 +1047,7 @@ class CopilotContext:
             return
 
         if not evaluation_flow_folder:
-            evaluation_flow_folder = self.flow_folder + '\\evaluation'
+            evaluation_flow_folder = os.path.join(self.flow_folder, 'evaluation')
 
         if not total_count or total_count < 1 or total_count > 1000:
             logger.info(f'invalid sample inputs count: {total_count}, Set to default 5')
@@ -660,46 +1061,45 @@ class CopilotContext:
             if target_output not in flow['outputs']:
                 raise Exception(f"Cannot find the specified output to evaluate in the flow. Output name: {target_output}")
 
-        if not os.path.exists(evaluation_flow_folder):
-            os.mkdir(evaluation_flow_folder)
-            logger.info(f'Create evaluation flow folder:{evaluation_flow_folder}')
+        artifact_writer = ArtifactWriter(evaluation_flow_folder)
 
-        # generate evaluation inputs
-        system_instruction = self.gen_eval_flow_inputs_template.render(flow_yaml=self.flow_yaml)
-        evaluation_data_count = total_count
-        user_input = f"Generate evaluation evalution input for me with {evaluation_data_count} items"
-        messages = [
-            {"role": "system", "content": system_instruction},
-            {"role": "user", "content": user_input},
-            ]
+        # evaluation inputs, evaluation functions and the evaluation flow yaml do not depend on each other and are generated concurrently
+        async def generate_evaluation_inputs():
+            return await self._generate_evaluation_inputs(total_count, evaluation_flow_folder, artifact_writer, print_info_func)
+
+        async def generate_evaluation_functions():
+            flow_output = f"flow output named {target_output}" if target_output else "flow outputs"
+            system_instruction = self.gen_eval_flow_functions.render(flow_yaml=self.flow_yaml, flow_output=flow_output)
+            messages = [{"role": "system", "content": system_instruction}]
+            response = await self._ask_openai_async(messages=messages, functions=[function_calls.dump_evaluation_functions], function_call={"name": "dump_evaluation_functions"}, priority=PRIORITY_BACKGROUND)
+            function_call = getattr(response.choices[0].message.function_call, "arguments", "") if hasattr(response.choices[0].message, 'function_call') else ""
+            return await self._smart_json_loads(function_call)
 
-        response = await self._ask_openai_async(messages=messages, functions=[function_calls.dump_evaluation_input], function_call={"name": "dump_evaluation_input"})
-        function_call = getattr(response.choices[0].message.function_call, "arguments", "") if hasattr(response.choices[0].message, 'function_call') else ""
-        function_arguments = await self._smart_json_loads(function_call)
-        evaluation_inputs = function_arguments['evaluation_inputs']
-        await self.dump_evaluation_inputs(evaluation_inputs, evaluation_flow_folder, print_info_func)
+        async def dump_evaluation_functions(generate_evaluation_functions):
+            # line_process and aggregate are refined concurrently
+            await self.dump_evaluation_functions(**generate_evaluation_functions, target_folder=evaluation_flow_folder, artifact_writer=artifact_writer)
 
-        # generate line_process and aggreate functions
-        flow_output = f"flow output named {target_output}" if target_output else "flow outputs"
-        system_instruction = self.gen_eval_flow_functions.render(flow_yaml=self.flow_yaml, flow_output=flow_output)
-        messages = [{"role": "system", "content": system_instruction}]
-        response = await self._ask_openai_async(messages=messages, functions=[function_calls.dump_evaluation_functions], function_call={"name": "dump_evaluation_functions"})
-        function_call = getattr(response.choices[0].message.function_call, "arguments", "") if hasattr(response.choices[0].message, 'function_call') else ""
-        function_arguments = await self._smart_json_loads(function_call)
+        async def dump_evaluation_flow_yaml_and_sdk_code():
+            await self.dump_evaluation_flow_yaml_and_sdk_code(flow, evaluation_flow_folder, self.flow_folder, target_output, artifact_writer=artifact_writer)
 
-        await self.dump_evaluation_functions(**function_arguments, target_folder=evaluation_flow_folder)
+        stage_graph = StageGraph('dump_evaluation_flow')
+        stage_graph.add('generate_evaluation_inputs', generate_evaluation_inputs)
+        stage_graph.add('generate_evaluation_functions', generate_evaluation_functions)
+        stage_graph.add('dump_evaluation_functions', dump_evaluation_functions, depends_on=['generate_evaluation_functions'])
+        stage_graph.add('dump_evaluation_flow_yaml_and_sdk_code', dump_evaluation_flow_yaml_and_sdk_code)
+        async with artifact_writer:
+            await stage_graph.run()
 
-        await self.dump_evaluation_flow_yaml_and_sdk_code(flow, evaluation_flow_folder, self.flow_folder, target_output)
         print_info_func(f"Successfully generated evaluation flow to {evaluation_flow_folder}")
 
         return evaluation_flow_folder
 
-    async def dump_evaluation_flow_yaml_and_sdk_code(self, original_flow, target_folder, flow_dir, specified_output, **kwargs):
-        evaluation_flow_template_folder = os.path.join(self.script_directory, '.\evaluation_template')
+    async def dump_evaluation_flow_yaml_and_sdk_code(self, original_flow, target_folder, flow_dir, specified_output, artifact_writer=None, **kwargs):
+        evaluation_flow_template_folder = os.path.join(self.script_directory, 'evaluation_template')
         evaluation_flow_yaml = os.path.join(evaluation_flow_template_folder, "flow.dag.yaml")
-        with open(evaluation_flow_yaml, 'r') as f:
-            yaml_str = f.read()
-            evaluation_flow = await self._safe_load_flow_yaml(yaml_str)
+        yaml_str = await asyncio.to_thread(Path(evaluation_flow_yaml).read_text)
+        evaluation_flow = await self._safe_load_flow_yaml(yaml_str)
+        writer = artifact_writer or ArtifactWriter(target_folder)
 
         evaluation_flow['inputs'] = {}
         for k,v in original_flow['outputs'].items():
@@ -714,9 +1114,7 @@ class CopilotContext:
                     node['inputs'][k] = f"${{inputs.{k}}}"
 
         # dump modified yaml to local file
-        modified_yaml_path = os.path.join(target_folder, "flow.dag.yaml")
-        with open(modified_yaml_path, "w", encoding="utf-8") as f:
-            yaml.safe_dump(evaluation_flow, f)
+        await writer.write("flow.dag.yaml", yaml.safe_dump(evaluation_flow))
 
         # dump sample sdk code
         # generate column mapping string
@@ -731,6 +1129,7 @@ class CopilotContext:
         evaluation_flow_folder_string = target_folder.replace("\\", "\\\\")
         flow_dir_string = flow_dir.replace("\\", "\\\\")
         target_folder_string = target_folder.replace("\\", "\\\\")
+        evaluation_data_string = os.path.join(target_folder, "evaluation_test_data.jsonl").replace("\\", "\\\\")
         sdk_eval_sample_code = f"""
 from promptflow import PFClient
 import json
@@ -738,7 +1137,7 @@ import json
 def main():
     # Set flow path and run input data
     flow = "{flow_dir_string}" # set the flow directory
-    data= "{target_folder_string}\\\\evaluation_test_data.jsonl" # set the data file
+    data= "{evaluation_data_string}" # set the data file
 
     pf = PFClient()
 
@@ -751,7 +1150,7 @@ def main():
 
     # set eval flow path
     eval_flow = "{evaluation_flow_folder_string}"
-    data= "{evaluation_flow_folder_string}\\\\evaluation_test_data.jsonl"
+    data= "{evaluation_data_string}"
 
     # run the flow with exisiting run
     eval_run = pf.run(
@@ -779,8 +1178,9 @@ if __name__ == "__main__":
     main()
 
     """
-        with open(f'{target_folder}\\promptflow_sdk_sample_code.py', 'w', encoding="utf-8") as f:
-            f.write(sdk_eval_sample_code)
+        await writer.write('promptflow_sdk_sample_code.py', sdk_eval_sample_code)
+        if artifact_writer is None:
+            await writer.commit()
 
     def dump_flow_definition_and_description(self, flow_yaml, description, print_info_func, reasoning=None, **kwargs):
         if reasoning is not None:
@@ -789,51 +1189,90 @@ if __name__ == "__main__":
         self.flow_yaml = flow_yaml
         self.flow_description = description
         print_info_func(description)
-        self.messages.append({'role':'assistant', 'content':description})
+        previous_description_message = self._flow_description_message
+        if previous_description_message is not None:
+            self.messages.remove_where(lambda message: message is previous_description_message)
+        description_message = {'role':'assistant', 'content':description}
+        self.messages.append(description_message)
+        self.messages.pin(description_message)
+        self._flow_description_message = description_message
 
     async def upsert_flow_files(self, files_name_content, print_info_func, reasoning=None, **kwargs):
         if reasoning is not None:
             logger.info(f'function call upsert_flow_files reasoning: {reasoning}')
 
-        for upsert_flow_files in files_name_content:
-            file_name = upsert_flow_files.get('name') or upsert_flow_files.get('file_name')
-            if file_name is None:
-                file_name = upsert_flow_files['file_name'] if 'file_name' in upsert_flow_files else None
-            if file_name is None:
-                logger.info(f'file name is not specified, skip.')
-                break
-            if self.flow_folder not in file_name:
-                file_name = os.path.join(self.flow_folder, file_name)
-            file_content = upsert_flow_files.get('content') or upsert_flow_files.get('file_content')
-            if os.path.exists(file_name):
-                logger.info(f'file {file_name} already exists, update existing file')
-                print_info_func(f'\nupdate existing file {file_name}')
-            else:
-                logger.info(f'file {file_name} does not exist, create new file')
-                print_info_func(f'\ncreate new file {file_name}')
-            with open(file_name, 'w', encoding="utf-8") as f:
-                f.write(file_content)
-
-            if file_name.endswith('dag.yaml'):
-                logger.info('update flow yaml')
-                await self._safe_load_flow_yaml(file_content)
+        # the files are committed together, a failure leaves all of them unchanged
+        flow_yaml = None
+        async with ArtifactWriter(self.flow_folder) as artifact_writer:
+            for upsert_flow_file in files_name_content:
+                staged_file = await self._upsert_flow_file(upsert_flow_file, artifact_writer, print_info_func)
+                if staged_file is None:
+                    break
+                file_name, file_content = staged_file
+                if file_name and file_name.endswith('dag.yaml'):
+                    flow_yaml = file_content
+
+        if flow_yaml is not None:
+            logger.info('update flow yaml')
+            await self._safe_load_flow_yaml(flow_yaml)
+
+    async def _upsert_flow_file(self, upsert_flow_file, artifact_writer, print_info_func):
+        '''
+        stage an upserted file to artifact_writer, return its file name and content, (None, None) if it is skipped,
+        or None if the file name is missing and the remaining files should not be upserted
+        '''
+        file_name = upsert_flow_file.get('name') or upsert_flow_file.get('file_name')
+        if file_name is None:
+            logger.info(f'file name is not specified, skip.')
+            return None
+        # the file name is relative to the flow folder unless it is a path inside the flow folder already
+        relative_path = relative_path_in_folder(file_name, self.flow_folder)
+        if relative_path is None:
+            file_name = os.path.join(self.flow_folder, file_name)
+            relative_path = relative_path_in_folder(file_name, self.flow_folder)
+        if relative_path is None:
+            logger.warning(f'file {file_name} is outside the flow folder {self.flow_folder}, skip.')
+            print_info_func(f'\nskip file {file_name}, only the files in the flow folder {self.flow_folder} can be updated')
+            return None, None
+        file_content = upsert_flow_file.get('content') or upsert_flow_file.get('file_content')
+        if os.path.exists(file_name):
+            logger.info(f'file {file_name} already exists, update existing file')
+            print_info_func(f'\nupdate existing file {file_name}')
+        else:
+            logger.info(f'file {file_name} does not exist, create new file')
+            print_info_func(f'\ncreate new file {file_name}')
+        await artifact_writer.write(relative_path, file_content)
+        return file_name, file_content
 
-    async def dump_evaluation_functions(self, line_process, aggregate, target_folder):
-        requirement_python_packages = set()
-        with open(f'{target_folder}\\line_process.py', 'w', encoding="utf-8") as f:
-            refined_codes = await self._refine_python_code(line_process)
-            f.write(refined_codes)
-            packages = await self._find_dependent_python_packages(refined_codes)
-            requirement_python_packages.update(packages)
-        with open(f'{target_folder}\\aggregate.py', 'w', encoding="utf-8") as f:
-            refined_codes = await self._refine_python_code(aggregate)
-            f.write(refined_codes)
-            packages = await self._find_dependent_python_packages(refined_codes)
-            requirement_python_packages.update(packages)
+    async def dump_evaluation_functions(self, line_process, aggregate, target_folder, artifact_writer=None):
+        python_files = [('line_process.py', line_process), ('aggregate.py', aggregate)]
+        writer = artifact_writer or ArtifactWriter(target_folder)
+        requirement_python_packages = await self._dump_python_files(python_files, writer)
 
         # dump requirements.txt
         if requirement_python_packages and len(requirement_python_packages) > 0:
-            with open(f'{target_folder}\\requirements.txt', 'w', encoding="utf-8") as f:
-                f.write('\n'.join(requirement_python_packages))
+            await writer.write('requirements.txt', '\n'.join(sorted(requirement_python_packages)))
+        if artifact_writer is None:
+            await writer.commit()
+
+    async def _dump_python_files(self, python_files, artifact_writer):
+        '''
+        refine python files and find their dependent packages concurrently, at most python_node_concurrency files at a time.
+        each file is staged to artifact_writer as soon as it is refined, the dependent packages of all files are merged and returned.
+        '''
+        local_modules = {Path(python_file_name).stem for python_file_name, _ in python_files}
+
+        async def dump_python_file(python_file_name, python_code):
+            # a refine call prefetched while dump_flow was streaming holds its own slot of the semaphore
+            refined_codes = await self._run_prefetched(('refine_python_code', python_code), lambda: self._refine_python_node(python_code))
+            async with self._python_node_semaphore:
+                await artifact_writer.write(python_file_name, refined_codes)
+                logger.info(f'Dumped python file {python_file_name}')
+                return await self._find_dependent_python_packages(refined_codes, local_modules)
+
+        requirement_python_packages = set()
+        for python_packages in await asyncio.gather(*[dump_python_file(name, code) for name, code in python_files]):
+            requirement_python_packages.update(python_packages)
+        return requirement_python_packages
 
     # endregion
\ No newline at end of file
@@ -0,0 +1,162 @@
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import tempfile
+from datetime import datetime
+from logging_util import get_logger
+
+logger = get_logger()
+
+MANIFEST_FILE_NAME = 'flow.manifest.json'
+
+def relative_path_in_folder(path, folder):
+    '''
+    the normalized path of path relative to folder, or None if it is not inside the folder
+    '''
+    try:
+        relative_path = os.path.normpath(os.path.relpath(path, folder))
+    except ValueError:
+        # on a different drive
+        return None
+    if os.path.isabs(relative_path) or relative_path == os.pardir or relative_path.startswith(os.pardir + os.sep):
+        return None
+    return relative_path
+
+class ArtifactWriter:
+    '''
+    write the files of a flow without blocking the event loop and without leaving a half written flow folder.
+    files are staged in a temp folder next to the target folder as soon as they are written, commit() then
+    renames the staging folder into place if the target folder does not exist yet, or atomically replaces
+    the files one by one in an existing folder. a manifest with the sha256 of every written file is kept in the target folder.
+    use it as an async context manager to commit on success and discard the staged files on failure.
+    '''
+    def __init__(self, target_folder, manifest_name=MANIFEST_FILE_NAME) -> None:
+        self.target_folder = target_folder
+        self.manifest_name = manifest_name
+        self._staging_folder = None
+        self._written_files = {}
+        self._append_hashes = {}
+        self._append_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.commit()
+        else:
+            await asyncio.to_thread(self.abort)
+
+    def _get_staging_folder(self):
+        if self._staging_folder is None:
+            parent_folder = os.path.dirname(os.path.abspath(self.target_folder))
+            os.makedirs(parent_folder, exist_ok=True)
+            self._staging_folder = tempfile.mkdtemp(prefix=f'.{os.path.basename(os.path.abspath(self.target_folder))}.tmp-', dir=parent_folder)
+        return self._staging_folder
+
+    def _write_staged(self, relative_path, content):
+        staged_path = os.path.join(self._get_staging_folder(), relative_path)
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        data = content.encode('utf-8')
+        with open(staged_path, 'wb') as f:
+            f.write(data)
+        self._written_files[relative_path] = {'sha256': hashlib.sha256(data).hexdigest(), 'size': len(data)}
+
+    def _append_staged(self, relative_path, content):
+        staged_path = os.path.join(self._get_staging_folder(), relative_path)
+        os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+        data = content.encode('utf-8')
+        with open(staged_path, 'ab') as f:
+            f.write(data)
+        file_hash = self._append_hashes.setdefault(relative_path, hashlib.sha256())
+        file_hash.update(data)
+        size = self._written_files.get(relative_path, {}).get('size', 0) + len(data)
+        self._written_files[relative_path] = {'sha256': file_hash.hexdigest(), 'size': size}
+
+    def _check_relative_path(self, relative_path):
+        checked_path = None if os.path.isabs(relative_path) else relative_path_in_folder(os.path.join(self.target_folder, relative_path), self.target_folder)
+        if checked_path is None:
+            raise ValueError(f'{relative_path} is not inside the flow folder {self.target_folder}')
+        self._get_staging_folder()
+        return checked_path
+
+    async def write(self, relative_path, content):
+        '''
+        stage a file, relative_path is relative to the target folder
+        '''
+        relative_path = self._check_relative_path(relative_path)
+        self._append_hashes.pop(relative_path, None)
+        await asyncio.to_thread(self._write_staged, relative_path, content)
+
+    async def write_lines(self, relative_path, lines):
+        await self.write(relative_path, ''.join(line + '\n' for line in lines))
+
+    async def append_lines(self, relative_path, lines):
+        '''
+        append lines to a staged file, so that large outputs can be streamed to disk while they are generated
+        '''
+        relative_path = self._check_relative_path(relative_path)
+        async with self._append_lock:
+            await asyncio.to_thread(self._append_staged, relative_path, ''.join(line + '\n' for line in lines))
+
+    def _load_manifest(self):
+        manifest_path = os.path.join(self.target_folder, self.manifest_name)
+        if os.path.exists(manifest_path):
+            try:
+                with open(manifest_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+            except (OSError, ValueError):
+                logger.warning(f'Failed to load manifest {manifest_path}, create a new one')
+        return {'files': {}}
+
+    def _build_manifest(self, manifest):
+        manifest['files'].update(self._written_files)
+        manifest['updated_at'] = datetime.now().isoformat()
+        return json.dumps(manifest, indent=2, sort_keys=True)
+
+    def _commit_sync(self):
+        if not self._written_files:
+            return []
+
+        staging_folder = self._get_staging_folder()
+        if not os.path.exists(self.target_folder):
+            with open(os.path.join(staging_folder, self.manifest_name), 'w', encoding='utf-8') as f:
+                f.write(self._build_manifest({'files': {}}))
+            try:
+                os.rename(staging_folder, self.target_folder)
+                self._staging_folder = None
+                logger.info(f'Created folder {self.target_folder} with {len(self._written_files)} files')
+                return list(self._written_files)
+            except OSError:
+                # the target folder was created meanwhile, fall back to replace the files one by one
+                os.remove(os.path.join(staging_folder, self.manifest_name))
+
+        for relative_path in self._written_files:
+            target_path = os.path.join(self.target_folder, relative_path)
+            os.makedirs(os.path.dirname(target_path), exist_ok=True)
+            os.replace(os.path.join(staging_folder, relative_path), target_path)
+
+        manifest_content = self._build_manifest(self._load_manifest())
+        staged_manifest_path = os.path.join(staging_folder, self.manifest_name)
+        with open(staged_manifest_path, 'w', encoding='utf-8') as f:
+            f.write(manifest_content)
+        os.replace(staged_manifest_path, os.path.join(self.target_folder, self.manifest_name))
+        self.abort()
+        logger.info(f'Updated {len(self._written_files)} files in folder {self.target_folder}')
+        return list(self._written_files)
+
+    async def commit(self):
+        '''
+        move the staged files into the target folder, return the relative paths of the written files
+        '''
+        written_files = await asyncio.to_thread(self._commit_sync)
+        self._written_files = {}
+        self._append_hashes = {}
+        return written_files
+
+    def abort(self):
+        if self._staging_folder is not None:
+            shutil.rmtree(self._staging_folder, ignore_errors=True)
+            self._staging_folder = None
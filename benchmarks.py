@@ -0,0 +1,315 @@
+'''
+micro-benchmarks of the cpu hot paths of the copilot, they run without any llm endpoint.
+
+    python benchmarks.py                          run all benchmarks and save the results to .benchmarks/<commit>.json
+    python benchmarks.py --filter token_count     run the benchmarks whose name contains token_count
+    python benchmarks.py --compare <results.json> compare the results with an earlier run, slower benchmarks are flagged
+    python benchmarks.py --output <results.json>  save the results to another file
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import random
+import shutil
+import asyncio
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+import yaml
+from CopilotContext import CopilotContext
+from llm_replay import LLMReplayer, ReplayLLMClient
+from snapshot_cache import SnapshotCache
+from token_utils import TokenCounter, TokenCountedMessages, get_token_counter
+
+RESULTS_FOLDER = '.benchmarks'
+# a benchmark whose min is more than this ratio of the baseline min is flagged as a regression, the min is the least noisy statistic
+REGRESSION_RATIO = 1.2
+
+BENCHMARKS = []
+
+def benchmark(name, rounds=5):
+    '''
+    register a benchmark. the decorated async function does the setup and returns the async function which is timed, it is called rounds times.
+    it can also return a tuple of a function preparing each round, which is not timed, and the timed async function
+    '''
+    def decorator(setup_func):
+        BENCHMARKS.append((name, rounds, setup_func))
+        return setup_func
+    return decorator
+
+def no_print(message):
+    pass
+
+def synthetic_history(message_count, seed=0):
+    rng = random.Random(seed)
+    words = ['flow', 'node', 'python', 'prompt', 'llm', 'input', 'output', 'variant', 'evaluation', 'yaml', 'the', 'a', 'of', 'to']
+    roles = ['user', 'assistant', 'function', 'system']
+    messages = []
+    for index in range(message_count):
+        role = roles[index % len(roles)]
+        message = {'role': role, 'content': ' '.join(rng.choice(words) for _ in range(rng.randint(20, 200))) + f' #{index}'}
+        if role == 'function':
+            message['name'] = rng.choice(['read_local_file', 'read_local_folder', 'dump_flow', 'upsert_flow_files'])
+        messages.append(message)
+    return messages
+
+def exact_token_counter():
+    # a new counter with empty memo caches, sharing the loaded encoding so that loading it is not timed
+    token_counter = TokenCounter()
+    token_counter._encoding = get_token_counter().encoding
+    return token_counter
+
+def stream_chunks(deltas, finish_reason='stop'):
+    from openai.openai_object import OpenAIObject
+    chunks = [OpenAIObject.construct_from({'choices': [{'index': 0, 'delta': {'role': 'assistant'}, 'finish_reason': None}]})]
+    chunks.extend(OpenAIObject.construct_from({'choices': [{'index': 0, 'delta': delta, 'finish_reason': None}]}) for delta in deltas)
+    chunks.append(OpenAIObject.construct_from({'choices': [{'index': 0, 'delta': {}, 'finish_reason': finish_reason}]}))
+    return chunks
+
+async def iterate(chunks):
+    for chunk in chunks:
+        yield chunk
+
+def split_text(text, pieces):
+    size = max(1, len(text) // pieces)
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+for message_count in (100, 1000, 5000):
+    @benchmark(f'token_count_history[{message_count}]')
+    async def bench_token_count_history(copilot_context, message_count=message_count):
+        messages = synthetic_history(message_count)
+
+        async def run():
+            # a history growing one message at a time, with the running total after every message
+            history = TokenCountedMessages(exact_token_counter())
+            for message in messages:
+                history.append(message)
+                history.num_tokens
+        return run
+
+    @benchmark(f'token_count_messages_warm[{message_count}]')
+    async def bench_token_count_messages_warm(copilot_context, message_count=message_count):
+        token_counter = exact_token_counter()
+        messages = synthetic_history(message_count)
+        token_counter.count_messages(messages)
+
+        async def run():
+            token_counter.count_messages(messages)
+        return run
+
+@benchmark('safe_load_flow_yaml[200 nodes, 100 node_variants]')
+async def bench_safe_load_flow_yaml(copilot_context):
+    nodes = []
+    node_variants = {}
+    for index in range(200):
+        node = {'name': f'node_{index}', 'type': 'llm' if index % 2 else 'python', 'source': {'type': 'code', 'path': f'node_{index}.jinja2'},
+                'inputs': {'prompt': f'node_{index}.jinja2', 'text': f'${{inputs.text}}', 'max_tokens': 256}}
+        if index < 100:
+            node_variants[f'node_{index}'] = {'default_variant_id': 'variant_0', 'variants': {
+                f'variant_{variant}': {'node': {'type': 'llm', 'source': {'type': 'code', 'path': f'node_{index}_variant_{variant}.jinja2'},
+                                                'inputs': {'prompt': f'node_{index}_variant_{variant}.jinja2', 'temperature': variant / 10}}}
+                for variant in range(5)}}
+            node = {'name': node['name'], 'use_variants': True}
+        nodes.append(node)
+    flow = {'inputs': {'text': {'type': 'string'}}, 'outputs': {'output': {'type': 'string', 'reference': '${node_199.output}'}},
+            'nodes': nodes, 'node_variants': node_variants}
+    flow_yaml = yaml.dump(flow, sort_keys=False)
+
+    async def run():
+        await copilot_context._safe_load_flow_yaml(flow_yaml)
+    return run
+
+def create_synthetic_tree(root, file_count):
+    for index in range(file_count):
+        folder = os.path.join(root, f'package_{index % 50}', f'module_{index % 7}')
+        os.makedirs(folder, exist_ok=True)
+        extension = '.py' if index % 4 else '.md'
+        with open(os.path.join(folder, f'file_{index}{extension}'), 'w') as f:
+            f.write(f'def function_{index}(value):\n    return value * {index}\n' * (index % 10 + 1))
+    with open(os.path.join(root, '.gitignore'), 'w') as f:
+        f.write('package_49/\n')
+
+@benchmark('read_local_folder_cold[10000 files]', rounds=3)
+async def bench_read_local_folder_cold(copilot_context):
+    root = os.path.join(copilot_context.benchmark_folder, 'tree')
+    if not os.path.exists(root):
+        create_synthetic_tree(root, 10000)
+
+    async def run():
+        copilot_context.file_snapshots = SnapshotCache(max_entries=20000)
+        copilot_context.sent_snapshots.clear()
+        await copilot_context.read_local_folder(no_print, path=root, included_file_types=['.py', '.md'])
+    return run
+
+@benchmark('read_local_folder_warm[10000 files]', rounds=3)
+async def bench_read_local_folder_warm(copilot_context):
+    root = os.path.join(copilot_context.benchmark_folder, 'tree')
+    if not os.path.exists(root):
+        create_synthetic_tree(root, 10000)
+    copilot_context.file_snapshots = SnapshotCache(max_entries=20000)
+    await copilot_context.read_local_folder(no_print, path=root, included_file_types=['.py', '.md'])
+
+    async def run():
+        await copilot_context.read_local_folder(no_print, path=root, included_file_types=['.py', '.md'])
+    return run
+
+@benchmark('parse_gpt_response_content[100000 deltas]', rounds=3)
+async def bench_parse_gpt_response_content(copilot_context):
+    chunks = stream_chunks({'content': f'token{index % 97} '} for index in range(100000))
+
+    async def run():
+        copilot_context.messages = copilot_context._new_history()
+        await copilot_context.parse_gpt_response(iterate(chunks), no_print)
+    return run
+
+@benchmark('read_function_call_stream[100000 deltas]', rounds=3)
+async def bench_read_function_call_stream(copilot_context):
+    arguments = json.dumps({
+        'flow_yaml': 'nodes:\n' + ''.join(f'- name: node_{index}\n  type: python\n' for index in range(500)),
+        'python_functions': [{'name': f'node_{index}', 'file_name': f'node_{index}.py'} for index in range(2000)],
+        'explaination': 'a synthetic flow'})
+    deltas = [{'function_call': {'name': 'dump_flow', 'arguments': ''}}]
+    deltas.extend({'function_call': {'arguments': piece}} for piece in split_text(arguments, 100000))
+    chunks = stream_chunks(deltas, 'function_call')
+
+    async def run():
+        # a flow folder is set so that no llm call is prefetched while the arguments stream
+        copilot_context.flow_folder = copilot_context.benchmark_folder
+        try:
+            await copilot_context._read_streaming_response(iterate(chunks), no_print)
+        finally:
+            copilot_context._clear_streamed_function_state()
+            copilot_context.flow_folder = None
+    return run
+
+for message_count in (1000, 10000):
+    @benchmark(f'clear_function_message[{message_count}]')
+    async def bench_clear_function_message(copilot_context, message_count=message_count):
+        messages = synthetic_history(message_count)
+
+        def prepare_round():
+            copilot_context.messages = copilot_context._new_history()
+            copilot_context.messages.extend(messages)
+
+        async def run():
+            copilot_context._clear_function_message()
+        return prepare_round, run
+
+@benchmark('dump_sample_inputs[1000 rows]', rounds=3)
+async def bench_dump_sample_inputs(copilot_context):
+    rows_per_response = copilot_context.sample_inputs_shard_size
+    records = []
+    for response_index in range(1000 // rows_per_response):
+        rows = [{'text': f'sample input {response_index * rows_per_response + index} ' + 'lorem ipsum ' * 20, 'language': 'en'} for index in range(rows_per_response)]
+        arguments = json.dumps({'sample_inputs': rows})
+        records.append({'key': str(response_index), 'request': {'stream': False}, 'latency': 0, 'response': {
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': None, 'function_call': {'name': 'generate_sample_inputs', 'arguments': arguments}}, 'finish_reason': 'stop'}],
+            'usage': {'prompt_tokens': 100, 'completion_tokens': 1000, 'total_tokens': 1100}}})
+    target_folder = os.path.join(copilot_context.benchmark_folder, 'sample_inputs')
+    os.makedirs(target_folder, exist_ok=True)
+    copilot_context.flow_yaml = 'inputs:\n  text:\n    type: string\n'
+
+    async def run():
+        copilot_context.llm_client.replayer = LLMReplayer(records, time_scale=0, sequential=True)
+        await copilot_context.dump_sample_inputs('samples.jsonl', 1000, None, target_folder, no_print)
+    return run
+
+def summarize(durations):
+    return {
+        'rounds': len(durations),
+        'min': min(durations),
+        'median': statistics.median(durations),
+        'mean': statistics.mean(durations),
+        'stdev': statistics.stdev(durations) if len(durations) > 1 else 0.0,
+    }
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+async def run_benchmarks(name_filter=None):
+    benchmark_folder = tempfile.mkdtemp(prefix='pfcopilot-benchmarks-')
+    copilot_context = CopilotContext(llm_client=ReplayLLMClient(LLMReplayer([], time_scale=0, sequential=True)))
+    copilot_context.benchmark_folder = benchmark_folder
+    get_token_counter().warmup()
+    results = {}
+    try:
+        for name, rounds, setup_func in BENCHMARKS:
+            if name_filter and name_filter not in name:
+                continue
+            run = await setup_func(copilot_context)
+            prepare_round = None
+            if isinstance(run, tuple):
+                prepare_round, run = run
+            durations = []
+            for _ in range(rounds):
+                if prepare_round:
+                    prepare_round()
+                start_time = time.perf_counter()
+                await run()
+                durations.append(time.perf_counter() - start_time)
+            results[name] = summarize(durations)
+            print(f'{name}: median {results[name]["median"] * 1000:.1f} ms, min {results[name]["min"] * 1000:.1f} ms ({rounds} rounds)')
+    finally:
+        await copilot_context.close()
+        shutil.rmtree(benchmark_folder, ignore_errors=True)
+    return results
+
+def compare(results, baseline):
+    '''
+    print the ratio of the min of each benchmark to its baseline min, return the names of the regressed benchmarks
+    '''
+    regressions = []
+    print(f'compared with {baseline.get("commit")} ({baseline.get("created_at")}):')
+    for name, result in results.items():
+        baseline_result = baseline['benchmarks'].get(name)
+        if baseline_result is None:
+            print(f'  {name}: new')
+            continue
+        ratio = result['min'] / baseline_result['min'] if baseline_result['min'] else float('inf')
+        flag = ''
+        if ratio > REGRESSION_RATIO:
+            flag = '  <-- slower'
+            regressions.append(name)
+        print(f'  {name}: {ratio:.2f}x{flag}')
+    return regressions
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', help='run the benchmarks whose name contains this text')
+    parser.add_argument('--compare', metavar='RESULTS_JSON', help='compare the results with an earlier run, slower benchmarks are flagged')
+    parser.add_argument('--output', metavar='RESULTS_JSON', help='save the results to this file instead of .benchmarks/<commit>.json')
+    return parser.parse_args(argv)
+
+def main(argv):
+    args = parse_args(argv)
+    results = asyncio.run(run_benchmarks(args.filter))
+    commit = current_commit()
+    output_path = args.output or os.path.join(RESULTS_FOLDER, f'{commit}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'benchmarks': results,
+        }, f, indent=2)
+    print(f'saved the results to {output_path}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f))
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
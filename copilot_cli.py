@@ -1,3 +1,7 @@
+from startup_profile import StartupProfiler
+# started before the other imports so that their import time is measured, run with --startup-profile to print it
+startup_profiler = StartupProfiler.from_argv()
+
 import colorama
 import traceback
 from termcolor import colored
@@ -10,15 +14,19 @@ colorama.init(autoreset=False)
 def print_no_newline(msg):
     print(msg, end="")
 
-def main():
+async def main_async():
+    if startup_profiler:
+        startup_profiler.mark('imports')
     print(colored(f'[{COPILOT_TAG}]:', 'red'))
     print(welcome_message + 'You can end the chat by type `exit` in the command line, or start a new chat by type `new chat` in the command line')
 
     load_dotenv('pfcopilot.env')
-    
+
     # init CopilotContext
     copilot_context = CopilotContext()
-    
+    if startup_profiler:
+        startup_profiler.mark('create copilot context')
+
     # check environment
     print(checking_environment_message)
     env_ready, msg = copilot_context.check_env()
@@ -27,9 +35,19 @@ def main():
     else:
         print(environment_not_ready_message + msg)
 
-    loop = asyncio.get_event_loop()
+    # warm up the tokenizer, templates and connections while the user is typing
+    warmup_task = asyncio.create_task(copilot_context.warmup()) if env_ready else None
+    if startup_profiler:
+        startup_profiler.mark('check environment')
+        if warmup_task:
+            await warmup_task
+            startup_profiler.mark('warmup')
+        print(startup_profiler.report())
+
+    loop = asyncio.get_running_loop()
     while True:
-        goal = input(colored(f'\n[{USER_TAG}]: \n', 'red'))
+        # input() runs in a worker thread so that the warmup keeps running on the event loop
+        goal = await loop.run_in_executor(None, input, colored(f'\n[{USER_TAG}]: \n', 'red'))
         if goal.lower() == 'exit':
             print('\n' + colored(f'[{COPILOT_TAG}]:', 'red') + '\n You are trying to end this chat, and it will be closed.')
             break
@@ -39,10 +57,17 @@ def main():
         else:
             print(colored(f'[{COPILOT_TAG}]:', 'red'))
             try:
-                loop.run_until_complete(copilot_context.ask_gpt_async(goal, print_no_newline))
+                await copilot_context.ask_gpt_async(goal, print_no_newline)
             except Exception:
                 trace_back = traceback.format_exc()
                 print('\nError occurred. Please fix the error and try again.\n' + trace_back)
 
+    if warmup_task and not warmup_task.done():
+        warmup_task.cancel()
+    await copilot_context.close()
+
+def main():
+    asyncio.run(main_async())
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
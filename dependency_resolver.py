@@ -0,0 +1,111 @@
+import ast
+import os
+import sys
+import sysconfig
+from importlib import metadata
+
+# import names whose distribution name differs from the import name
+IMPORT_TO_DISTRIBUTION = {
+    'attr': 'attrs',
+    'bs4': 'beautifulsoup4',
+    'Crypto': 'pycryptodome',
+    'cv2': 'opencv-python',
+    'dateutil': 'python-dateutil',
+    'docx': 'python-docx',
+    'dotenv': 'python-dotenv',
+    'faiss': 'faiss-cpu',
+    'fitz': 'pymupdf',
+    'git': 'gitpython',
+    'github': 'pygithub',
+    'googleapiclient': 'google-api-python-client',
+    'jwt': 'pyjwt',
+    'Levenshtein': 'python-levenshtein',
+    'magic': 'python-magic',
+    'multipart': 'python-multipart',
+    'MySQLdb': 'mysqlclient',
+    'nacl': 'pynacl',
+    'OpenSSL': 'pyopenssl',
+    'PIL': 'pillow',
+    'pptx': 'python-pptx',
+    'psycopg2': 'psycopg2-binary',
+    'serial': 'pyserial',
+    'skimage': 'scikit-image',
+    'sklearn': 'scikit-learn',
+    'slugify': 'python-slugify',
+    'telegram': 'python-telegram-bot',
+    'usb': 'pyusb',
+    'win32api': 'pywin32',
+    'win32con': 'pywin32',
+    'yaml': 'pyyaml',
+    'zmq': 'pyzmq',
+}
+
+# well known packages which import name is the same as the distribution name, used when they are not installed locally
+KNOWN_DISTRIBUTIONS = {
+    'aiohttp', 'boto3', 'chromadb', 'flask', 'httpx', 'jinja2', 'langchain', 'lxml', 'markdown', 'matplotlib', 'nltk',
+    'numpy', 'openai', 'pandas', 'pydantic', 'pypdf', 'PyPDF2', 'requests', 'scipy', 'spacy', 'sqlalchemy',
+    'tenacity', 'tiktoken', 'torch', 'tqdm', 'transformers', 'wikipedia',
+}
+
+# provided by the promptflow runtime which runs the flow, they are never added to the requirements of a flow
+RUNTIME_MODULES = {'promptflow'}
+
+def _scan_stdlib_modules():
+    stdlib_path = sysconfig.get_paths()['stdlib']
+    module_names = set(sys.builtin_module_names)
+    for name in os.listdir(stdlib_path):
+        if name == 'site-packages':
+            continue
+        module_name, ext = os.path.splitext(name)
+        if ext in ('.py', '') and module_name.isidentifier():
+            module_names.add(module_name)
+    return module_names
+
+STDLIB_MODULES = frozenset(getattr(sys, 'stdlib_module_names', None) or _scan_stdlib_modules())
+
+_packages_distributions = None
+
+def _get_packages_distributions():
+    global _packages_distributions
+    if _packages_distributions is None:
+        try:
+            _packages_distributions = metadata.packages_distributions()
+        except Exception:
+            _packages_distributions = {}
+    return _packages_distributions
+
+def find_imported_modules(python_code):
+    """Return the top level names of the absolute imports in python_code."""
+    module_names = set()
+    for node in ast.walk(ast.parse(python_code)):
+        if isinstance(node, ast.Import):
+            for alias in node.names:
+                module_names.add(alias.name.split('.')[0])
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            module_names.add(node.module.split('.')[0])
+    return module_names
+
+def resolve_python_packages(python_code, local_modules=()):
+    """
+    Return the distributions the python code depends on and the imported modules that can not be mapped to a distribution.
+    Return None if the code can not be parsed.
+    """
+    try:
+        module_names = find_imported_modules(python_code)
+    except SyntaxError:
+        return None
+
+    packages = set()
+    unresolved_modules = set()
+    for module_name in module_names:
+        if module_name in STDLIB_MODULES or module_name in RUNTIME_MODULES or module_name in local_modules:
+            continue
+        if module_name in IMPORT_TO_DISTRIBUTION:
+            packages.add(IMPORT_TO_DISTRIBUTION[module_name])
+        elif module_name in _get_packages_distributions():
+            packages.add(_get_packages_distributions()[module_name][0].lower())
+        elif module_name in KNOWN_DISTRIBUTIONS:
+            packages.add(module_name.lower())
+        else:
+            unresolved_modules.add(module_name)
+    return packages, unresolved_modules
@@ -0,0 +1,120 @@
+import json
+import time
+import random
+from rate_limiter import TokenBucket, retry_after_seconds, retryable_errors, is_rate_limit_error
+from logging_util import get_logger
+
+logger = get_logger()
+
+EWMA_ALPHA = 0.3
+# seconds a throttled deployment is skipped if the server does not send a Retry-After delay
+DEFAULT_COOLDOWN_SECONDS = 10
+MAX_ERROR_RATE = 0.95
+
+class Deployment:
+    '''
+    an endpoint serving the model, with the EWMA of its latency and error rate and its tokens per minute quota
+    '''
+    def __init__(self, api_base, api_key, name, tokens_per_minute=0) -> None:
+        self.api_base = api_base
+        self.api_key = api_key
+        self.name = name
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.latency_ewma = None
+        self.error_rate_ewma = 0.0
+        self.in_flight = 0
+        self.unavailable_until = 0
+        self.requests = 0
+        self.failures = 0
+
+    def score(self, estimated_tokens):
+        '''
+        expected seconds until a request completes on this deployment, the lowest score is routed to
+        '''
+        # deployments without any observed latency are tried first
+        latency = self.latency_ewma or 0
+        expected_latency = latency * (1 + self.in_flight) / (1 - min(self.error_rate_ewma, MAX_ERROR_RATE))
+        return expected_latency + self.token_bucket.wait_time(estimated_tokens)
+
+    def record(self, latency_seconds, failed):
+        self.requests += 1
+        self.failures += 1 if failed else 0
+        self.error_rate_ewma = EWMA_ALPHA * (1 if failed else 0) + (1 - EWMA_ALPHA) * self.error_rate_ewma
+        if latency_seconds is not None:
+            self.latency_ewma = latency_seconds if self.latency_ewma is None else EWMA_ALPHA * latency_seconds + (1 - EWMA_ALPHA) * self.latency_ewma
+
+    def __repr__(self) -> str:
+        latency = f'{self.latency_ewma:.2f}s' if self.latency_ewma is not None else 'n/a'
+        return f'{self.name}@{self.api_base} (latency: {latency}, error rate: {self.error_rate_ewma:.2f}, requests: {self.requests})'
+
+def load_deployments(deployments_json, api_key=None, api_base=None, deployment=None):
+    '''
+    load the deployments from a json list of objects with api_base, api_key, deployment and the optional tokens_per_minute,
+    fall back to the single api_key, api_base and deployment if deployments_json is empty. raise ValueError if it is invalid
+    '''
+    if not deployments_json:
+        return [Deployment(api_base, api_key, deployment)] if api_key and api_base and deployment else []
+
+    try:
+        deployment_configs = json.loads(deployments_json)
+    except json.JSONDecodeError as ex:
+        raise ValueError(f'AOAI_DEPLOYMENTS is not a valid json list: {ex}')
+    if not isinstance(deployment_configs, list) or not deployment_configs:
+        raise ValueError('AOAI_DEPLOYMENTS must be a non empty json list')
+
+    deployments = []
+    for index, config in enumerate(deployment_configs):
+        missing_keys = [key for key in ('api_base', 'api_key', 'deployment') if not isinstance(config, dict) or not config.get(key)]
+        if missing_keys:
+            raise ValueError(f'deployment {index} in AOAI_DEPLOYMENTS misses {", ".join(missing_keys)}')
+        deployments.append(Deployment(config['api_base'], config['api_key'], config['deployment'], int(config.get('tokens_per_minute', 0))))
+    return deployments
+
+def is_failover_error(ex):
+    '''
+    throttling, server and connection errors are retried on another deployment, other errors are caused by the request itself
+    '''
+    from openai import error as openai_error
+    if isinstance(ex, retryable_errors()):
+        return True
+    return isinstance(ex, openai_error.APIError) and (ex.http_status or 0) >= 500
+
+class DeploymentRouter:
+    '''
+    route every request to the deployment with the lowest expected latency, based on the EWMA of the observed latency
+    and error rate, the requests in flight and the tokens per minute quota. throttled deployments are skipped until their
+    Retry-After delay has passed.
+    '''
+    def __init__(self, deployments) -> None:
+        self.deployments = deployments
+
+    def choose(self, estimated_tokens=0, exclude=()):
+        '''
+        return the deployment to send the request to, or None if all deployments are excluded
+        '''
+        candidates = [deployment for deployment in self.deployments if deployment not in exclude]
+        if not candidates:
+            return None
+        now = time.monotonic()
+        available = [deployment for deployment in candidates if deployment.unavailable_until <= now]
+        if not available:
+            # every deployment is cooling down, use the one which recovers first
+            return min(candidates, key=lambda deployment: deployment.unavailable_until)
+        # random tie break spreads the requests over deployments with the same score
+        deployment = min(available, key=lambda deployment: (deployment.score(estimated_tokens), random.random()))
+        deployment.token_bucket.consume(estimated_tokens)
+        return deployment
+
+    def record_success(self, deployment, latency_seconds):
+        deployment.record(latency_seconds, failed=False)
+
+    def record_failure(self, deployment, ex):
+        # the latency of a failed request, such as a fast 429, says nothing about the latency of the deployment
+        deployment.record(None, failed=True)
+        if is_rate_limit_error(ex):
+            retry_after = retry_after_seconds(ex)
+            deployment.unavailable_until = time.monotonic() + (retry_after if retry_after is not None else DEFAULT_COOLDOWN_SECONDS)
+        logger.warning(f'request to deployment {deployment.name}@{deployment.api_base} failed: {type(ex).__name__}: {ex}')
+
+    def stats_message(self):
+        return 'deployments: ' + ', '.join(repr(deployment) for deployment in self.deployments)
@@ -0,0 +1,148 @@
+import os
+import re
+import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from logging_util import get_logger
+from snapshot_cache import file_signature
+
+logger = get_logger()
+
+# folders and files which are never sent to the model
+DEFAULT_EXCLUDES = [
+    '.git/', '.hg/', '.svn/', 'venv/', '.venv/', 'env/', 'node_modules/', '__pycache__/', '.mypy_cache/', '.pytest_cache/',
+    '.ruff_cache/', '.tox/', '.nox/', '.idea/', '.vscode/', 'dist/', 'build/', '*.egg-info/', '.promptflow/', '.runs/',
+]
+BINARY_SNIFF_BYTES = 8192
+
+class IgnoreRules:
+    '''
+    a subset of .gitignore semantics: blank lines and comments, negation with '!', directory only patterns with a trailing '/',
+    patterns anchored to the root when they contain a '/', and '*', '?', '[]' and '**' wildcards
+    '''
+    def __init__(self, patterns=()) -> None:
+        self.rules = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    @classmethod
+    def from_folder(cls, folder, extra_patterns=()):
+        rules = cls(extra_patterns)
+        gitignore_path = os.path.join(folder, '.gitignore')
+        if os.path.isfile(gitignore_path):
+            with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+                for line in f:
+                    rules.add(line)
+        return rules
+
+    def add(self, pattern):
+        pattern = pattern.rstrip('\n').rstrip()
+        if not pattern or pattern.startswith('#'):
+            return
+        negated = pattern.startswith('!')
+        if negated:
+            pattern = pattern[1:]
+        directory_only = pattern.endswith('/')
+        pattern = pattern.strip('/') if directory_only else pattern
+        anchored = '/' in pattern.lstrip('/')
+        pattern = pattern.lstrip('/')
+        regex = fnmatch.translate(pattern).replace('.*', '[^/]*').replace('[^/]*[^/]*', '.*')
+        self.rules.append((re.compile(regex), negated, directory_only, anchored))
+
+    def is_ignored(self, relative_path, is_dir):
+        relative_path = relative_path.replace(os.sep, '/')
+        name = relative_path.rsplit('/', 1)[-1]
+        ignored = False
+        for regex, negated, directory_only, anchored in self.rules:
+            if directory_only and not is_dir:
+                continue
+            if regex.match(relative_path if anchored else name):
+                ignored = not negated
+        return ignored
+
+def _read_file(file_path, max_file_bytes):
+    '''
+    return (content, truncated, skip_reason) of a file, binary and non utf-8 files are skipped
+    '''
+    try:
+        with open(file_path, 'rb') as f:
+            data = f.read(max_file_bytes + 1)
+    except OSError as ex:
+        return None, False, f'failed to read: {ex}'
+    if b'\x00' in data[:BINARY_SNIFF_BYTES]:
+        return None, False, 'binary file'
+    truncated = len(data) > max_file_bytes
+    if truncated:
+        data = data[:max_file_bytes]
+    try:
+        content = data.decode('utf-8')
+    except UnicodeDecodeError as ex:
+        # a truncated file may end in the middle of a multi-byte character
+        if not truncated or ex.start < len(data) - 3:
+            return None, False, 'not utf-8 encoded'
+        content = data[:ex.start].decode('utf-8')
+    return content, truncated, None
+
+def _read_file_with_cache(file_path, max_file_bytes, file_cache):
+    if file_cache is None:
+        return _read_file(file_path, max_file_bytes)
+    try:
+        signature = file_signature(file_path)
+    except OSError as ex:
+        return None, False, f'failed to read: {ex}'
+    snapshot = file_cache.get((file_path, max_file_bytes), signature)
+    if snapshot is not None:
+        return snapshot[1]
+    result = _read_file(file_path, max_file_bytes)
+    file_cache.put((file_path, max_file_bytes), signature, result)
+    return result
+
+def list_folder_files(path, included_file_types):
+    '''
+    return (relative path, path) of the files with included_file_types under path, honoring .gitignore and the default excludes
+    '''
+    ignore_rules = IgnoreRules.from_folder(path, DEFAULT_EXCLUDES)
+    file_paths = []
+    for root, dirs, files in os.walk(path):
+        relative_root = os.path.relpath(root, start=path)
+        relative_root = '' if relative_root == '.' else relative_root.replace(os.sep, '/') + '/'
+        dirs[:] = sorted(d for d in dirs if not ignore_rules.is_ignored(relative_root + d, is_dir=True))
+        for file_name in sorted(files):
+            if os.path.splitext(file_name)[1] not in included_file_types:
+                continue
+            if ignore_rules.is_ignored(relative_root + file_name, is_dir=False):
+                continue
+            file_paths.append((relative_root + file_name, os.path.join(root, file_name)))
+    return file_paths
+
+def read_folder(path, included_file_types, max_file_bytes, max_total_bytes, max_total_tokens=None, count_tokens=None, max_workers=8, file_cache=None):
+    '''
+    read the files with included_file_types under path concurrently, honoring .gitignore and the default excludes.
+    unchanged files are served from file_cache (a SnapshotCache) when it is given.
+    return a dict of relative file path and content, and a report of the truncated, omitted and skipped files.
+    '''
+    file_paths = list_folder_files(path, included_file_types)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        read_results = list(executor.map(lambda p: _read_file_with_cache(p[1], max_file_bytes, file_cache), file_paths))
+
+    file_contents_dict = {}
+    report = {'truncated_files': [], 'omitted_files': [], 'skipped_files': []}
+    total_bytes = 0
+    total_tokens = 0
+    for (relative_path, _), (content, truncated, skip_reason) in zip(file_paths, read_results):
+        if skip_reason:
+            report['skipped_files'].append(f'{relative_path}: {skip_reason}')
+            continue
+        content_bytes = len(content.encode('utf-8'))
+        content_tokens = count_tokens(content) if count_tokens and max_total_tokens else 0
+        if total_bytes + content_bytes > max_total_bytes or (max_total_tokens and total_tokens + content_tokens > max_total_tokens):
+            report['omitted_files'].append(relative_path)
+            continue
+        total_bytes += content_bytes
+        total_tokens += content_tokens
+        file_contents_dict[relative_path] = content
+        if truncated:
+            report['truncated_files'].append(relative_path)
+
+    logger.info(f'read {len(file_contents_dict)} files ({total_bytes} bytes) from folder {path}, ' +
+                f'truncated: {len(report["truncated_files"])}, omitted: {len(report["omitted_files"])}, skipped: {len(report["skipped_files"])}')
+    return file_contents_dict, report
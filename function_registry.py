@@ -0,0 +1,37 @@
+import inspect
+
+class FunctionCallResult:
+    '''
+    result of handling a function call, decides what the agent loop does next
+    early_stop: end the user turn without asking the model again
+    next_functions: functions the model is allowed to call in the next step
+    function_call: function_call choice of the next step, 'auto' or {'name': function_name}
+    '''
+    def __init__(self, early_stop=False, next_functions=None, function_call='auto') -> None:
+        self.early_stop = early_stop
+        self.next_functions = next_functions
+        self.function_call = function_call
+
+class FunctionRegistry:
+    '''
+    registry which maps function names to their handlers and the functions allowed to be called after them
+    '''
+    def __init__(self) -> None:
+        self._functions = {}
+
+    def register(self, function, handler, next_functions=None, function_call='auto', early_stop=False):
+        '''
+        register handler for the function schema, handler is called with (function_arguments, print_info_func)
+        and can return a FunctionCallResult to override the registered next step
+        '''
+        self._functions[function['name']] = (handler, FunctionCallResult(early_stop, next_functions, function_call))
+
+    def __contains__(self, function_name):
+        return function_name in self._functions
+
+    async def dispatch(self, function_name, function_arguments, print_info_func):
+        handler, default_result = self._functions[function_name]
+        result = handler(function_arguments, print_info_func)
+        if inspect.isawaitable(result):
+            result = await result
+        return result if result is not None else default_result
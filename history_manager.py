@@ -0,0 +1,148 @@
+from token_utils import TokenCountedMessages
+from logging_util import get_logger
+
+logger = get_logger()
+
+# context window of the known models, matched by the longest prefix of the model or deployment name
+MODEL_CONTEXT_WINDOWS = {
+    'gpt-4-32k': 32768,
+    'gpt-4': 8192,
+    'gpt-35-turbo-16k': 16384,
+    'gpt-3.5-turbo-16k': 16384,
+    'gpt-35-turbo': 4096,
+    'gpt-3.5-turbo': 4096,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+SUMMARY_PREFIX = 'Summary of the earlier conversation which was removed to save tokens:'
+MAX_SUMMARY_LINES = 10
+MAX_SUMMARY_LINE_CHARS = 200
+MAX_SUMMARY_RATIO = 0.2
+
+def context_window_for_model(model_name):
+    matched_prefix = None
+    for prefix in MODEL_CONTEXT_WINDOWS:
+        if model_name and model_name.lower().startswith(prefix) and (matched_prefix is None or len(prefix) > len(matched_prefix)):
+            matched_prefix = prefix
+    return MODEL_CONTEXT_WINDOWS[matched_prefix] if matched_prefix else DEFAULT_CONTEXT_WINDOW
+
+class ConversationHistory(TokenCountedMessages):
+    '''
+    chat history which keeps every request within a token budget.
+    the first system message and the pinned messages (such as the flow description) are never evicted,
+    the oldest turns are evicted first and summarized into a short system message,
+    if the current turn alone is still over budget, its largest messages are truncated.
+    '''
+    def __init__(self, token_counter, context_window=DEFAULT_CONTEXT_WINDOW, token_budget=None, completion_reserve=1024, messages=()):
+        self._pinned_messages = {}
+        self._summary_lines = []
+        super().__init__(token_counter, messages)
+        self.context_window = context_window
+        self.completion_reserve = completion_reserve
+        self.token_budget = token_budget
+        # called with the list of messages evicted or truncated to fit the token limit
+        self.on_evict = None
+
+    @property
+    def token_limit(self):
+        limit = self.context_window - self.completion_reserve
+        return min(limit, self.token_budget) if self.token_budget else limit
+
+    def pin(self, message):
+        self._pinned_messages[id(message)] = message
+
+    def unpin(self, message):
+        self._pinned_messages.pop(id(message), None)
+
+    def _is_pinned(self, index, message):
+        return (index == 0 and message['role'] == 'system') or id(message) in self._pinned_messages or self._is_summary(message)
+
+    @staticmethod
+    def _is_summary(message):
+        return message['role'] == 'system' and message['content'].startswith(SUMMARY_PREFIX)
+
+    def remove_where(self, predicate):
+        '''
+        remove all messages matching predicate in a single pass
+        '''
+        self.delete_indexes([index for index, message in enumerate(self) if predicate(message)])
+
+    def delete_indexes(self, indexes):
+        # a removed message is not pinned any more, its id may be reused by a new message
+        for index in indexes:
+            self.unpin(self[index])
+        super().delete_indexes(indexes)
+
+    def fit(self, function_tokens=0):
+        '''
+        evict, summarize or truncate messages until messages and functions fit into the token limit
+        '''
+        limit = self.token_limit - function_tokens
+        if self.num_tokens <= limit:
+            return
+
+        logger.info(f'chat history has {self.num_tokens} tokens, over the limit {limit}, compact it')
+        while self.num_tokens > limit and self._evict_oldest_messages(limit):
+            pass
+        self._truncate_current_turn(limit)
+
+    def _evict_oldest_messages(self, limit):
+        current_turn_start = max((i for i, message in enumerate(self) if message['role'] == 'user'), default=len(self))
+        over_tokens = self.num_tokens - limit
+        evicted_indexes = []
+        for index, message in enumerate(self):
+            if over_tokens <= 0 or index >= current_turn_start:
+                break
+            if not self._is_pinned(index, message):
+                over_tokens -= self.message_tokens(index)
+                evicted_indexes.append(index)
+
+        evicted_messages = [self[index] for index in evicted_indexes]
+        if evicted_messages:
+            self.delete_indexes(evicted_indexes)
+            self._summarize(evicted_messages, int(limit * MAX_SUMMARY_RATIO))
+            logger.info(f'evicted {len(evicted_messages)} messages from chat history, {self.num_tokens} tokens left')
+            if self.on_evict:
+                self.on_evict(evicted_messages)
+        return len(evicted_messages) > 0
+
+    def _summarize(self, evicted_messages, max_summary_tokens):
+        for message in evicted_messages:
+            if message['role'] in ('user', 'assistant') and message['content']:
+                speaker = 'User' if message['role'] == 'user' else 'PF copilot'
+                content = ' '.join(message['content'].split())
+                if len(content) > MAX_SUMMARY_LINE_CHARS:
+                    content = content[:MAX_SUMMARY_LINE_CHARS] + '...'
+                self._summary_lines.append(f'{speaker}: {content}')
+        self._summary_lines = self._summary_lines[-MAX_SUMMARY_LINES:]
+        summary_message = {'role': 'system', 'content': '\n'.join([SUMMARY_PREFIX] + self._summary_lines)}
+        while self._summary_lines and self.token_counter.count_message(summary_message) > max_summary_tokens:
+            self._summary_lines.pop(0)
+            summary_message = {'role': 'system', 'content': '\n'.join([SUMMARY_PREFIX] + self._summary_lines)}
+        if not self._summary_lines:
+            return
+
+        for index, message in enumerate(self):
+            if self._is_summary(message):
+                self[index] = summary_message
+                return
+        self.insert(1 if self and self[0]['role'] == 'system' else 0, summary_message)
+
+    def _truncate_current_turn(self, limit):
+        current_turn_start = max((i for i, message in enumerate(self) if message['role'] == 'user'), default=len(self))
+        truncated_indexes = set()
+        while self.num_tokens > limit:
+            candidates = [(self.message_tokens(index), index) for index, message in enumerate(self)
+                          if index >= current_turn_start and index not in truncated_indexes and not self._is_pinned(index, message) and message['content']]
+            if not candidates:
+                logger.warning(f'chat history has {self.num_tokens} tokens and can not be compacted under the limit {limit}')
+                return
+            message_tokens, index = max(candidates)
+            message = self[index]
+            keep_ratio = max(0.0, (limit - (self.num_tokens - message_tokens)) / message_tokens - 0.05)
+            content = message['content'][:int(len(message['content']) * keep_ratio)]
+            self[index] = {**message, 'content': content + '\n[truncated to fit the context window]'}
+            truncated_indexes.add(index)
+            if self.on_evict:
+                self.on_evict([message])
+            logger.info(f'truncated message {index} with {message_tokens} tokens to fit the context window')
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import sqlite3
+import asyncio
+import hashlib
+import threading
+from logging_util import get_logger
+
+logger = get_logger()
+
+class LLMCache:
+    '''
+    persistent content-addressed cache for deterministic (temperature 0) chat completion requests.
+    responses are stored as json in a sqlite database, keyed by the hash of the request arguments,
+    which include the rendered messages, functions, function_call and model/deployment.
+    concurrent identical requests are coalesced into a single call.
+    '''
+    def __init__(self, db_path, max_entries=2000, max_age_days=30, enabled=True) -> None:
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 24 * 3600
+        self.enabled = enabled
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _get_connection(self):
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, response TEXT NOT NULL, created_at REAL NOT NULL, last_access REAL NOT NULL)')
+            self._connection.commit()
+        return self._connection
+
+    @staticmethod
+    def make_key(request_args):
+        request_string = json.dumps(request_args, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(request_string.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            connection = self._get_connection()
+            row = connection.execute('SELECT response, created_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            response, created_at = row
+            now = time.time()
+            if now - created_at > self.max_age_seconds:
+                connection.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                connection.commit()
+                return None
+            connection.execute('UPDATE llm_cache SET last_access = ? WHERE key = ?', (now, key))
+            connection.commit()
+            return json.loads(response)
+
+    def put(self, key, response):
+        with self._lock:
+            connection = self._get_connection()
+            now = time.time()
+            connection.execute('INSERT OR REPLACE INTO llm_cache (key, response, created_at, last_access) VALUES (?, ?, ?, ?)', (key, json.dumps(response, ensure_ascii=False), now, now))
+            self._evict(connection, now)
+            connection.commit()
+
+    def _evict(self, connection, now):
+        connection.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.max_age_seconds,))
+        connection.execute('DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def clear(self):
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute('DELETE FROM llm_cache')
+            connection.commit()
+
+    async def get_or_create(self, request_args, create_func):
+        '''
+        return the cached response for request_args, or await create_func() to create it.
+        create_func should return a json serializable response.
+        '''
+        if not self.enabled:
+            return await create_func()
+
+        key = self.make_key(request_args)
+        task = self._in_flight.get(key)
+        if task is None:
+            # the request runs in its own task shared by the identical requests, a cancelled caller stops waiting
+            # for it but does not cancel it for the others
+            task = asyncio.create_task(self._get_or_create(key, create_func))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda task: self._on_request_done(key, task))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _get_or_create(self, key, create_func):
+        # the sqlite queries and commits run in a worker thread, they must not block the event loop
+        response = await asyncio.to_thread(self.get, key)
+        if response is not None:
+            self.hits += 1
+            return response
+
+        self.misses += 1
+        response = await create_func()
+        await asyncio.to_thread(self.put, key, response)
+        return response
+
+    def _on_request_done(self, key, task):
+        del self._in_flight[key]
+        if not task.cancelled():
+            # mark the exception as retrieved in case every caller was cancelled
+            task.exception()
+
+    def stats_message(self):
+        return f'llm cache hits: {self.hits}, misses: {self.misses}, coalesced: {self.coalesced}'
@@ -0,0 +1,192 @@
+import time
+import asyncio
+from deployment_router import DeploymentRouter, is_failover_error
+from rate_limiter import PrioritySemaphore, PRIORITY_BACKGROUND
+from logging_util import get_logger
+
+logger = get_logger()
+
+AOAI_API_VERSION = "2023-07-01-preview"
+OPENAI_API_BASE = "https://api.openai.com/v1"
+
+class StreamingResponse:
+    '''
+    async iterator over the chunks of a streaming response, on_close(error) is called exactly once when the stream
+    is exhausted, fails or is closed, even if it was never iterated. error is None unless the stream failed.
+    use it with async with, or call aclose(), so that the stream is closed when the consumer fails mid-stream
+    '''
+    def __init__(self, response, on_close) -> None:
+        self._response = response
+        self._on_close = on_close
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._on_close is None:
+            raise StopAsyncIteration
+        try:
+            return await self._response.__anext__()
+        except StopAsyncIteration:
+            await self._close(None)
+            raise
+        except BaseException as ex:
+            await self._close(ex)
+            raise
+
+    async def _close(self, error):
+        if self._on_close is not None:
+            on_close, self._on_close = self._on_close, None
+            try:
+                if hasattr(self._response, 'aclose'):
+                    await self._response.aclose()
+            finally:
+                on_close(error)
+
+    async def aclose(self):
+        await self._close(None)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        # a consumer failing mid-stream must still release the concurrency slot of the stream
+        await self._close(None)
+
+class LLMClient:
+    '''
+    chat completion client with its own credentials and a pooled keep-alive http session, instead of the openai module globals.
+    every request is routed to one of the deployments by the DeploymentRouter and fails over to the next best deployment
+    on throttling, server and connection errors. a streaming request stays on its deployment for its whole duration.
+    at most max_concurrency requests are in flight at a time, a streaming request stays in flight until its stream is consumed.
+    the free slots go to the waiting requests by priority, see PrioritySemaphore.
+    the api_base of a deployment can point to any openai compatible server, such as a local stand-in server.
+    '''
+    def __init__(self, deployments, use_aoai=False, api_version=AOAI_API_VERSION,
+                 max_concurrency=8, max_connections=16, keepalive_timeout=30, connect_timeout=10, request_timeout=600) -> None:
+        self.router = DeploymentRouter(deployments)
+        self.use_aoai = use_aoai
+        self.api_type = "azure" if use_aoai else "open_ai"
+        self.api_version = api_version if use_aoai else None
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.request_timeout = (connect_timeout, request_timeout)
+        # the main streaming call can trigger helper calls before its stream is consumed, so at least 2 requests must be allowed
+        self.max_concurrency = max(2, max_concurrency)
+        self._semaphore = PrioritySemaphore(self.max_concurrency)
+        self._session = None
+        self.in_flight = 0
+
+    def _deployment_model_args(self, deployment):
+        return {'engine': deployment.name} if self.use_aoai else {'model': deployment.name}
+
+    def model_args(self):
+        '''
+        the engine or model arguments of a chat completion request, all deployments are expected to serve the same model
+        '''
+        return self._deployment_model_args(self.router.deployments[0]) if self.router.deployments else {}
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            import aiohttp
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    async def _create(self, deployment, request_args_dict):
+        import openai
+        session_token = openai.aiosession.set(self._get_session())
+        try:
+            return await openai.ChatCompletion.acreate(
+                **{**request_args_dict, **self._deployment_model_args(deployment)},
+                api_key=deployment.api_key,
+                api_base=deployment.api_base,
+                api_type=self.api_type,
+                api_version=self.api_version,
+                request_timeout=self.request_timeout)
+        finally:
+            openai.aiosession.reset(session_token)
+
+    async def chat_completion(self, request_args_dict, estimated_tokens=0, priority=PRIORITY_BACKGROUND):
+        '''
+        create a chat completion with the pooled session on the best deployment, request_args_dict contains the model arguments from model_args()
+        '''
+        wait_seconds = await self._semaphore.acquire(priority)
+        if wait_seconds > 0.1:
+            logger.info(f'llm request waited {wait_seconds:.2f}s for a concurrency slot')
+        self.in_flight += 1
+        released = False
+        try:
+            failed_deployments = []
+            while True:
+                deployment = self.router.choose(estimated_tokens, exclude=failed_deployments)
+                if deployment is None:
+                    if failed_deployments:
+                        raise last_error
+                    raise ValueError('no llm deployment is configured')
+
+                start_time = time.perf_counter()
+                deployment.in_flight += 1
+                try:
+                    response = await self._create(deployment, request_args_dict)
+                except Exception as ex:
+                    deployment.in_flight -= 1
+                    if not is_failover_error(ex):
+                        raise
+                    self.router.record_failure(deployment, ex)
+                    failed_deployments.append(deployment)
+                    last_error = ex
+                    continue
+                latency_seconds = time.perf_counter() - start_time
+
+                if request_args_dict.get('stream'):
+                    released = True
+                    return StreamingResponse(response, lambda error, deployment=deployment: self._on_stream_closed(deployment, latency_seconds, error))
+                deployment.in_flight -= 1
+                self.router.record_success(deployment, latency_seconds)
+                return response
+        finally:
+            if not released:
+                self._release()
+
+    def _on_stream_closed(self, deployment, latency_seconds, error):
+        # the latency of a streaming request is the time until the response headers arrived
+        deployment.in_flight -= 1
+        if isinstance(error, Exception):
+            self.router.record_failure(deployment, error)
+        else:
+            self.router.record_success(deployment, latency_seconds)
+        self._release()
+
+    def _release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def concurrency_metrics(self):
+        return self._semaphore.metrics()
+
+    def stats_message(self):
+        return self._semaphore.stats_message()
+
+    async def warmup(self, timeout=10):
+        '''
+        import openai off the event loop and open a keep-alive connection to every deployment, so that the first request
+        does not pay for the import, the dns lookup and the tls handshake
+        '''
+        await asyncio.to_thread(__import__, 'openai')
+        session = self._get_session()
+
+        async def connect(deployment):
+            import aiohttp
+            try:
+                async with session.get(deployment.api_base, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    await response.read()
+            except Exception as ex:
+                logger.info(f'failed to warm up the connection to {deployment.api_base}: {ex}')
+
+        await asyncio.gather(*[connect(deployment) for deployment in self.router.deployments])
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,219 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from llm_client import LLMClient
+from llm_cache import LLMCache
+from deployment_router import Deployment
+from logging_util import get_logger
+
+logger = get_logger()
+
+REPLAY_API_BASE = 'replay://local'
+REPLAY_DEPLOYMENT = 'replay'
+MODEL_ARG_NAMES = ('engine', 'model', 'deployment_id')
+
+def recording_key(request_args):
+    '''
+    the key a request is matched by, the model and deployment are left out so that a recording can be replayed on any deployment
+    '''
+    return LLMCache.make_key({key: value for key, value in request_args.items() if key not in MODEL_ARG_NAMES})
+
+class LLMReplayMiss(LookupError):
+    pass
+
+class LLMRecorder:
+    '''
+    appends the recorded requests and responses to a jsonl file, one line per request:
+    {"key", "request", "latency", "response"} for a normal request, or {"key", "request", "latency", "chunks"} for a
+    streaming request, where chunks is a list of [seconds since the previous chunk, chunk]. latency is the time until
+    the response, or for a streaming request until the first chunk could be read
+    '''
+    def __init__(self, path) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _write(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with self._lock:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line)
+
+    async def write(self, request_args, latency, response=None, chunks=None):
+        request = {key: value for key, value in request_args.items() if key not in MODEL_ARG_NAMES}
+        record = {'key': recording_key(request), 'request': request, 'latency': round(latency, 4)}
+        if chunks is None:
+            record['response'] = response
+        else:
+            record['chunks'] = chunks
+        await asyncio.to_thread(self._write, record)
+
+class LLMReplayer:
+    '''
+    serves the records of a recording. a request gets the next record recorded for the same request, the last one is
+    served again to repeated requests. a request which was never recorded gets the next unused record of the same kind
+    in recording order, so that a session whose prompts changed slightly still replays.
+    with sequential the records are served in order regardless of the requests and start over when they are used up,
+    for synthetic records which were not recorded from real requests. delays are multiplied by time_scale, 0 replays without any delay
+    '''
+    def __init__(self, records, time_scale=1.0, sequential=False) -> None:
+        self.records = records
+        self.time_scale = time_scale
+        self.sequential = sequential
+        self.hits = 0
+        self.misses = 0
+        self._records_by_key = {}
+        self._used = set()
+        self._next_sequential_index = {}
+        for index, record in enumerate(records):
+            self._records_by_key.setdefault(record['key'], deque()).append(index)
+
+    @classmethod
+    def load(cls, path, time_scale=1.0):
+        with open(path, 'r', encoding='utf-8') as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        logger.info(f'loaded {len(records)} llm records from {path}')
+        return cls(records, time_scale)
+
+    def next_record(self, request_args):
+        if self.sequential:
+            return self._next_sequential_record(bool(request_args.get('stream')))
+        indexes = self._records_by_key.get(recording_key(request_args))
+        if indexes:
+            index = indexes.popleft() if len(indexes) > 1 else indexes[0]
+            self.hits += 1
+        else:
+            stream = bool(request_args.get('stream'))
+            index = next((index for index, record in enumerate(self.records)
+                          if index not in self._used and bool(record['request'].get('stream')) == stream), None)
+            if index is None:
+                raise LLMReplayMiss(f'no recorded response is left for the request: {json.dumps(request_args, ensure_ascii=False)[:200]}')
+            logger.warning(f'the request was not recorded, replaying record {index} instead')
+            self.misses += 1
+        self._used.add(index)
+        return self.records[index]
+
+    def _next_sequential_record(self, stream):
+        start_index = self._next_sequential_index.get(stream, 0)
+        for offset in range(len(self.records)):
+            index = (start_index + offset) % len(self.records)
+            if bool(self.records[index]['request'].get('stream')) == stream:
+                self._next_sequential_index[stream] = index + 1
+                self.hits += 1
+                return self.records[index]
+        raise LLMReplayMiss(f'no {"streaming" if stream else "normal"} response is recorded')
+
+    async def sleep(self, seconds):
+        if self.time_scale > 0 and seconds > 0:
+            await asyncio.sleep(seconds * self.time_scale)
+
+    async def replay_chunks(self, record):
+        for delay, chunk in record['chunks']:
+            await self.sleep(delay)
+            yield chunk
+
+class RecordingLLMClient(LLMClient):
+    '''
+    llm client which records every request and its response, including the chunks of streaming responses with their timing
+    '''
+    def __init__(self, deployments, recording_path, **kwargs) -> None:
+        super().__init__(deployments, **kwargs)
+        self.recorder = LLMRecorder(recording_path)
+
+    async def _create(self, deployment, request_args_dict):
+        start_time = time.perf_counter()
+        response = await super()._create(deployment, request_args_dict)
+        latency = time.perf_counter() - start_time
+        if not request_args_dict.get('stream'):
+            await self.recorder.write(request_args_dict, latency, response=response.to_dict_recursive())
+            return response
+        return self._record_stream(request_args_dict, latency, response)
+
+    async def _record_stream(self, request_args_dict, latency, response):
+        chunks = []
+        last_time = time.perf_counter()
+        async for chunk in response:
+            now = time.perf_counter()
+            chunks.append([round(now - last_time, 4), chunk.to_dict_recursive()])
+            last_time = now
+            yield chunk
+        # streams which were not consumed to the end are not recorded, they can not be replayed faithfully
+        await self.recorder.write(request_args_dict, latency, chunks=chunks)
+
+class ReplayLLMClient(LLMClient):
+    '''
+    llm client which replays a recording instead of calling an endpoint, with the concurrency limits of LLMClient
+    '''
+    def __init__(self, replayer, use_aoai=False, **kwargs) -> None:
+        super().__init__([Deployment(REPLAY_API_BASE, None, REPLAY_DEPLOYMENT)], use_aoai=use_aoai, **kwargs)
+        self.replayer = replayer
+
+    async def _create(self, deployment, request_args_dict):
+        from openai.openai_object import OpenAIObject
+        record = self.replayer.next_record(request_args_dict)
+        await self.replayer.sleep(record['latency'])
+        if not request_args_dict.get('stream'):
+            return OpenAIObject.construct_from(record['response'], response_ms=int(record['latency'] * 1000))
+        return self._replay_stream(record)
+
+    async def _replay_stream(self, record):
+        from openai.openai_object import OpenAIObject
+        async for chunk in self.replayer.replay_chunks(record):
+            yield OpenAIObject.construct_from(chunk)
+
+    async def warmup(self, timeout=10):
+        await asyncio.to_thread(__import__, 'openai')
+
+    async def close(self):
+        pass
+
+def create_app(replayer):
+    '''
+    openai compatible http stand-in server replaying the records, point OPENAI_API_BASE to http://<host>:<port>/v1
+    or AOAI_API_BASE to http://<host>:<port>/ to use it. a request without a record left gets a 404
+    '''
+    from aiohttp import web
+
+    async def handle_chat_completions(request):
+        request_args = await request.json()
+        try:
+            record = replayer.next_record(request_args)
+        except LLMReplayMiss as ex:
+            return web.json_response({'error': {'message': str(ex), 'type': 'invalid_request_error'}}, status=404)
+        await replayer.sleep(record['latency'])
+        if not request_args.get('stream'):
+            return web.json_response(record['response'])
+
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        async for chunk in replayer.replay_chunks(record):
+            await response.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+    async def handle_probe(request):
+        # the llm client warms up its connections with a GET of the api base
+        return web.Response(text='ok')
+
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    for path in ('/chat/completions', '/v1/chat/completions', '/openai/deployments/{deployment}/chat/completions'):
+        app.router.add_post(path, handle_chat_completions)
+    app.router.add_get('/{path:.*}', handle_probe)
+    return app
+
+def main():
+    from aiohttp import web
+    if len(sys.argv) < 2:
+        print('usage: python llm_replay.py <recording.jsonl> [port] [time scale]')
+        return
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+    time_scale = float(sys.argv[3]) if len(sys.argv) > 3 else 1.0
+    web.run_app(create_app(LLMReplayer.load(sys.argv[1], time_scale)), host='127.0.0.1', port=port)
+
+if __name__ == '__main__':
+    main()
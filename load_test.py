@@ -0,0 +1,472 @@
+'''
+load test of many concurrent copilot sessions in one process, against a local openai compatible mock server with
+synthetic responses. it reports the throughput, the turn latency, the time to first token, the event loop lag and the memory per session.
+
+    python load_test.py --sessions 50                          50 sessions running the scripts round robin
+    python load_test.py --scripts new_flow,read_flow           run only some of the scripts
+    python load_test.py --latency 0.5 --tokens-per-second 50   seconds to the first token and token rate of the mock server
+    python load_test.py --repeat 3 --think-time 1              run each script 3 times per session, 1 second between turns
+    python load_test.py --ramp-up 10                           start the sessions evenly over 10 seconds
+    python load_test.py --mock-url http://127.0.0.1:8000/v1    use a running mock server instead of starting one
+    python load_test.py --output report.json                   save the report as json
+
+the time to first token is the time until a turn prints its first output, as the user sees it. the sessions share one
+llm client like the sessions of server.py, so the limits of pfcopilot.env apply, such as LLM_MAX_CONCURRENCY. the mock server alone is started with
+python load_test.py --mock-server --port 8000 --latency 0.5 --tokens-per-second 50
+'''
+import os
+import re
+import sys
+import json
+import math
+import argparse
+import time
+import socket
+import asyncio
+import tempfile
+import itertools
+from collections import defaultdict
+
+from logging_util import get_logger
+
+logger = get_logger()
+
+FLOW_YAML = '''inputs:
+  text:
+    type: string
+outputs:
+  summary:
+    type: string
+    reference: ${summarize.output}
+nodes:
+- name: clean_text
+  type: python
+  source:
+    type: code
+    path: clean_text.py
+  inputs:
+    text: ${inputs.text}
+- name: summarize
+  type: llm
+  source:
+    type: code
+    path: summarize.jinja2
+  inputs:
+    deployment_name: gpt-35-turbo
+    text: ${clean_text.output}
+  connection: open_ai_connection
+  api: chat
+'''
+
+PYTHON_CODE = '''import re
+from promptflow import tool
+
+
+@tool
+def clean_text(text: str) -> str:
+    return re.sub(r"\\s+", " ", text).strip()
+'''
+
+PROMPT = '''system:
+Summarize the text in one sentence.
+
+user:
+{{text}}
+'''
+
+LINE_PROCESS_CODE = '''from promptflow import tool
+
+
+@tool
+def line_process(groundtruth: str, prediction: str):
+    return "Correct" if groundtruth.lower() == prediction.lower() else "Incorrect"
+'''
+
+AGGREGATE_CODE = '''from typing import List
+from promptflow import tool, log_metric
+
+
+@tool
+def aggregate(processed_results: List[str]):
+    accuracy = round(processed_results.count("Correct") / len(processed_results), 2)
+    log_metric("accuracy", accuracy)
+    return accuracy
+'''
+
+# the user turns of each script, {flow_folder} is replaced by the folder of a flow prepared for the session
+SCRIPTS = {
+    'new_flow': ['create a flow that cleans the input text and summarizes it with llm'],
+    'read_flow': ['read the flow in folder {flow_folder}'],
+    'sample_inputs': ['read the flow in folder {flow_folder}', 'generate 40 sample inputs for the flow'],
+    'evaluation_flow': ['read the flow in folder {flow_folder}', 'generate evaluation flow with 20 evaluation data'],
+}
+
+CHARS_PER_TOKEN = 4
+
+class SyntheticResponder:
+    '''
+    answers chat completion requests like the model would answer the scripts, with latency seconds to the first token
+    and then tokens_per_second. it has the interface of LLMReplayer so that llm_replay.create_app can serve it
+    '''
+    def __init__(self, latency=0.5, tokens_per_second=50) -> None:
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.requests = 0
+        self._ids = itertools.count()
+
+    def next_record(self, request_args):
+        self.requests += 1
+        messages = request_args.get('messages') or []
+        forced_function = request_args.get('function_call', {}).get('name') if isinstance(request_args.get('function_call'), dict) else None
+        if forced_function:
+            function_name, arguments = forced_function, self._function_arguments(forced_function, messages)
+        elif request_args.get('functions'):
+            function_name, arguments = self._choose_function(messages, [function['name'] for function in request_args['functions']])
+        else:
+            function_name, arguments = None, None
+
+        if function_name:
+            return self._record(request_args, function_name=function_name, arguments=json.dumps(arguments))
+        return self._record(request_args, content=self._text_answer(messages) if not request_args.get('functions') else 'Done, what else can I do for you?')
+
+    def _choose_function(self, messages, function_names):
+        # after a function result the model answers in text, otherwise it calls the function the user asks for
+        last_message = next((message for message in reversed(messages) if message['role'] != 'system'), None)
+        if last_message is None or last_message['role'] != 'user':
+            return None, None
+        user_input = last_message['content'].lower()
+        for keyword, function_name in (('evaluation flow', 'dump_evaluation_flow'), ('sample inputs', 'dump_sample_inputs'),
+                                       ('read the flow', 'read_flow_from_local_folder'), ('create a flow', 'dump_flow')):
+            if keyword in user_input and function_name in function_names:
+                return function_name, self._function_arguments(function_name, messages)
+        return None, None
+
+    def _function_arguments(self, function_name, messages):
+        user_input = next((message['content'] for message in reversed(messages) if message['role'] == 'user'), '')
+        numbers = re.findall(r'\b(\d+)\b', user_input)
+        total_count = int(numbers[0]) if numbers else 5
+        if function_name == 'dump_flow':
+            return {'flow_yaml': FLOW_YAML, 'explaination': 'the flow cleans the input text and summarizes it with llm',
+                    'python_functions': [{'name': 'clean_text', 'content': PYTHON_CODE}], 'prompts': [{'name': 'summarize', 'content': PROMPT}],
+                    'reasoning': 'the user asks to create a flow'}
+        if function_name == 'read_flow_from_local_folder':
+            match = re.search(r'folder (\S+)', user_input)
+            return {'path': match.group(1) if match else '', 'reasoning': 'the user asks to read the flow'}
+        if function_name == 'dump_flow_definition_and_description':
+            return {'flow_yaml': FLOW_YAML, 'description': 'the flow cleans the input text and summarizes it with llm', 'reasoning': 'understand the flow'}
+        if function_name == 'dump_sample_inputs':
+            return {'file_name': 'samples.jsonl', 'total_count': total_count, 'extra_requirements': '', 'reasoning': 'the user asks for sample inputs'}
+        if function_name == 'dump_evaluation_flow':
+            return {'evaluation_flow_folder': '', 'target_output': '', 'total_count': total_count, 'reasoning': 'the user asks for an evaluation flow'}
+        if function_name == 'generate_sample_inputs':
+            return {'sample_inputs': [json.dumps({'text': f'sample text {next(self._ids)} about the weather'}) for _ in range(total_count)]}
+        if function_name == 'dump_evaluation_input':
+            return {'evaluation_inputs': [json.dumps({'text': f'evaluation text {next(self._ids)}', 'groundtruth': 'a summary'}) for _ in range(total_count)]}
+        if function_name == 'dump_evaluation_functions':
+            return {'line_process': LINE_PROCESS_CODE, 'aggregate': AGGREGATE_CODE}
+        return {}
+
+    def _text_answer(self, messages):
+        system_message = messages[0]['content'] if messages and messages[0]['role'] == 'system' else ''
+        user_input = next((message['content'] for message in reversed(messages) if message['role'] == 'user'), '')
+        if 'into a valid folder name' in system_message:
+            # unique names, the flows of the sessions must not share a folder
+            return f'load_test_flow_{next(self._ids)}'
+        if 'find the public python packages' in system_message:
+            return 'None'
+        # rewrite_user_input and refine_python_code keep the user input
+        return user_input
+
+    def _record(self, request_args, content=None, function_name=None, arguments=None):
+        text = content if function_name is None else arguments
+        completion_tokens = max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+        usage = {'prompt_tokens': sum(len(message.get('content') or '') for message in request_args.get('messages') or []) // CHARS_PER_TOKEN,
+                 'completion_tokens': completion_tokens}
+        usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+        finish_reason = 'function_call' if function_name else 'stop'
+
+        if not request_args.get('stream'):
+            message = {'role': 'assistant', 'content': content}
+            if function_name:
+                message['function_call'] = {'name': function_name, 'arguments': arguments}
+            return {'latency': self.latency + completion_tokens / self.tokens_per_second, 'response': {
+                'id': 'chatcmpl-load-test', 'object': 'chat.completion', 'created': int(time.time()), 'model': 'load-test',
+                'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}], 'usage': usage}}
+
+        def chunk(delta, finish=None):
+            return {'id': 'chatcmpl-load-test', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': 'load-test',
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}]}
+
+        token_delay = 1 / self.tokens_per_second
+        pieces = [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+        if function_name:
+            chunks = [[0, chunk({'role': 'assistant', 'content': None, 'function_call': {'name': function_name, 'arguments': ''}})]]
+            chunks.extend([token_delay, chunk({'function_call': {'arguments': piece}})] for piece in pieces)
+        else:
+            chunks = [[0, chunk({'role': 'assistant', 'content': ''})]]
+            chunks.extend([token_delay, chunk({'content': piece})] for piece in pieces)
+        chunks.append([0, chunk({}, finish_reason)])
+        return {'latency': self.latency, 'chunks': chunks}
+
+    async def sleep(self, seconds):
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    async def replay_chunks(self, record):
+        for delay, chunk in record['chunks']:
+            await self.sleep(delay)
+            yield chunk
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+def distribution(values):
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99),
+            'max': max(values) if values else None, 'count': len(values)}
+
+def prepare_flow_folder(folder):
+    os.makedirs(folder, exist_ok=True)
+    for file_name, content in (('flow.dag.yaml', FLOW_YAML), ('clean_text.py', PYTHON_CODE), ('summarize.jinja2', PROMPT)):
+        with open(os.path.join(folder, file_name), 'w') as f:
+            f.write(content)
+
+class LoadTest:
+    '''
+    runs the sessions against the mock server and collects the measurements
+    '''
+    def __init__(self, session_count, script_names, repeat=1, think_time=0, ramp_up=0) -> None:
+        self.session_count = session_count
+        self.script_names = script_names
+        self.repeat = repeat
+        self.think_time = think_time
+        self.ramp_up = ramp_up
+        self.turns = []
+        self.failures = []
+        self.event_loop_lags = []
+        self.peak_memory_mb = None
+
+    async def _monitor(self, stop_event, interval=0.05):
+        from server import current_memory_mb
+        last_memory_sample = 0
+        while not stop_event.is_set():
+            start_time = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.event_loop_lags.append(max(0, time.perf_counter() - start_time - interval))
+            if start_time - last_memory_sample > 0.5:
+                last_memory_sample = start_time
+                memory_mb = current_memory_mb()
+                if memory_mb is not None:
+                    self.peak_memory_mb = max(self.peak_memory_mb or 0, memory_mb)
+
+    async def _run_session(self, session_index, shared_context, work_folder):
+        from CopilotContext import CopilotContext
+        await asyncio.sleep(self.ramp_up * session_index / max(1, self.session_count))
+        script_name = self.script_names[session_index % len(self.script_names)]
+        copilot_context = CopilotContext(
+            llm_client=shared_context.llm_client,
+            rate_limit_scheduler=shared_context.rate_limit_scheduler,
+            llm_cache=shared_context.llm_cache)
+        flow_folder = os.path.join(work_folder, f'session_{session_index}', 'flow')
+        prepare_flow_folder(flow_folder)
+
+        for iteration in range(self.repeat):
+            if iteration > 0:
+                copilot_context.reset()
+            for turn_index, user_input in enumerate(SCRIPTS[script_name]):
+                if self.think_time and (iteration > 0 or turn_index > 0):
+                    await asyncio.sleep(self.think_time)
+                start_time = time.perf_counter()
+                first_token_time = None
+
+                def print_info(message):
+                    nonlocal first_token_time
+                    if first_token_time is None and message:
+                        first_token_time = time.perf_counter()
+
+                try:
+                    await copilot_context.ask_gpt_async(user_input.format(flow_folder=flow_folder), print_info)
+                except Exception as ex:
+                    logger.exception(f'load test session {session_index} failed in turn {turn_index} of {script_name}')
+                    self.failures.append({'session': session_index, 'script': script_name, 'turn': turn_index, 'error': repr(ex)})
+                    return
+                end_time = time.perf_counter()
+                self.turns.append({
+                    'session': session_index,
+                    'script': script_name,
+                    'turn': turn_index,
+                    'latency': end_time - start_time,
+                    'time_to_first_token': first_token_time - start_time if first_token_time else None})
+
+    async def run(self, mock_url):
+        from CopilotContext import CopilotContext
+        from server import current_memory_mb
+        os.environ.update({
+            'AOAI_BY_DEFAULT': 'false',
+            'OPENAI_API_KEY': 'load-test',
+            'OPENAI_MODEL': 'gpt-4',
+            'OPENAI_API_BASE': mock_url,
+            'LLM_BACKEND': 'live',
+        })
+        os.environ.setdefault('LLM_CACHE_ENABLED', 'false')
+        work_folder = tempfile.mkdtemp(prefix='pfcopilot-load-test-')
+        # the flows created by the sessions are dumped to the current folder
+        original_folder = os.getcwd()
+        os.chdir(work_folder)
+        shared_context = CopilotContext()
+        stop_event = asyncio.Event()
+        try:
+            await shared_context.warmup()
+            baseline_memory_mb = current_memory_mb()
+            monitor_task = asyncio.create_task(self._monitor(stop_event))
+            start_time = time.perf_counter()
+            await asyncio.gather(*[self._run_session(index, shared_context, work_folder) for index in range(self.session_count)])
+            wall_time = time.perf_counter() - start_time
+            stop_event.set()
+            await monitor_task
+            llm_requests = sum(deployment.requests for deployment in shared_context.llm_client.router.deployments)
+        finally:
+            os.chdir(original_folder)
+            await shared_context.close()
+        return self.report(wall_time, baseline_memory_mb, llm_requests, work_folder)
+
+    def report(self, wall_time, baseline_memory_mb, llm_requests, work_folder):
+        latencies = [turn['latency'] for turn in self.turns]
+        time_to_first_tokens = [turn['time_to_first_token'] for turn in self.turns if turn['time_to_first_token'] is not None]
+        scripts = {}
+        turns_by_script = defaultdict(list)
+        for turn in self.turns:
+            turns_by_script[turn['script']].append(turn['latency'])
+        for script_name, script_latencies in turns_by_script.items():
+            scripts[script_name] = distribution(script_latencies)
+
+        memory_per_session_mb = None
+        if baseline_memory_mb is not None and self.peak_memory_mb is not None:
+            memory_per_session_mb = max(0, self.peak_memory_mb - baseline_memory_mb) / max(1, self.session_count)
+        return {
+            'sessions': self.session_count,
+            'scripts': self.script_names,
+            'repeat': self.repeat,
+            'llm_max_concurrency': os.environ.get('LLM_MAX_CONCURRENCY', '8'),
+            'wall_time': wall_time,
+            'completed_turns': len(self.turns),
+            'failed_sessions': len(self.failures),
+            'failures': self.failures,
+            'llm_requests': llm_requests,
+            'turns_per_second': len(self.turns) / wall_time if wall_time else None,
+            'llm_requests_per_second': llm_requests / wall_time if wall_time else None,
+            'turn_latency': distribution(latencies),
+            'turn_latency_by_script': scripts,
+            'time_to_first_token': distribution(time_to_first_tokens),
+            'event_loop_lag': distribution(self.event_loop_lags),
+            'baseline_memory_mb': baseline_memory_mb,
+            'peak_memory_mb': self.peak_memory_mb,
+            'memory_per_session_mb': memory_per_session_mb,
+            'work_folder': work_folder,
+        }
+
+def format_seconds(value):
+    return 'n/a' if value is None else f'{value * 1000:.0f} ms'
+
+def format_distribution(name, values):
+    return f'{name}: p50 {format_seconds(values["p50"])}, p95 {format_seconds(values["p95"])}, p99 {format_seconds(values["p99"])}, max {format_seconds(values["max"])}'
+
+def print_report(report):
+    print(f'{report["sessions"]} sessions ({", ".join(report["scripts"])}) x {report["repeat"]}, llm max concurrency {report["llm_max_concurrency"]}')
+    print(f'{report["completed_turns"]} turns completed in {report["wall_time"]:.1f}s, {report["failed_sessions"]} sessions failed')
+    print(f'throughput: {report["turns_per_second"]:.2f} turns/s, {report["llm_requests_per_second"]:.2f} llm requests/s ({report["llm_requests"]} requests)')
+    print(format_distribution('turn latency', report['turn_latency']))
+    for script_name, values in report['turn_latency_by_script'].items():
+        print('  ' + format_distribution(script_name, values))
+    print(format_distribution('time to first token', report['time_to_first_token']))
+    print(format_distribution('event loop lag', report['event_loop_lag']))
+    if report['memory_per_session_mb'] is not None:
+        print(f'rss: {report["baseline_memory_mb"]:.0f} MB before the sessions, {report["peak_memory_mb"]:.0f} MB peak, {report["memory_per_session_mb"]:.2f} MB per session')
+    for failure in report['failures'][:10]:
+        print(f'  session {failure["session"]} {failure["script"]} turn {failure["turn"]}: {failure["error"]}')
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+async def start_mock_server(latency, tokens_per_second):
+    '''
+    start the mock server in a child process so that it does not share the event loop and the memory with the sessions
+    '''
+    import aiohttp
+    port = free_port()
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.abspath(__file__), '--mock-server', '--port', str(port),
+        '--latency', str(latency), '--tokens-per-second', str(tokens_per_second),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}/v1'
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(url) as response:
+                    if response.status == 200:
+                        return process, url
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    process.kill()
+    raise RuntimeError('the mock server did not start')
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=10, help='number of concurrent sessions')
+    parser.add_argument('--scripts', type=script_names_arg, default=list(SCRIPTS), help=f'comma separated scripts to run, of {",".join(SCRIPTS)}')
+    parser.add_argument('--repeat', type=int, default=1, help='number of times each session runs its script')
+    parser.add_argument('--think-time', type=float, default=0, help='seconds between the turns of a session')
+    parser.add_argument('--ramp-up', type=float, default=0, help='seconds over which the sessions are started')
+    parser.add_argument('--latency', type=float, default=0.5, help='seconds to the first token of the mock server')
+    parser.add_argument('--tokens-per-second', type=float, default=50, help='token rate of the mock server')
+    parser.add_argument('--mock-url', help='use a running mock server instead of starting one')
+    parser.add_argument('--output', help='save the report as json')
+    parser.add_argument('--mock-server', action='store_true', help='only run the mock server')
+    parser.add_argument('--port', type=int, default=8000, help='port of the mock server started with --mock-server')
+    return parser.parse_args(argv)
+
+def script_names_arg(value):
+    script_names = value.split(',')
+    unknown_scripts = [name for name in script_names if name not in SCRIPTS]
+    if unknown_scripts:
+        raise argparse.ArgumentTypeError(f'unknown scripts: {", ".join(unknown_scripts)}, the scripts are {", ".join(SCRIPTS)}')
+    return script_names
+
+async def main_async(args):
+    mock_url = args.mock_url
+    process = None
+    if not mock_url:
+        process, mock_url = await start_mock_server(args.latency, args.tokens_per_second)
+    try:
+        load_test = LoadTest(args.sessions, args.scripts, args.repeat, args.think_time, args.ramp_up)
+        report = await load_test.run(mock_url)
+    finally:
+        if process:
+            process.terminate()
+            await process.wait()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'saved the report to {args.output}')
+    return 1 if report['failed_sessions'] else 0
+
+def main(argv):
+    args = parse_args(argv)
+    if args.mock_server:
+        from aiohttp import web
+        from llm_replay import create_app
+
+        responder = SyntheticResponder(args.latency, args.tokens_per_second)
+        web.run_app(create_app(responder), host='127.0.0.1', port=args.port)
+        return 0
+    return asyncio.run(main_async(args))
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
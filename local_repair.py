@@ -0,0 +1,181 @@
+import re
+import json
+import yaml
+
+CODE_FENCE_PATTERN = re.compile(r'^\s*```[\w-]*\s*\n(.*?)\n\s*```\s*$', re.DOTALL)
+YAML_KEY_VALUE_PATTERN = re.compile(r'^(\s*(?:-\s+)?[\w.\-]+:\s+)(.+)$')
+PYTHON_LITERALS = {'True': 'true', 'False': 'false', 'None': 'null'}
+JSON_ESCAPE_PATTERN = re.compile(r'\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})')
+YAML_DOUBLE_QUOTED_PATTERN = re.compile(r'"(?:[^"\\\n]|\\.)*"')
+YAML_STRAY_BACKSLASH_PATTERN = re.compile(r'\\(?![0abt\tnvfre "/\\N_LP]|x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|U[0-9a-fA-F]{8})')
+
+class RepairStats:
+    '''
+    counters of the local repair outcomes, every local repair avoids at least one llm fixer call
+    '''
+    def __init__(self) -> None:
+        self.json_repaired = 0
+        self.json_failed = 0
+        self.yaml_repaired = 0
+        self.yaml_failed = 0
+
+    def stats_message(self):
+        return f'local repair json repaired: {self.json_repaired}, json failed: {self.json_failed}, ' + \
+            f'yaml repaired: {self.yaml_repaired}, yaml failed: {self.yaml_failed}, ' + \
+            f'llm fixer calls avoided: {self.json_repaired + self.yaml_repaired}'
+
+def strip_code_fences(text):
+    match = CODE_FENCE_PATTERN.match(text)
+    return match.group(1) if match else text
+
+def _drop_trailing_comma(chars):
+    index = len(chars) - 1
+    while index >= 0 and chars[index].isspace():
+        index -= 1
+    if index >= 0 and chars[index] == ',':
+        del chars[index]
+
+def _next_non_space(text, start):
+    while start < len(text) and text[start].isspace():
+        start += 1
+    return text[start] if start < len(text) else ''
+
+def repair_json_string(json_string):
+    '''
+    fix the common json mistakes of the model: markdown code fences, text around the json value, trailing commas,
+    unescaped new lines and quotes in strings, stray backslashes, single quoted strings, python literals and
+    truncated closing brackets
+    '''
+    text = strip_code_fences(str(json_string)).strip()
+    starts = [i for i in (text.find('{'), text.find('[')) if i >= 0]
+    if starts:
+        text = text[min(starts):]
+    text = re.sub(r'\\\n', r'\\n', text)
+
+    chars = []
+    closing_stack = []
+    in_string = False
+    quote = None
+    escape = False
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if in_string:
+            if escape:
+                chars.append(c)
+                escape = False
+            elif c == '\\':
+                if JSON_ESCAPE_PATTERN.match(text, i):
+                    chars.append(c)
+                    escape = True
+                elif text[i + 1:i + 2] == "'":
+                    chars.append("'")
+                    i += 1
+                elif i + 1 < len(text):
+                    # a stray backslash, such as in a windows path, stands for itself
+                    chars.append('\\\\')
+            elif c == quote:
+                if _next_non_space(text, i + 1) in (',', ':', '}', ']', ''):
+                    chars.append('"')
+                    in_string = False
+                else:
+                    chars.append('\\"')
+            elif c == '"':
+                chars.append('\\"')
+            elif c == '\n':
+                chars.append('\\n')
+            elif c == '\r':
+                chars.append('\\r')
+            elif c == '\t':
+                chars.append('\\t')
+            else:
+                chars.append(c)
+        elif c in ('"', "'"):
+            in_string = True
+            quote = c
+            chars.append('"')
+        elif c in '{[':
+            closing_stack.append('}' if c == '{' else ']')
+            chars.append(c)
+        elif c in '}]':
+            _drop_trailing_comma(chars)
+            if closing_stack:
+                closing_stack.pop()
+            chars.append(c)
+            if not closing_stack:
+                # ignore anything after the top level value
+                break
+        elif c.isalpha():
+            j = i
+            while j < len(text) and (text[j].isalnum() or text[j] == '_'):
+                j += 1
+            word = text[i:j]
+            chars.append(PYTHON_LITERALS.get(word, word))
+            i = j
+            continue
+        else:
+            chars.append(c)
+        i += 1
+
+    if in_string:
+        chars.append('"')
+    while closing_stack:
+        _drop_trailing_comma(chars)
+        if ''.join(chars).rstrip().endswith(':'):
+            chars.append('null')
+        chars.append(closing_stack.pop())
+    return ''.join(chars)
+
+def repair_json_loads(json_string):
+    '''
+    repair the json string locally and load it, raise JSONDecodeError if it still can not be loaded
+    '''
+    return json.loads(repair_json_string(json_string))
+
+def _replace_tabs_in_indent(text):
+    lines = []
+    for line in text.splitlines():
+        content = line.lstrip(' \t')
+        indent = line[:len(line) - len(content)].replace('\t', '  ')
+        lines.append(indent + content.rstrip())
+    return '\n'.join(lines)
+
+def _quote_plain_scalars(text):
+    lines = []
+    for line in text.splitlines():
+        match = YAML_KEY_VALUE_PATTERN.match(line)
+        if match:
+            key, value = match.groups()
+            if value[0] not in '\'"[{|>&*!' and (': ' in value or ' #' in value):
+                value = json.dumps(value)
+        else:
+            key, value = '', line
+        lines.append(key + value)
+    return '\n'.join(lines)
+
+def _round_odd_indents(text):
+    lines = []
+    for line in text.splitlines():
+        content = line.lstrip(' ')
+        indent = len(line) - len(content)
+        lines.append(' ' * (indent - indent % 2) + content)
+    return '\n'.join(lines)
+
+def _escape_stray_backslashes(text):
+    return YAML_DOUBLE_QUOTED_PATTERN.sub(lambda match: YAML_STRAY_BACKSLASH_PATTERN.sub(r'\\\\', match.group(0)), text)
+
+def repair_yaml_loads(yaml_string):
+    '''
+    repair the common yaml mistakes of the model locally and load it: markdown code fences, tabs in indentation,
+    unquoted values containing ': ', stray backslashes in double quoted strings and odd indentation.
+    raise YAMLError if it still can not be loaded
+    '''
+    text = _replace_tabs_in_indent(strip_code_fences(str(yaml_string)))
+    error = None
+    for repair in (lambda t: t, _quote_plain_scalars, _escape_stray_backslashes, _round_odd_indents):
+        text = repair(text)
+        try:
+            return yaml.safe_load(text)
+        except yaml.YAMLError as ex:
+            error = ex
+    raise error
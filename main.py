@@ -1,3 +1,7 @@
+from startup_profile import StartupProfiler
+# started before the other imports so that their import time is measured, run with --startup-profile to print it
+startup_profiler = StartupProfiler.from_argv()
+
 from tkinter import messagebox
 import tkinter as tk
 from async_tkinter_loop import async_handler, async_mainloop
@@ -124,7 +128,11 @@ update_label = customtkinter.CTkLabel(app, text="Status: Waiting for user's inpu
 update_label.grid(row=0, sticky='nwse')
 
 # init CopilotContext
+if startup_profiler:
+    startup_profiler.mark('imports')
 copilot_context = CopilotContext()
+if startup_profiler:
+    startup_profiler.mark('create copilot context')
 
 # Create a text widget to display the chat conversation
 chat_box = tk.Text(app, font=CHAT_FONT)
@@ -160,6 +168,18 @@ if env_ready:
 else:
     add_to_chat(environment_not_ready_message + msg, COPILOT_TAG)
 
+async def warmup_async():
+    # warm up the tokenizer, templates and connections while the user is typing
+    if env_ready:
+        await copilot_context.warmup()
+    if startup_profiler:
+        startup_profiler.mark('warmup')
+        print(startup_profiler.report())
+
+if startup_profiler:
+    startup_profiler.mark('create ui and check environment')
+async_handler(warmup_async)()
+
 
 # setup logging
 logger = get_logger()
@@ -0,0 +1,258 @@
+import re
+import time
+import heapq
+import random
+import asyncio
+import itertools
+import functools
+from logging_util import get_logger
+
+logger = get_logger()
+
+# interactive main turn calls are scheduled before background helper calls
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+RETRY_AFTER_PATTERN = re.compile(r'retry after (\d+(?:\.\d+)?) second', re.IGNORECASE)
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors():
+    # openai is imported on first use to keep it out of the startup path
+    from openai import error as openai_error
+    return (openai_error.RateLimitError, openai_error.ServiceUnavailableError, openai_error.Timeout,
+            openai_error.APIConnectionError, openai_error.TryAgain)
+
+def is_rate_limit_error(ex):
+    from openai import error as openai_error
+    return isinstance(ex, openai_error.RateLimitError)
+
+class TokenBucket:
+    '''
+    token bucket refilled continuously with limit_per_minute tokens per minute, a limit of 0 means unlimited.
+    the level may become negative when the actual usage is higher than the reserved amount.
+    '''
+    def __init__(self, limit_per_minute) -> None:
+        self.capacity = limit_per_minute
+        self.level = float(limit_per_minute)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.capacity / 60)
+        self.updated_at = now
+
+    def wait_time(self, amount):
+        '''
+        seconds until amount tokens are available, amounts larger than the capacity only wait for a full bucket
+        '''
+        if not self.capacity:
+            return 0
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0, missing * 60 / self.capacity)
+
+    def consume(self, amount):
+        if self.capacity:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount):
+        if self.capacity:
+            self.level -= amount
+
+def retry_after_seconds(ex):
+    '''
+    the delay requested by the server in the Retry-After headers or in the error message, or None
+    '''
+    headers = getattr(ex, 'headers', None) or {}
+    for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1)):
+        value = headers.get(header) if hasattr(headers, 'get') else None
+        if value is not None:
+            try:
+                return float(value) * scale
+            except ValueError:
+                pass
+    match = RETRY_AFTER_PATTERN.search(str(ex))
+    return float(match.group(1)) if match else None
+
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: 'interactive', PRIORITY_BACKGROUND: 'background'}
+
+class PrioritySemaphore:
+    '''
+    semaphore which hands the released slots to the waiting acquirers by priority and then in arrival order,
+    so that an interactive request does not queue behind background requests for a concurrency slot.
+    the queue depth and the wait times per priority are kept as metrics
+    '''
+    def __init__(self, value) -> None:
+        self._value = value
+        self._waiters = []
+        self._sequence = itertools.count()
+
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self._waits = {}
+
+    async def acquire(self, priority=PRIORITY_BACKGROUND):
+        '''
+        wait for a slot, return the seconds waited
+        '''
+        start_time = time.perf_counter()
+        if self._value > 0 and not self._waiters:
+            self._value -= 1
+        else:
+            waiter = (priority, next(self._sequence), asyncio.get_running_loop().create_future())
+            heapq.heappush(self._waiters, waiter)
+            self._update_queue_depth()
+            try:
+                await waiter[2]
+            except asyncio.CancelledError:
+                if waiter[2].cancelled():
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                        heapq.heapify(self._waiters)
+                        self._update_queue_depth()
+                else:
+                    # the slot was handed over right before the cancellation, pass it on
+                    self.release()
+                raise
+        wait_seconds = time.perf_counter() - start_time
+        count, total_wait_seconds, max_wait_seconds = self._waits.get(priority, (0, 0, 0))
+        self._waits[priority] = (count + 1, total_wait_seconds + wait_seconds, max(max_wait_seconds, wait_seconds))
+        return wait_seconds
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            self._update_queue_depth()
+            if not future.done():
+                future.set_result(None)
+                return
+        self._value += 1
+
+    def _update_queue_depth(self):
+        self.queue_depth = len(self._waiters)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    def metrics(self):
+        metrics = {'queue_depth': self.queue_depth, 'max_queue_depth': self.max_queue_depth}
+        for priority, (count, total_wait_seconds, max_wait_seconds) in sorted(self._waits.items()):
+            name = PRIORITY_NAMES.get(priority, str(priority))
+            metrics[f'{name}_requests'] = count
+            metrics[f'{name}_average_wait_seconds'] = total_wait_seconds / count
+            metrics[f'{name}_max_wait_seconds'] = max_wait_seconds
+        return metrics
+
+    def stats_message(self):
+        metrics = self.metrics()
+        return 'llm concurrency slots ' + ', '.join(f'{key.replace("_", " ")}: {value:.2f}' if isinstance(value, float) else f'{key.replace("_", " ")}: {value}'
+                                                  for key, value in metrics.items())
+
+class RateLimitScheduler:
+    '''
+    schedule llm requests within requests per minute and tokens per minute budgets using token buckets.
+    waiting requests are served by priority and then in arrival order, throttled or failed requests are retried
+    after the Retry-After delay or with jittered exponential backoff, a 429 pauses all requests until the delay has passed.
+    '''
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, max_retries=5, base_delay=1, max_delay=60) -> None:
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._paused_until = 0
+
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.scheduled_requests = 0
+        self.total_wait_seconds = 0
+        self.max_wait_seconds = 0
+        self.throttled_responses = 0
+        self.retries = 0
+
+    def _wake_head(self):
+        if self._waiters:
+            self._waiters[0][2].set()
+
+    async def _acquire(self, tokens, priority):
+        waiter = (priority, next(self._sequence), asyncio.Event())
+        heapq.heappush(self._waiters, waiter)
+        self.queue_depth = len(self._waiters)
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+        try:
+            while True:
+                if self._waiters[0] is not waiter:
+                    waiter[2].clear()
+                    await waiter[2].wait()
+                    continue
+                wait_time = max(self.request_bucket.wait_time(1), self.token_bucket.wait_time(tokens), self._paused_until - time.monotonic())
+                if wait_time <= 0:
+                    self.request_bucket.consume(1)
+                    self.token_bucket.consume(tokens)
+                    return
+                await asyncio.sleep(wait_time)
+        finally:
+            self._waiters.remove(waiter)
+            heapq.heapify(self._waiters)
+            self.queue_depth = len(self._waiters)
+            self._wake_head()
+
+    def _backoff_delay(self, attempt, ex):
+        retry_after = retry_after_seconds(ex)
+        if retry_after is not None:
+            return min(self.max_delay, retry_after) + random.uniform(0, self.base_delay)
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def run(self, create_func, estimated_tokens, priority=PRIORITY_BACKGROUND):
+        '''
+        run create_func within the budgets and retry it on throttling and transient errors,
+        return its result and the seconds waited for the budgets
+        '''
+        wait_seconds = 0
+        for attempt in range(self.max_retries + 1):
+            start_time = time.perf_counter()
+            await self._acquire(estimated_tokens, priority)
+            wait_seconds += time.perf_counter() - start_time
+            try:
+                result = await create_func()
+                break
+            except retryable_errors() as ex:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff_delay(attempt, ex)
+                if is_rate_limit_error(ex):
+                    self.throttled_responses += 1
+                    self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self.retries += 1
+                logger.warning(f'llm request failed with {type(ex).__name__}, retry {attempt + 1}/{self.max_retries} in {delay:.1f}s: {ex}')
+                await asyncio.sleep(delay)
+                wait_seconds += delay
+
+        self.scheduled_requests += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        return result, wait_seconds
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        '''
+        correct the token budget with the actual usage of a request
+        '''
+        self.token_bucket.adjust(actual_tokens - estimated_tokens)
+
+    def metrics(self):
+        return {
+            'queue_depth': self.queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+            'scheduled_requests': self.scheduled_requests,
+            'average_wait_seconds': self.total_wait_seconds / self.scheduled_requests if self.scheduled_requests else 0,
+            'max_wait_seconds': self.max_wait_seconds,
+            'throttled_responses': self.throttled_responses,
+            'retries': self.retries,
+        }
+
+    def stats_message(self):
+        metrics = self.metrics()
+        return f'rate limit scheduler requests: {metrics["scheduled_requests"]}, queue depth: {metrics["queue_depth"]}, ' + \
+            f'max queue depth: {metrics["max_queue_depth"]}, average wait: {metrics["average_wait_seconds"]:.2f}s, ' + \
+            f'max wait: {metrics["max_wait_seconds"]:.2f}s, throttled: {metrics["throttled_responses"]}, retries: {metrics["retries"]}'
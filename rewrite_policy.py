@@ -0,0 +1,108 @@
+import re
+
+# a reply or a continuation at the start of the input, such as "yes", "also add ..." or "what about ..."
+CONTINUATION_PATTERN = re.compile(
+    r"^\W*(yes|yeah|yep|no|nope|ok|okay|sure|thanks|thank you|great|also|and|then|instead|again|now|but|please do|do it|do that|"
+    r"go ahead|continue|what about|how about|it|this|that|these|those)\b",
+    re.IGNORECASE)
+# explicit references to earlier turns anywhere in the input
+EARLIER_TURN_PATTERN = re.compile(
+    r"\b(above|previous|previously|earlier|former|latter|mentioned|as before|like before|the same|"
+    r"the last (one|flow|answer|version|step|change|time)|you (just )?(said|mentioned|suggested|proposed|created|generated|wrote|made|did|changed))\b"
+    r"|\binstead\W*$",
+    re.IGNORECASE)
+# pronouns and demonstratives which need an antecedent, "that" only where it is not a conjunction or a relative pronoun
+PRONOUN_PATTERN = re.compile(
+    r"\b(it|its|they|them|their|this|these|those|"
+    r"that(?=\s*([.,!?;:]|$|\s+(is|was|looks|seems|works|did|does|one|ones|part|flow|node|file|folder|code|prompt|function|output|input|step|version)\b)))\b",
+    re.IGNORECASE)
+# a request for something new, or a local path, introduces the antecedent of the pronouns after it, as in "create a flow which ... and run it"
+INTRODUCTION_PATTERN = re.compile(
+    r"\b(create|build|generate|write|make|design|develop|implement|give me|i want|i need)\s+(me\s+)?(a|an|new|some)\b"
+    r"|\b(folder|file|path)\s+[\"'`]?[\w.:~-]*[/\\]",
+    re.IGNORECASE)
+WORD_PATTERN = re.compile(r"\w+")
+
+REWRITE_MODES = ['always', 'auto', 'speculative']
+
+class RewritePolicy:
+    '''
+    decide whether the user input needs to be rewritten with the conversation history before the main request.
+    modes:
+    always: always rewrite the user input before the main request.
+    auto: only rewrite when there is prior conversation and the input refers to it: a short input, a continuation such as
+    "yes" or "also ...", an explicit reference to an earlier turn, or a pronoun which the input itself has not introduced.
+    speculative: same as auto, but the main request runs in parallel with the rewrite and is restarted only if the rewrite differs materially.
+    '''
+    def __init__(self, mode='auto', max_short_input_words=3, similarity_threshold=0.6) -> None:
+        if mode not in REWRITE_MODES:
+            raise ValueError(f'Unknown rewrite mode {mode}, supported modes: {REWRITE_MODES}')
+        self.mode = mode
+        self.max_short_input_words = max_short_input_words
+        self.similarity_threshold = similarity_threshold
+
+        self.skipped = 0
+        self.rewritten = 0
+        self.speculative_hits = 0
+        self.speculative_restarts = 0
+        self.saved_ms = 0.0
+        self.rewrite_latency_ms = None
+
+    @staticmethod
+    def has_prior_conversation(messages):
+        return any(message['role'] in ('user', 'assistant') for message in messages)
+
+    def refers_to_history(self, user_input):
+        words = WORD_PATTERN.findall(user_input)
+        if len(words) <= self.max_short_input_words:
+            return True
+        if CONTINUATION_PATTERN.search(user_input) or EARLIER_TURN_PATTERN.search(user_input):
+            return True
+        # a pronoun refers to an earlier turn unless the input has introduced what it refers to before it
+        pronoun = PRONOUN_PATTERN.search(user_input)
+        if pronoun is None:
+            return False
+        introduction = INTRODUCTION_PATTERN.search(user_input)
+        return introduction is None or introduction.start() > pronoun.start()
+
+    def choose_path(self, user_input, messages):
+        '''
+        return 'rewrite', 'skip' or 'speculative'
+        '''
+        if self.mode == 'always':
+            return 'rewrite'
+        if not self.has_prior_conversation(messages) or not self.refers_to_history(user_input):
+            return 'skip'
+        return 'speculative' if self.mode == 'speculative' else 'rewrite'
+
+    def differs_materially(self, user_input, rewritten_user_input):
+        original_words = set(w.lower() for w in WORD_PATTERN.findall(user_input))
+        rewritten_words = set(w.lower() for w in WORD_PATTERN.findall(rewritten_user_input))
+        if not original_words or not rewritten_words:
+            return original_words != rewritten_words
+        similarity = len(original_words & rewritten_words) / len(original_words | rewritten_words)
+        return similarity < self.similarity_threshold
+
+    def record_rewrite_latency(self, latency_ms):
+        self.rewrite_latency_ms = latency_ms if self.rewrite_latency_ms is None else 0.8 * self.rewrite_latency_ms + 0.2 * latency_ms
+
+    def record_skip(self):
+        self.skipped += 1
+        if self.rewrite_latency_ms is not None:
+            self.saved_ms += self.rewrite_latency_ms
+
+    def record_rewrite(self, latency_ms):
+        self.rewritten += 1
+        self.record_rewrite_latency(latency_ms)
+
+    def record_speculation(self, latency_ms, restarted):
+        self.record_rewrite_latency(latency_ms)
+        if restarted:
+            self.speculative_restarts += 1
+        else:
+            self.speculative_hits += 1
+            self.saved_ms += latency_ms
+
+    def stats_message(self):
+        return f'rewrite user input mode: {self.mode}, skipped: {self.skipped}, rewritten: {self.rewritten}, ' + \
+            f'speculative hits: {self.speculative_hits}, speculative restarts: {self.speculative_restarts}, estimated saved latency: {self.saved_ms:.0f} ms'
@@ -0,0 +1,283 @@
+import os
+import gc
+import hmac
+import json
+import time
+import uuid
+import asyncio
+import ipaddress
+from collections import OrderedDict
+from aiohttp import web, WSMsgType
+from dotenv import load_dotenv
+from logging_util import get_logger
+from CopilotContext import CopilotContext
+
+logger = get_logger()
+
+def current_memory_mb():
+    '''
+    resident memory of the process in MB, or None if it can not be measured on this platform
+    '''
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 * 1024)
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+class Session:
+    '''
+    a chat session with its own CopilotContext, it outlives its websocket so that a client can reconnect with the session id.
+    messages printed by the copilot are queued in outbox and sent over the current websocket of the session
+    '''
+    def __init__(self, session_id, copilot_context) -> None:
+        self.session_id = session_id
+        self.copilot_context = copilot_context
+        self.outbox = asyncio.Queue()
+        self.websocket = None
+        self.request_task = None
+        self.last_active = time.monotonic()
+
+    @property
+    def busy(self):
+        return self.request_task is not None and not self.request_task.done()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def print_info(self, message):
+        self.outbox.put_nowait({'type': 'token', 'content': message})
+
+class CopilotServer:
+    '''
+    headless server hosting many chat sessions over websockets in one process.
+    the sessions share the llm client and its http pool, the rate limit scheduler, the llm cache, the templates and the tokenizer.
+    sessions are evicted after session_idle_timeout seconds without activity, or least recently active first when
+    there are more than max_sessions sessions or the process uses more than max_memory_mb. the memory is only freed
+    gradually after a session is closed, so at most max_memory_evictions sessions are evicted for memory per check.
+
+    protocol: connect to /ws, optionally with ?session_id=<id> to resume a session. the server sends
+    {"type": "session", "session_id": ...}, the client sends {"type": "message", "content": ...}, {"type": "new_chat"}
+    or {"type": "cancel"}. the answer is streamed as {"type": "token", "content": ...} and ends with
+    {"type": "done"}, {"type": "cancelled"} or {"type": "error", "message": ...}
+
+    a session reads and writes local files with the permissions of the server process, so the server must only be reachable
+    by trusted users. with auth_token set, /ws requires the token as ?token=<token> or as an "Authorization: Bearer <token>" header
+    '''
+    def __init__(self, session_idle_timeout=1800, max_sessions=100, max_memory_mb=0, max_memory_evictions=1, eviction_interval=30, auth_token=None) -> None:
+        self.session_idle_timeout = session_idle_timeout
+        self.max_sessions = max_sessions
+        self.max_memory_mb = max_memory_mb
+        self.max_memory_evictions = max_memory_evictions
+        self.eviction_interval = eviction_interval
+        self.auth_token = auth_token
+        self.sessions = OrderedDict()
+        self.shared_context = None
+        self._eviction_task = None
+        self._warmup_task = None
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/ws', self.handle_websocket)
+        app.router.add_get('/health', self.handle_health)
+        app.on_startup.append(self.on_startup)
+        app.on_cleanup.append(self.on_cleanup)
+        return app
+
+    async def on_startup(self, app):
+        # the resources created by the first context are shared by the contexts of all sessions
+        self.shared_context = CopilotContext()
+        env_ready, msg = self.shared_context.check_env()
+        if not env_ready:
+            logger.error(f'environment is not ready: {msg}')
+        else:
+            self._warmup_task = asyncio.create_task(self.shared_context.warmup())
+        self._eviction_task = asyncio.create_task(self._evict_sessions_periodically())
+        logger.info('copilot server started')
+
+    async def on_cleanup(self, app):
+        for task in (self._eviction_task, self._warmup_task):
+            if task and not task.done():
+                task.cancel()
+        for session in list(self.sessions.values()):
+            await self.close_session(session, 'server is shutting down')
+        await self.shared_context.close()
+
+    def _new_session(self):
+        copilot_context = CopilotContext(
+            llm_client=self.shared_context.llm_client,
+            rate_limit_scheduler=self.shared_context.rate_limit_scheduler,
+            llm_cache=self.shared_context.llm_cache)
+        session = Session(uuid.uuid4().hex, copilot_context)
+        self.sessions[session.session_id] = session
+        logger.info(f'created session {session.session_id}, {len(self.sessions)} sessions')
+        return session
+
+    async def close_session(self, session, reason):
+        self.sessions.pop(session.session_id, None)
+        if session.request_task and not session.request_task.done():
+            session.request_task.cancel()
+        if session.websocket is not None and not session.websocket.closed:
+            try:
+                await session.websocket.send_json({'type': 'session_closed', 'reason': reason})
+                await session.websocket.close()
+            except ConnectionError:
+                pass
+        logger.info(f'closed session {session.session_id}: {reason}, {len(self.sessions)} sessions')
+
+    def _idle_sessions_by_age(self):
+        return sorted((session for session in self.sessions.values() if not session.busy), key=lambda session: session.last_active)
+
+    async def evict_sessions(self, reserve=0):
+        '''
+        evict the idle sessions, and the least recently active ones while the server is over its session or memory limits.
+        reserve is the number of sessions about to be created
+        '''
+        now = time.monotonic()
+        for session in self._idle_sessions_by_age():
+            if now - session.last_active > self.session_idle_timeout:
+                await self.close_session(session, 'idle timeout')
+
+        memory_evictions = 0
+        for session in self._idle_sessions_by_age():
+            if len(self.sessions) + reserve > self.max_sessions:
+                await self.close_session(session, 'too many sessions')
+            elif self.max_memory_mb and memory_evictions < self.max_memory_evictions and (current_memory_mb() or 0) > self.max_memory_mb:
+                await self.close_session(session, 'memory pressure')
+                memory_evictions += 1
+                # collect the closed session before measuring again, the rss still includes it until then
+                gc.collect()
+            else:
+                break
+
+    async def _evict_sessions_periodically(self):
+        while True:
+            await asyncio.sleep(self.eviction_interval)
+            try:
+                await self.evict_sessions()
+            except Exception:
+                logger.exception('failed to evict sessions')
+
+    async def handle_health(self, request):
+        return web.json_response({
+            'sessions': len(self.sessions),
+            'busy_sessions': sum(1 for session in self.sessions.values() if session.busy),
+            'memory_mb': current_memory_mb(),
+            'rate_limit': self.shared_context.rate_limit_scheduler.metrics(),
+            'concurrency': self.shared_context.llm_client.concurrency_metrics(),
+        })
+
+    def _is_authorized(self, request):
+        if not self.auth_token:
+            return True
+        token = request.query.get('token')
+        authorization = request.headers.get('Authorization', '')
+        if token is None and authorization.startswith('Bearer '):
+            token = authorization[len('Bearer '):]
+        return token is not None and hmac.compare_digest(token.encode('utf-8'), self.auth_token.encode('utf-8'))
+
+    async def handle_websocket(self, request):
+        if not self._is_authorized(request):
+            logger.warning(f'rejected an unauthorized websocket from {request.remote}')
+            raise web.HTTPUnauthorized(text='a valid token is required')
+        websocket = web.WebSocketResponse(heartbeat=30)
+        await websocket.prepare(request)
+
+        session = self.sessions.get(request.query.get('session_id'))
+        if session is None:
+            await self.evict_sessions(reserve=1)
+            if len(self.sessions) >= self.max_sessions:
+                await websocket.send_json({'type': 'error', 'message': 'the server is busy, please try again later'})
+                await websocket.close()
+                return websocket
+            session = self._new_session()
+        elif session.websocket is not None and not session.websocket.closed:
+            await session.websocket.close(message=b'replaced by a new connection')
+        session.websocket = websocket
+        session.touch()
+        self.sessions.move_to_end(session.session_id)
+
+        await websocket.send_json({'type': 'session', 'session_id': session.session_id})
+        sender_task = asyncio.create_task(self._send_outbox(session, websocket))
+        try:
+            async for message in websocket:
+                if message.type == WSMsgType.TEXT:
+                    await self._handle_message(session, message.data)
+                elif message.type == WSMsgType.ERROR:
+                    logger.warning(f'websocket of session {session.session_id} failed: {websocket.exception()}')
+        finally:
+            sender_task.cancel()
+            if session.websocket is websocket:
+                session.websocket = None
+            session.touch()
+        return websocket
+
+    async def _send_outbox(self, session, websocket):
+        while True:
+            item = await session.outbox.get()
+            await websocket.send_json(item)
+
+    async def _handle_message(self, session, data):
+        session.touch()
+        try:
+            message = json.loads(data)
+        except json.JSONDecodeError:
+            message = {'type': 'message', 'content': data}
+
+        message_type = message.get('type')
+        if message_type == 'cancel':
+            if session.request_task and not session.request_task.done():
+                session.request_task.cancel()
+        elif session.busy:
+            session.outbox.put_nowait({'type': 'error', 'message': 'please wait until the current request is completed'})
+        elif message_type == 'new_chat':
+            session.copilot_context.reset()
+            session.outbox.put_nowait({'type': 'done'})
+        elif message_type == 'message' and message.get('content'):
+            session.request_task = asyncio.create_task(self._run_request(session, message['content']))
+        else:
+            session.outbox.put_nowait({'type': 'error', 'message': f'unsupported message: {data[:200]}'})
+
+    async def _run_request(self, session, content):
+        try:
+            await session.copilot_context.ask_gpt_async(content, session.print_info)
+            session.outbox.put_nowait({'type': 'done'})
+        except asyncio.CancelledError:
+            session.outbox.put_nowait({'type': 'cancelled'})
+        except Exception as ex:
+            logger.exception(f'request of session {session.session_id} failed')
+            session.outbox.put_nowait({'type': 'error', 'message': str(ex)})
+        finally:
+            session.touch()
+
+def is_loopback_host(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+def main():
+    load_dotenv('pfcopilot.env')
+    host = os.environ.get("SERVER_HOST", "127.0.0.1")
+    auth_token = os.environ.get("SERVER_AUTH_TOKEN") or None
+    if auth_token is None and not is_loopback_host(host):
+        # the sessions can read and write any local file, never expose them without authentication
+        logger.error(f'SERVER_AUTH_TOKEN is required to listen on {host}')
+        print(f'SERVER_AUTH_TOKEN is required to listen on {host}, set it in pfcopilot.env or use SERVER_HOST=127.0.0.1')
+        return
+    server = CopilotServer(
+        session_idle_timeout=float(os.environ.get("SERVER_SESSION_IDLE_TIMEOUT", "1800")),
+        max_sessions=int(os.environ.get("SERVER_MAX_SESSIONS", "100")),
+        max_memory_mb=float(os.environ.get("SERVER_MAX_MEMORY_MB", "0")),
+        max_memory_evictions=int(os.environ.get("SERVER_MAX_MEMORY_EVICTIONS", "1")),
+        auth_token=auth_token)
+    web.run_app(server.create_app(), host=host, port=int(os.environ.get("SERVER_PORT", "8765")))
+
+if __name__ == '__main__':
+    main()
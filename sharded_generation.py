@@ -0,0 +1,97 @@
+import json
+import asyncio
+import hashlib
+from logging_util import get_logger
+
+logger = get_logger()
+
+def normalize_row(value):
+    '''
+    normalize a generated row so that rows differing only in key order, case or whitespace are treated as duplicates
+    '''
+    if isinstance(value, str):
+        return ' '.join(value.lower().split())
+    if isinstance(value, dict):
+        return {str(k): normalize_row(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [normalize_row(v) for v in value]
+    return value
+
+def row_hash(row):
+    return hashlib.sha256(json.dumps(normalize_row(row), sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+def split_into_shards(total_count, shard_size):
+    shard_size = max(1, shard_size)
+    return [min(shard_size, total_count - start) for start in range(0, total_count, shard_size)]
+
+class ShardedRowGenerator:
+    '''
+    generate total_count unique rows with an llm by splitting the request into shards which run concurrently.
+    generate_shard(count, shard_index, round_index) returns a list of rows, the unique rows of every finished shard are
+    passed to on_rows right away, duplicated rows across shards are dropped and top up shards are generated
+    until total_count unique rows exist or max_top_up_rounds is reached.
+    '''
+    def __init__(self, generate_shard, on_rows, shard_size=20, concurrency=4, max_top_up_rounds=3, on_progress=None) -> None:
+        self.generate_shard = generate_shard
+        self.on_rows = on_rows
+        self.shard_size = shard_size
+        self.concurrency = concurrency
+        self.max_top_up_rounds = max_top_up_rounds
+        self.on_progress = on_progress
+        self.seen_hashes = set()
+        self.unique_rows = 0
+        self.duplicated_rows = 0
+        self.failed_shards = 0
+        self.shards = 0
+
+    def _take_unique_rows(self, rows, total_count):
+        unique_rows = []
+        for row in rows:
+            if self.unique_rows + len(unique_rows) >= total_count:
+                break
+            key = row_hash(row)
+            if key in self.seen_hashes:
+                self.duplicated_rows += 1
+                continue
+            self.seen_hashes.add(key)
+            unique_rows.append(row)
+        self.unique_rows += len(unique_rows)
+        return unique_rows
+
+    async def generate(self, total_count):
+        '''
+        return the number of unique rows generated
+        '''
+        semaphore = asyncio.Semaphore(max(1, self.concurrency))
+
+        async def run_shard(count, shard_index, round_index):
+            async with semaphore:
+                if self.unique_rows >= total_count:
+                    return
+                try:
+                    rows = await self.generate_shard(count, shard_index, round_index)
+                except Exception as ex:
+                    self.failed_shards += 1
+                    logger.warning(f'failed to generate shard {shard_index} of round {round_index}: {ex}')
+                    return
+            unique_rows = self._take_unique_rows(rows or [], total_count)
+            if unique_rows:
+                await self.on_rows(unique_rows)
+            if self.on_progress:
+                self.on_progress(self.unique_rows, total_count)
+
+        for round_index in range(self.max_top_up_rounds + 1):
+            remaining_count = total_count - self.unique_rows
+            if remaining_count <= 0:
+                break
+            shard_counts = split_into_shards(remaining_count, self.shard_size)
+            self.shards += len(shard_counts)
+            logger.info(f'generating {remaining_count} rows in {len(shard_counts)} shards, round {round_index}')
+            await asyncio.gather(*[run_shard(count, shard_index, round_index) for shard_index, count in enumerate(shard_counts)])
+
+        logger.info(self.stats_message(total_count))
+        return self.unique_rows
+
+    def stats_message(self, total_count):
+        return f'sharded generation unique rows: {self.unique_rows}/{total_count}, shards: {self.shards}, ' + \
+            f'failed shards: {self.failed_shards}, duplicated rows dropped: {self.duplicated_rows}'
@@ -0,0 +1,69 @@
+import os
+import difflib
+import threading
+from collections import OrderedDict
+
+def file_signature(path):
+    '''
+    signature of a file which changes whenever the file is modified
+    '''
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+class SnapshotCache:
+    '''
+    LRU cache of snapshots keyed by path, a snapshot is only returned while its signature (such as mtime and size) still matches
+    '''
+    def __init__(self, max_entries=256) -> None:
+        self.max_entries = max_entries
+        self._snapshots = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, signature=None):
+        '''
+        return the cached (signature, content) of key, or None if there is no snapshot or the signature changed.
+        if signature is None, the last snapshot is returned without validation
+        '''
+        with self._lock:
+            snapshot = self._snapshots.get(key)
+            if snapshot is None or (signature is not None and snapshot[0] != signature):
+                return None
+            self._snapshots.move_to_end(key)
+            return snapshot
+
+    def put(self, key, signature, content):
+        with self._lock:
+            self._snapshots[key] = (signature, content)
+            self._snapshots.move_to_end(key)
+            while len(self._snapshots) > self.max_entries:
+                self._snapshots.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+def unified_diff(old_content, new_content, file_name):
+    return ''.join(difflib.unified_diff(
+        old_content.splitlines(keepends=True),
+        new_content.splitlines(keepends=True),
+        fromfile=f'a/{file_name}',
+        tofile=f'b/{file_name}'))
+
+def diff_folder_contents(old_files, new_files):
+    '''
+    return the changes between two dicts of file name and content: unified diffs of changed files, new files and deleted files
+    '''
+    changes = {}
+    changed_files = {name: unified_diff(old_files[name], content, name) for name, content in new_files.items() if name in old_files and old_files[name] != content}
+    new_file_contents = {name: content for name, content in new_files.items() if name not in old_files}
+    deleted_files = [name for name in old_files if name not in new_files]
+    if changed_files:
+        changes['changed_files_diff'] = changed_files
+    if new_file_contents:
+        changes['new_files'] = new_file_contents
+    if deleted_files:
+        changes['deleted_files'] = deleted_files
+    return changes
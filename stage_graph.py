@@ -0,0 +1,50 @@
+import time
+import asyncio
+from logging_util import get_logger
+
+logger = get_logger()
+
+class StageGraph:
+    '''
+    a small dependency graph of async stages, every stage starts as soon as the stages it depends on are finished.
+    a stage is called with the results of its dependencies as keyword arguments, the duration of every stage is logged.
+    '''
+    def __init__(self, name) -> None:
+        self.name = name
+        self.stages = {}
+        self.timings = {}
+
+    def add(self, name, func, depends_on=()):
+        for dependency in depends_on:
+            if dependency not in self.stages:
+                raise ValueError(f'stage {name} depends on unknown stage {dependency}')
+        self.stages[name] = (func, tuple(depends_on))
+
+    async def _run_stage(self, name, tasks):
+        func, depends_on = self.stages[name]
+        dependency_results = {dependency: await tasks[dependency] for dependency in depends_on}
+        start_time = time.perf_counter()
+        try:
+            return await func(**dependency_results)
+        finally:
+            self.timings[name] = time.perf_counter() - start_time
+            logger.info(f'{self.name} stage {name} took {self.timings[name]:.2f}s')
+
+    async def run(self):
+        '''
+        run all stages and return a dict of stage name and result, if a stage fails the other stages are cancelled
+        '''
+        start_time = time.perf_counter()
+        tasks = {}
+        for name in self.stages:
+            tasks[name] = asyncio.create_task(self._run_stage(name, tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            raise
+        logger.info(f'{self.name} took {time.perf_counter() - start_time:.2f}s, stage timings: ' +
+                    ', '.join(f'{name}: {duration:.2f}s' for name, duration in self.timings.items()))
+        return {name: task.result() for name, task in tasks.items()}
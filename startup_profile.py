@@ -0,0 +1,75 @@
+import sys
+import time
+import builtins
+
+STARTUP_PROFILE_OPTION = '--startup-profile'
+
+class StartupProfiler:
+    '''
+    measure the import time of every top level package imported after start(), and the duration of named startup phases.
+    the cumulative time of a package includes the packages it imports, the self time does not.
+    '''
+    def __init__(self) -> None:
+        self.start_time = time.perf_counter()
+        self.import_times = {}
+        self.phases = []
+        self._original_import = None
+        self._stack = []
+
+    @classmethod
+    def from_argv(cls, argv=None):
+        '''
+        return a started profiler if --startup-profile is in argv, otherwise None
+        '''
+        argv = sys.argv if argv is None else argv
+        if STARTUP_PROFILE_OPTION not in argv:
+            return None
+        argv.remove(STARTUP_PROFILE_OPTION)
+        profiler = cls()
+        profiler.start()
+        return profiler
+
+    def start(self):
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def stop(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        package = name.split('.')[0]
+        if level or name in sys.modules or package in (frame[0] for frame in self._stack):
+            return self._original_import(name, globals, locals, fromlist, level)
+
+        frame = [package, 0.0]
+        self._stack.append(frame)
+        start_time = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            duration = time.perf_counter() - start_time
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1] += duration
+            cumulative, self_time = self.import_times.get(package, (0.0, 0.0))
+            self.import_times[package] = (cumulative + duration, self_time + duration - frame[1])
+
+    def mark(self, phase):
+        '''
+        record that phase finished now, its duration is the time since the previous phase
+        '''
+        self.phases.append((phase, time.perf_counter()))
+
+    def report(self, top=15):
+        self.stop()
+        lines = ['startup profile', f'{"package":<30}{"cumulative ms":>15}{"self ms":>12}']
+        for package, (cumulative, self_time) in sorted(self.import_times.items(), key=lambda item: -item[1][0])[:top]:
+            lines.append(f'{package:<30}{cumulative * 1000:>15.1f}{self_time * 1000:>12.1f}')
+        previous_time = self.start_time
+        for phase, phase_time in self.phases:
+            lines.append(f'{phase:<30}{(phase_time - previous_time) * 1000:>15.1f}')
+            previous_time = phase_time
+        lines.append(f'{"total":<30}{(previous_time - self.start_time) * 1000:>15.1f}')
+        return '\n'.join(lines)
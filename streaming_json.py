@@ -0,0 +1,154 @@
+import json
+from collections import namedtuple
+
+# index is None for a top level value, or the position of the element in a top level array
+JsonEvent = namedtuple('JsonEvent', ['key', 'index', 'value'])
+
+class StreamingJsonParser:
+    '''
+    incremental parser for a json object streamed in chunks, such as function call arguments.
+    feed() returns the events of the values completed by the chunk: one event for every top level value,
+    and one event for every element of the top level arrays listed in array_keys as soon as the element closes.
+    once the stream turns out to be malformed, failed is set and no more events are emitted,
+    the caller should parse the whole string with its fallback path instead.
+    '''
+    def __init__(self, array_keys=()) -> None:
+        self.array_keys = set(array_keys)
+        self.failed = False
+        self.finished = False
+
+        # the text which may still be needed, starting at the absolute position _base. the consumed prefix is dropped
+        # after every chunk so that a long stream is not copied and rescanned over and over
+        self._chunks = []
+        self._base = 0
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._expecting_key = False
+        self._reading_key = False
+        self._key_start = None
+        self._key = None
+        self._value_start = None
+        self._in_tracked_array = False
+        self._item_start = None
+        self._item_index = 0
+        self._items = []
+
+    def feed(self, text):
+        events = []
+        if self.failed or self.finished:
+            return events
+        self._chunks.append(text)
+        try:
+            self._scan(text, events)
+        except ValueError:
+            self.failed = True
+        self._drop_consumed()
+        return events
+
+    def _text(self, start, end):
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+        return self._chunks[0][start - self._base:end - self._base]
+
+    def _drop_consumed(self):
+        starts = [start for start in (self._key_start if self._reading_key else None, self._value_start, self._item_start) if start is not None]
+        keep_from = min(starts, default=self._pos)
+        while self._chunks and self._base + len(self._chunks[0]) <= keep_from:
+            self._base += len(self._chunks.pop(0))
+
+    def _scan(self, text, events):
+        chunk_start = self._pos
+        for j, c in enumerate(text):
+            i = chunk_start + j
+            self._pos = i + 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == '\\':
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._reading_key:
+                        self._key = json.loads(self._text(self._key_start, i + 1))
+                        self._reading_key = False
+                elif c == '\n':
+                    raise ValueError('unescaped new line in json string')
+                continue
+
+            if c.isspace():
+                continue
+
+            if c == '"':
+                self._in_string = True
+                if self._depth == 1 and self._expecting_key:
+                    self._reading_key = True
+                    self._key_start = i
+                else:
+                    self._begin_value(i)
+            elif c in '{[':
+                if self._depth == 0 and c != '{':
+                    raise ValueError('json stream is not an object')
+                self._check_not_expecting_key()
+                self._begin_value(i)
+                self._depth += 1
+                if self._depth == 1:
+                    self._expecting_key = True
+                elif self._depth == 2 and c == '[' and self._key in self.array_keys:
+                    # the array is put together from its elements, so its text does not need to be kept
+                    self._in_tracked_array = True
+                    self._value_start = None
+                    self._item_index = 0
+                    self._items = []
+            elif c in '}]':
+                self._end_scalar(i, events)
+                self._depth -= 1
+                if self._depth < 0:
+                    raise ValueError('unbalanced json stream')
+                if self._depth == 0:
+                    self.finished = True
+                    return
+                if self._depth == 1:
+                    value = self._items if self._in_tracked_array else json.loads(self._text(self._value_start, i + 1))
+                    events.append(JsonEvent(self._key, None, value))
+                    self._value_start = None
+                    self._in_tracked_array = False
+                    self._items = []
+                elif self._depth == 2 and self._in_tracked_array:
+                    self._emit_item(self._text(self._item_start, i + 1), events)
+            elif c == ':':
+                if self._depth == 1:
+                    self._expecting_key = False
+            elif c == ',':
+                self._end_scalar(i, events)
+                if self._depth == 1:
+                    self._expecting_key = True
+            else:
+                self._check_not_expecting_key()
+                self._begin_value(i)
+
+    def _check_not_expecting_key(self):
+        if self._depth == 1 and self._expecting_key:
+            raise ValueError('json value where a key is expected')
+
+    def _begin_value(self, i):
+        if self._depth == 1 and not self._expecting_key and self._value_start is None:
+            self._value_start = i
+        elif self._depth == 2 and self._in_tracked_array and self._item_start is None:
+            self._item_start = i
+
+    def _end_scalar(self, i, events):
+        if self._depth == 1 and self._value_start is not None:
+            events.append(JsonEvent(self._key, None, json.loads(self._text(self._value_start, i))))
+            self._value_start = None
+        elif self._depth == 2 and self._in_tracked_array and self._item_start is not None:
+            self._emit_item(self._text(self._item_start, i), events)
+
+    def _emit_item(self, item_string, events):
+        item = json.loads(item_string)
+        self._items.append(item)
+        events.append(JsonEvent(self._key, self._item_index, item))
+        self._item_index += 1
+        self._item_start = None
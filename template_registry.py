@@ -0,0 +1,105 @@
+import os
+import json
+import hashlib
+import functools
+import threading
+from collections import OrderedDict
+from logging_util import get_logger
+
+logger = get_logger()
+
+class MemoizedTemplate:
+    '''
+    a template of the registry, render() returns the memoized output for arguments rendered before
+    '''
+    def __init__(self, registry, name) -> None:
+        self.registry = registry
+        self.name = name
+
+    def render(self, **kwargs):
+        return self.registry.render(self.name, **kwargs)
+
+class TemplateRegistry:
+    '''
+    process wide registry of the prompt templates, every template is compiled once per process and the compiled
+    bytecode is cached on disk for a faster cold start. renders are memoized by the hash of their arguments.
+    in dev mode the templates are reloaded and the memoized renders invalidated when the template files change.
+    '''
+    def __init__(self, template_folder, bytecode_cache_folder=None, dev_mode=False, max_renders=256) -> None:
+        self.template_folder = template_folder
+        self.bytecode_cache_folder = bytecode_cache_folder
+        self.dev_mode = dev_mode
+        self.max_renders = max_renders
+        self._environment = None
+        self._renders = OrderedDict()
+        self._lock = threading.Lock()
+        self.render_hits = 0
+        self.render_misses = 0
+
+    @property
+    def environment(self):
+        '''
+        the jinja environment, jinja is imported on first use to keep it out of the startup path
+        '''
+        with self._lock:
+            if self._environment is None:
+                from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+                bytecode_cache = None
+                if self.bytecode_cache_folder:
+                    os.makedirs(self.bytecode_cache_folder, exist_ok=True)
+                    bytecode_cache = FileSystemBytecodeCache(self.bytecode_cache_folder)
+                self._environment = Environment(
+                    loader=FileSystemLoader(self.template_folder),
+                    variable_start_string='[[',
+                    variable_end_string=']]',
+                    bytecode_cache=bytecode_cache,
+                    auto_reload=self.dev_mode,
+                    cache_size=-1)
+            return self._environment
+
+    def get(self, name):
+        return MemoizedTemplate(self, name)
+
+    def compile_all(self, folder='prompts'):
+        '''
+        compile every template under folder ahead of the first render
+        '''
+        names = self.environment.list_templates(filter_func=lambda name: name.startswith(folder + '/'))
+        for name in names:
+            self.environment.get_template(name)
+        return names
+
+    def _template_signature(self, name):
+        if not self.dev_mode:
+            return None
+        stat = os.stat(os.path.join(self.template_folder, name))
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def render(self, name, /, **kwargs):
+        arguments_hash = hashlib.sha1(json.dumps(kwargs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        key = (name, self._template_signature(name), arguments_hash)
+        with self._lock:
+            rendered = self._renders.get(key)
+            if rendered is not None:
+                self._renders.move_to_end(key)
+                self.render_hits += 1
+                return rendered
+
+        rendered = self.environment.get_template(name).render(**kwargs)
+        with self._lock:
+            self.render_misses += 1
+            self._renders[key] = rendered
+            while len(self._renders) > self.max_renders:
+                self._renders.popitem(last=False)
+        return rendered
+
+    def stats_message(self):
+        return f'template renders memoized: {self.render_hits}, rendered: {self.render_misses}, memoized entries: {len(self._renders)}'
+
+@functools.lru_cache(maxsize=None)
+def get_template_registry(template_folder, bytecode_cache_folder=None, dev_mode=False):
+    '''
+    the registry shared by all copilot contexts of the process with the same settings
+    '''
+    logger.info(f'create template registry for {template_folder}, bytecode cache: {bytecode_cache_folder}, dev mode: {dev_mode}')
+    return TemplateRegistry(template_folder, bytecode_cache_folder, dev_mode)
@@ -0,0 +1,108 @@
+import random
+import pytest
+from token_utils import TokenCounter
+from history_manager import ConversationHistory, SUMMARY_PREFIX
+
+@pytest.fixture(scope='module')
+def token_counter():
+    return TokenCounter()
+
+def turn(index, words=40):
+    return [
+        {'role': 'user', 'content': f'question {index} ' + 'word ' * words},
+        {'role': 'assistant', 'content': f'answer {index} ' + 'word ' * words},
+    ]
+
+def new_history(token_counter, context_window=100000, messages=()):
+    return ConversationHistory(token_counter, context_window=context_window, completion_reserve=0, messages=messages)
+
+def test_running_total_matches_a_full_recount(token_counter):
+    rng = random.Random(7)
+    history = new_history(token_counter, messages=[{'role': 'system', 'content': 'system'}])
+    for step in range(500):
+        message = {'role': rng.choice(['user', 'assistant', 'function']), 'name': 'f', 'content': 'x ' * rng.randint(0, 30)}
+        operation = rng.randrange(9) if len(history) > 3 else 0
+        if operation == 0:
+            history.append(message)
+        elif operation == 1:
+            history.insert(rng.randrange(len(history)), message)
+        elif operation == 2:
+            history.pop(rng.randrange(len(history)))
+        elif operation == 3:
+            history.remove(history[rng.randrange(len(history))])
+        elif operation == 4:
+            history[rng.randrange(len(history))] = message
+        elif operation == 5:
+            history[1:3] = [message, dict(message), dict(message)]
+        elif operation == 6:
+            del history[1:3]
+        elif operation == 7:
+            history.delete_indexes(rng.sample(range(len(history)), 2))
+        else:
+            history.remove_where(lambda m: m['role'] == 'function')
+        assert history.num_tokens == token_counter.count_messages(history), f'step {step}, operation {operation}'
+        assert [history.message_tokens(i) for i in range(len(history))] == [token_counter.count_message(m) for m in history]
+
+def test_oldest_turns_are_evicted_first_and_summarized(token_counter):
+    messages = [{'role': 'system', 'content': 'system instruction'}]
+    for index in range(10):
+        messages.extend(turn(index))
+    history = new_history(token_counter, messages=messages)
+    current_turn = turn(10)
+    history.extend(current_turn)
+
+    history.fit()
+    assert history.num_tokens <= history.token_limit
+    history.token_budget = history.num_tokens // 2
+    history.fit()
+
+    assert history.num_tokens <= history.token_limit
+    assert history.num_tokens == token_counter.count_messages(history)
+    assert history[0]['content'] == 'system instruction'
+    assert history[1]['content'].startswith(SUMMARY_PREFIX)
+    # the kept turns are the most recent ones, and the summary ends with the last evicted turn
+    kept_turns = [int(m['content'].split()[1]) for m in history[2:]]
+    first_kept_turn = kept_turns[0]
+    assert first_kept_turn > 0
+    assert kept_turns == [index for index in range(first_kept_turn, 11) for _ in range(2)]
+    assert history[1]['content'].splitlines()[-1].startswith(f'PF copilot: answer {first_kept_turn - 1} ')
+
+def test_pinned_messages_are_never_evicted(token_counter):
+    messages = [{'role': 'system', 'content': 'system instruction'}] + turn(0)
+    pinned_message = {'role': 'assistant', 'content': 'flow description ' + 'word ' * 40}
+    messages.append(pinned_message)
+    for index in range(1, 10):
+        messages.extend(turn(index))
+    history = new_history(token_counter, messages=messages)
+    history.pin(pinned_message)
+    history.token_budget = history.num_tokens // 3
+
+    history.fit()
+    assert any(m is pinned_message for m in history)
+    assert not any('question 0' in m['content'] for m in history if m['role'] == 'user')
+
+def test_removed_messages_are_unpinned(token_counter):
+    pinned_message = {'role': 'assistant', 'content': 'flow description'}
+    history = new_history(token_counter, messages=[{'role': 'system', 'content': 'system'}, pinned_message])
+    history.pin(pinned_message)
+    history.remove_where(lambda m: m is pinned_message)
+    assert history._pinned_messages == {}
+
+def test_current_turn_is_truncated_when_it_alone_is_over_budget(token_counter):
+    history = new_history(token_counter, messages=[{'role': 'system', 'content': 'system'}] + turn(0, words=2000))
+    history.token_budget = 500
+    history.fit()
+    assert history.num_tokens <= 500
+    assert history.num_tokens == token_counter.count_messages(history)
+    assert history[0]['content'] == 'system'
+    assert history[1]['content'].endswith('[truncated to fit the context window]')
+
+def test_only_the_last_flow_description_is_pinned():
+    from CopilotContext import CopilotContext
+    from llm_replay import LLMReplayer, ReplayLLMClient
+    copilot_context = CopilotContext(llm_client=ReplayLLMClient(LLMReplayer([], 0)))
+    for index in range(3):
+        copilot_context.dump_flow_definition_and_description(f'nodes: []  # {index}', f'description {index}', lambda message: None)
+    descriptions = [m for m in copilot_context.messages if m['content'].startswith('description')]
+    assert [m['content'] for m in descriptions] == ['description 2']
+    assert list(copilot_context.messages._pinned_messages.values()) == descriptions
@@ -0,0 +1,155 @@
+import time
+import asyncio
+import threading
+import pytest
+from llm_cache import LLMCache
+
+REQUEST_ARGS = {'model': 'gpt-4', 'temperature': 0, 'messages': [{'role': 'user', 'content': 'hello'}]}
+RESPONSE = {'choices': [{'message': {'role': 'assistant', 'content': 'hi'}}]}
+
+class SlowCreate:
+    def __init__(self, response=RESPONSE, error=None) -> None:
+        self.response = response
+        self.error = error
+        self.calls = 0
+        self.started = asyncio.Event()
+        self.release = asyncio.Event()
+
+    async def __call__(self):
+        self.calls += 1
+        self.started.set()
+        await self.release.wait()
+        if self.error:
+            raise self.error
+        return self.response
+
+def test_identical_in_flight_requests_are_coalesced(tmp_path):
+    async def run():
+        cache = LLMCache(str(tmp_path / 'cache.db'))
+        create = SlowCreate()
+        tasks = [asyncio.create_task(cache.get_or_create(dict(REQUEST_ARGS), create)) for _ in range(5)]
+        await create.started.wait()
+        create.release.set()
+        responses = await asyncio.gather(*tasks)
+
+        # a later identical request is served from sqlite
+        assert await cache.get_or_create(dict(REQUEST_ARGS), create) == RESPONSE
+        return cache, create, responses
+
+    cache, create, responses = asyncio.run(run())
+    assert responses == [RESPONSE] * 5
+    assert create.calls == 1
+    assert (cache.misses, cache.coalesced, cache.hits) == (1, 4, 1)
+    assert cache._in_flight == {}
+    assert LLMCache(str(tmp_path / 'cache.db')).get(LLMCache.make_key(REQUEST_ARGS)) == RESPONSE
+
+def test_different_requests_are_not_coalesced(tmp_path):
+    async def run():
+        cache = LLMCache(str(tmp_path / 'cache.db'))
+        create = SlowCreate()
+        create.release.set()
+        other_args = dict(REQUEST_ARGS, messages=[{'role': 'user', 'content': 'bye'}])
+        await asyncio.gather(cache.get_or_create(REQUEST_ARGS, create), cache.get_or_create(other_args, create))
+        return cache, create
+
+    cache, create = asyncio.run(run())
+    assert create.calls == 2
+    assert (cache.misses, cache.coalesced) == (2, 0)
+
+def test_cancelled_caller_does_not_fail_coalesced_peers(tmp_path):
+    async def run():
+        cache = LLMCache(str(tmp_path / 'cache.db'))
+        create = SlowCreate()
+        first = asyncio.create_task(cache.get_or_create(REQUEST_ARGS, create))
+        await create.started.wait()
+        peers = [asyncio.create_task(cache.get_or_create(REQUEST_ARGS, create)) for _ in range(2)]
+        await asyncio.sleep(0)
+
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        create.release.set()
+        return cache, create, await asyncio.gather(*peers)
+
+    cache, create, responses = asyncio.run(run())
+    assert responses == [RESPONSE, RESPONSE]
+    assert create.calls == 1
+    assert cache._in_flight == {}
+
+def test_cancelling_every_caller_still_caches_the_response(tmp_path):
+    async def run():
+        cache = LLMCache(str(tmp_path / 'cache.db'))
+        create = SlowCreate()
+        caller = asyncio.create_task(cache.get_or_create(REQUEST_ARGS, create))
+        await create.started.wait()
+        task = cache._in_flight[cache.make_key(REQUEST_ARGS)]
+        caller.cancel()
+        create.release.set()
+        await task
+        return cache
+
+    cache = asyncio.run(run())
+    assert cache._in_flight == {}
+    assert cache.get(cache.make_key(REQUEST_ARGS)) == RESPONSE
+
+def test_error_reaches_every_coalesced_caller_and_is_not_cached(tmp_path):
+    async def run():
+        cache = LLMCache(str(tmp_path / 'cache.db'))
+        create = SlowCreate(error=RuntimeError('rate limited'))
+        tasks = [asyncio.create_task(cache.get_or_create(REQUEST_ARGS, create)) for _ in range(3)]
+        await create.started.wait()
+        create.release.set()
+        return cache, await asyncio.gather(*tasks, return_exceptions=True)
+
+    cache, results = asyncio.run(run())
+    assert [str(result) for result in results] == ['rate limited'] * 3
+    assert cache._in_flight == {}
+    assert cache.get(cache.make_key(REQUEST_ARGS)) is None
+
+def test_sqlite_work_runs_off_the_event_loop(tmp_path, monkeypatch):
+    threads = []
+    get, put = LLMCache.get, LLMCache.put
+
+    def slow_get(self, key):
+        threads.append(threading.get_ident())
+        time.sleep(0.2)
+        return get(self, key)
+
+    def recording_put(self, key, response):
+        threads.append(threading.get_ident())
+        return put(self, key, response)
+
+    monkeypatch.setattr(LLMCache, 'get', slow_get)
+    monkeypatch.setattr(LLMCache, 'put', recording_put)
+
+    async def run():
+        cache = LLMCache(str(tmp_path / 'cache.db'))
+        create = SlowCreate()
+        create.release.set()
+        ticks = 0
+        request = asyncio.create_task(cache.get_or_create(REQUEST_ARGS, create))
+        while not request.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        await request
+        return ticks
+
+    loop_thread = threading.get_ident()
+    ticks = asyncio.run(run())
+    assert len(threads) == 2
+    assert loop_thread not in threads
+    # the loop kept running while the slow sqlite read was in progress
+    assert ticks >= 10
+
+def test_disabled_cache_always_calls_create(tmp_path):
+    async def run():
+        cache = LLMCache(str(tmp_path / 'cache.db'), enabled=False)
+        create = SlowCreate()
+        create.release.set()
+        await cache.get_or_create(REQUEST_ARGS, create)
+        await cache.get_or_create(REQUEST_ARGS, create)
+        return cache, create
+
+    cache, create = asyncio.run(run())
+    assert create.calls == 2
+    assert (cache.hits, cache.misses, cache.coalesced) == (0, 0, 0)
@@ -0,0 +1,81 @@
+import json
+import pytest
+import yaml
+from local_repair import repair_json_loads, repair_json_string, repair_yaml_loads, strip_code_fences
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"a": 1, "b": [1, 2, ], }', {'a': 1, 'b': [1, 2]}),
+    ('[{"a": 1,}\n,\n]', [{'a': 1}]),
+])
+def test_json_trailing_commas(text, expected):
+    assert repair_json_loads(text) == expected
+
+@pytest.mark.parametrize('text, expected', [
+    ("{'a': 'single', 'b': ['x']}", {'a': 'single', 'b': ['x']}),
+    ("{'a': 'it\\'s'}", {'a': "it's"}),
+    ('{"a": "say "hi" now"}', {'a': 'say "hi" now'}),
+    ('{"a": "it\'s"}', {'a': "it's"}),
+    ('{"a": "line one\nline two\ttab"}', {'a': 'line one\nline two\ttab'}),
+    ('{"a": True, "b": None, "c": False}', {'a': True, 'b': None, 'c': False}),
+])
+def test_json_quotes_and_literals(text, expected):
+    assert repair_json_loads(text) == expected
+
+@pytest.mark.parametrize('text, expected', [
+    ('{"a": [1, 2', {'a': [1, 2]}),
+    ('{"a": {"b": "unfinished', {'a': {'b': 'unfinished'}}),
+    ('{"a": "ends in an escape\\', {'a': 'ends in an escape'}),
+    ('{"a": 1, "b":', {'a': 1, 'b': None}),
+    ('{"a": [1, 2,', {'a': [1, 2]}),
+])
+def test_json_truncation(text, expected):
+    assert repair_json_loads(text) == expected
+
+@pytest.mark.parametrize('text', [
+    '```json\n{"a": 1}\n```',
+    '```\n{"a": 1}\n```',
+    'Here is the result:\n{"a": 1}\nHope this helps!',
+    'Sure: {"a": 1} and {"b": 2}',
+])
+def test_json_fences_and_surrounding_text(text):
+    assert repair_json_loads(text) == {'a': 1}
+
+@pytest.mark.parametrize('text, expected', [
+    (r'{"path": "C:\path\docs"}', 'C:\\path\\docs'),
+    (r'{"pattern": "\d+\s*\."}', r'\d+\s*\.'),
+    (r'{"a": "\u12"}', r'\u12'),
+    (r'{"a": "C:\\"}', 'C:\\'),
+    (r'{"a": "\"q\" \\ \/ \u00e9 \n"}', '"q" \\ / \u00e9 \n'),
+])
+def test_json_backslashes(text, expected):
+    assert list(repair_json_loads(text).values()) == [expected]
+
+@pytest.mark.parametrize('text', ['{"a": 1, "b": [true, null, "x\\"y"]}', '[1, {"c": "\\u00e9"}]', '{}'])
+def test_valid_json_is_unchanged(text):
+    assert repair_json_string(text) == text
+
+def test_unrepairable_json_raises():
+    with pytest.raises(json.JSONDecodeError):
+        repair_json_loads('{"a" 1 2}')
+
+def test_yaml_fences():
+    assert repair_yaml_loads('```yaml\na: 1\nb: [x]\n```') == {'a': 1, 'b': ['x']}
+    assert strip_code_fences('no fences') == 'no fences'
+
+def test_yaml_tabs_in_indentation():
+    assert repair_yaml_loads('a:\n\tb: 1\n\tc: 2') == {'a': {'b': 1, 'c': 2}}
+
+def test_yaml_quotes_plain_scalars_with_colons_and_comments():
+    text = 'nodes:\n- name: echo\n  prompt: answer this: what is it #1\n'
+    assert repair_yaml_loads(text) == {'nodes': [{'name': 'echo', 'prompt': 'answer this: what is it #1'}]}
+
+def test_yaml_odd_indentation():
+    assert repair_yaml_loads('a:\n   b: 1\n  c: 2') == {'a': {'b': 1, 'c': 2}}
+
+def test_yaml_backslashes():
+    text = 'path: "C:\\path\\x"\nregex: "\\d+"\ntab: "a\\tb \\x41"'
+    assert repair_yaml_loads(text) == {'path': 'C:\\path\\x', 'regex': '\\d+', 'tab': 'a\tb A'}
+
+def test_unrepairable_yaml_raises():
+    with pytest.raises(yaml.YAMLError):
+        repair_yaml_loads('a: [1, 2\nb: }')
@@ -0,0 +1,48 @@
+import asyncio
+from rate_limiter import PrioritySemaphore, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+def test_free_slots_go_to_interactive_requests_first():
+    async def run():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire(PRIORITY_BACKGROUND)
+        order = []
+
+        async def request(name, priority):
+            await semaphore.acquire(priority)
+            order.append(name)
+            await asyncio.sleep(0.01)
+            semaphore.release()
+
+        tasks = [asyncio.create_task(request(f'background {index}', PRIORITY_BACKGROUND)) for index in range(3)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(request('interactive', PRIORITY_INTERACTIVE)))
+        await asyncio.sleep(0)
+        semaphore.release()
+        await asyncio.gather(*tasks)
+        return order, semaphore
+
+    order, semaphore = asyncio.run(run())
+    assert order == ['interactive', 'background 0', 'background 1', 'background 2']
+    metrics = semaphore.metrics()
+    assert metrics['max_queue_depth'] == 4
+    assert metrics['interactive_requests'] == 1
+    assert metrics['background_requests'] == 4
+    assert metrics['interactive_max_wait_seconds'] < metrics['background_max_wait_seconds']
+
+def test_cancelled_waiter_does_not_take_a_slot():
+    async def run():
+        semaphore = PrioritySemaphore(1)
+        await semaphore.acquire()
+        cancelled = asyncio.create_task(semaphore.acquire(PRIORITY_INTERACTIVE))
+        waiting = asyncio.create_task(semaphore.acquire(PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        semaphore.release()
+        await asyncio.wait_for(waiting, 1)
+        semaphore.release()
+        return semaphore
+
+    semaphore = asyncio.run(run())
+    assert semaphore._value == 1
+    assert semaphore.queue_depth == 0
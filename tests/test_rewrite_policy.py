@@ -0,0 +1,47 @@
+import pytest
+from rewrite_policy import RewritePolicy
+
+HISTORY = [
+    {'role': 'user', 'content': 'Create a flow that summarizes a web page'},
+    {'role': 'assistant', 'content': 'I have created the flow in folder flow_web_summary_20231101120000'},
+]
+
+FOLLOW_UP_INPUTS = [
+    'yes',
+    'Use gpt-4 instead',
+    'Also add a node that translates the summary to French',
+    'Make it faster by caching the embeddings of the pages',
+    'Can you change the prompt you generated to be more concise?',
+    'What about adding a retry to the python node?',
+    'Rename this flow to news_summary and keep the outputs',
+    'That looks wrong, the output should be a list of bullet points',
+    'Do the same for the other python node',
+    'Go ahead and generate the evaluation flow with 20 inputs',
+    'Update the flow as I mentioned earlier',
+    'The summary is too long, shorten them to three sentences',
+]
+
+STANDALONE_INPUTS = [
+    'Create a flow that summarizes the content of a web page and returns the summary as the output',
+    'Build a chatbot flow which answers questions about our product docs, it should cite its sources',
+    'Generate a flow that classifies customer emails into billing, technical and other, and make sure that the flow returns json',
+    'Write a python tool that calls the weather api and returns the temperature for a city',
+    'I need a flow to translate text between English and Spanish with gpt-4',
+    'Read the flow in folder c:/flows/web_classification and explain what it does',
+    'Give me a flow which extracts the named entities of a document and stores them in a table',
+]
+
+@pytest.mark.parametrize('user_input', FOLLOW_UP_INPUTS)
+def test_follow_up_is_rewritten(user_input):
+    assert RewritePolicy('auto').choose_path(user_input, HISTORY) == 'rewrite'
+
+@pytest.mark.parametrize('user_input', STANDALONE_INPUTS)
+def test_standalone_input_is_not_rewritten(user_input):
+    assert RewritePolicy('auto').choose_path(user_input, HISTORY) == 'skip'
+
+def test_first_input_is_never_rewritten():
+    assert RewritePolicy('auto').choose_path('Make it faster', []) == 'skip'
+
+def test_speculative_mode_and_always_mode():
+    assert RewritePolicy('speculative').choose_path('Make it faster', HISTORY) == 'speculative'
+    assert RewritePolicy('always').choose_path(STANDALONE_INPUTS[0], []) == 'rewrite'
@@ -0,0 +1,95 @@
+import json
+import random
+import pytest
+from streaming_json import StreamingJsonParser, JsonEvent
+
+DOCUMENTS = [
+    {
+        'flow_yaml': 'inputs:\n  url: {type: string}\nnodes: []\n',
+        'explaination': 'reads "a page" and summarizes it \\ in 3 steps: ünïcödé, 中文, emoji 🙂',
+        'python_functions': [
+            {'name': 'fetch', 'content': 'def fetch(url):\n    return requests.get(url).text  # {"x": [1, 2]}\n'},
+            {'name': 'parse', 'content': 'import re\nPATTERN = re.compile(r"\\d+\\s*[{}\\[\\]]")\n'},
+        ],
+        'prompts': [{'name': 'summarize', 'content': 'Summarize: {{text}}'}],
+        'count': 3, 'ratio': -2.5e-3, 'enabled': True, 'disabled': False, 'missing': None,
+    },
+    {'files_name_content': [1, 'two', [3, [4]], {'five': {'six': []}}, None, True, 7.5], 'reasoning': ''},
+    {'python_functions': [], 'prompts': {}},
+]
+
+def feed_in_chunks(parser, text, chunk_sizes):
+    events = []
+    position = 0
+    for size in chunk_sizes:
+        events.append(parser.feed(text[position:position + size]))
+        position += size
+    events.append(parser.feed(text[position:]))
+    return events
+
+def random_chunk_sizes(rng, text):
+    sizes = []
+    while sum(sizes) < len(text):
+        sizes.append(rng.randint(1, 8))
+    return sizes
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+@pytest.mark.parametrize('indent', [None, 2])
+@pytest.mark.parametrize('ensure_ascii', [True, False])
+def test_random_chunk_boundaries_give_the_same_events(document, indent, ensure_ascii):
+    text = json.dumps(document, indent=indent, ensure_ascii=ensure_ascii)
+    expected_events = StreamingJsonParser(['python_functions', 'files_name_content']).feed(text)
+    rng = random.Random(len(text))
+    for _ in range(200):
+        parser = StreamingJsonParser(['python_functions', 'files_name_content'])
+        events = [event for chunk_events in feed_in_chunks(parser, text, random_chunk_sizes(rng, text)) for event in chunk_events]
+        assert events == expected_events
+        assert parser.finished and not parser.failed
+
+def test_every_split_inside_strings_and_escapes():
+    text = json.dumps({'a': 'quote " backslash \\ newline \n tab \t unicode é 🙂', 'b': [1]}, ensure_ascii=False)
+    for split in range(1, len(text)):
+        parser = StreamingJsonParser(['b'])
+        events = parser.feed(text[:split]) + parser.feed(text[split:])
+        assert [event.value for event in events if event.index is None] == [json.loads(text)['a'], [1]]
+
+@pytest.mark.parametrize('document', DOCUMENTS)
+def test_top_level_values_match_json_loads(document):
+    text = json.dumps(document, ensure_ascii=False)
+    parser = StreamingJsonParser(['python_functions', 'files_name_content'])
+    events = [event for chunk_events in feed_in_chunks(parser, text, [3] * (len(text) // 3)) for event in chunk_events]
+    assert {event.key: event.value for event in events if event.index is None} == json.loads(text)
+
+def test_array_elements_are_emitted_as_soon_as_they_close():
+    parser = StreamingJsonParser(['python_functions'])
+    assert parser.feed('{"explaination": "abc", "python_functions": [{"name": "a", "content"') == [JsonEvent('explaination', None, 'abc')]
+    assert parser.feed(': "x"}, {"name": "b"') == [JsonEvent('python_functions', 0, {'name': 'a', 'content': 'x'})]
+    assert parser.feed(', "content": "y"}]') == [
+        JsonEvent('python_functions', 1, {'name': 'b', 'content': 'y'}),
+        JsonEvent('python_functions', None, [{'name': 'a', 'content': 'x'}, {'name': 'b', 'content': 'y'}]),
+    ]
+    assert not parser.finished
+    assert parser.feed(', "n": 12') == []
+    assert parser.feed('}') == [JsonEvent('n', None, 12)]
+    assert parser.finished
+    assert parser.feed(', "ignored": 1') == []
+
+def test_partial_scalars_are_not_emitted():
+    parser = StreamingJsonParser()
+    assert parser.feed('{"count": 12') == []
+    assert parser.feed('3, "flag": tr') == [JsonEvent('count', None, 123)]
+    assert parser.feed('ue}') == [JsonEvent('flag', None, True)]
+
+@pytest.mark.parametrize('text', ['[1, 2]', '{"a": "line\nbreak"}', '{"a": tru}', '{"a" 1}'])
+def test_malformed_stream_sets_failed(text):
+    parser = StreamingJsonParser()
+    for c in text:
+        parser.feed(c)
+    assert parser.failed
+    assert parser.feed('{"b": 1}') == []
+
+def test_consumed_text_is_dropped():
+    parser = StreamingJsonParser(['python_functions'])
+    for index in range(1000):
+        parser.feed(json.dumps({'name': f'f{index}', 'content': 'x' * 100}) + ', ' if index else '{"python_functions": [')
+    assert sum(len(chunk) for chunk in parser._chunks) < 300
@@ -0,0 +1,27 @@
+import pytest
+from token_utils import APPROXIMATE_CHARS_PER_TOKEN, TokenCounter, approximate_token_count, calibration_corpus
+
+# the error bounds of APPROXIMATE_CHARS_PER_TOKEN stated in token_utils: it never under counts the corpus and over counts it by at most 32%
+MIN_RELATIVE_ERROR = 0.0
+MAX_RELATIVE_ERROR = 0.32
+
+@pytest.fixture(scope='module')
+def token_counter():
+    return TokenCounter()
+
+def test_approximate_count_stays_within_the_stated_bounds(token_counter):
+    texts = calibration_corpus()
+    assert texts
+    for text in texts:
+        exact_count = token_counter.count_text(text)
+        relative_error = approximate_token_count(text, APPROXIMATE_CHARS_PER_TOKEN) / exact_count - 1
+        assert MIN_RELATIVE_ERROR <= relative_error <= MAX_RELATIVE_ERROR, text[:100]
+
+def test_calibration_corpus_skips_folders_and_binary_files(tmp_path):
+    (tmp_path / 'evaluation_template' / '__pycache__').mkdir(parents=True)
+    (tmp_path / 'evaluation_template' / 'line_process.py').write_text('def line_process():\n    return 1\n' * 20, encoding='utf-8')
+    (tmp_path / 'evaluation_template' / 'line_process.cpython-311.pyc').write_bytes(b'\xa7\r\r\n' + bytes(range(256)) * 2)
+    (tmp_path / 'prompt_flows' / 'flow.dir').mkdir(parents=True)
+
+    texts = calibration_corpus(root=str(tmp_path))
+    assert any(text.startswith('def line_process') for text in texts)
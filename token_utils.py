@@ -1,90 +1,413 @@
-import tiktoken
+import os
+import json
+import math
+import base64
+import hashlib
+import threading
+from collections import OrderedDict
 from logging_util import get_logger
 
 logger = get_logger()
 
-def num_tokens_from_messages(messages):
-    """Return the number of tokens used by a list of messages."""
+tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+tokens_per_name = -1  # if there's a name, the role is omitted
+tokens_per_reply = 3  # every reply is primed with <|start|>assistant<|message|>
+
+# the cl100k_base encoding is loaded from a local file so that no network access is needed,
+# TOKENIZER_DATA_DIR overrides the folder of the file, tiktoken's download is only the fallback when the file is missing
+CL100K_BASE_FILE_NAME = 'cl100k_base.tiktoken'
+CL100K_BASE_URL = 'https://openaipublic.blob.core.windows.net/encodings/cl100k_base.tiktoken'
+CL100K_BASE_SHA256 = '223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7'
+CL100K_BASE_PAT_STR = r"""(?i:'s|'t|'re|'ve|'m|'ll|'d)|[^\r\n\p{L}\p{N}]?\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]+[\r\n]*|\s*[\r\n]+|\s+(?!\S)|\s+"""
+CL100K_BASE_SPECIAL_TOKENS = {
+    '<|endoftext|>': 100257,
+    '<|fim_prefix|>': 100258,
+    '<|fim_middle|>': 100259,
+    '<|fim_suffix|>': 100260,
+    '<|endofprompt|>': 100276,
+}
+DEFAULT_TOKENIZER_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tokenizer_data')
+
+def get_encoding_file_path():
+    return os.path.join(os.environ.get('TOKENIZER_DATA_DIR') or DEFAULT_TOKENIZER_DATA_DIR, CL100K_BASE_FILE_NAME)
+
+def load_local_encoding(path):
+    """Build the cl100k_base encoding from a local .tiktoken file, the file is checked against the published sha256."""
+    import tiktoken
+    with open(path, 'rb') as f:
+        data = f.read()
+    if hashlib.sha256(data).hexdigest() != CL100K_BASE_SHA256:
+        raise ValueError(f'{path} does not match the sha256 of cl100k_base')
+
+    mergeable_ranks = {}
+    for line in data.splitlines():
+        if line:
+            token, rank = line.split()
+            mergeable_ranks[base64.b64decode(token)] = int(rank)
+    return tiktoken.Encoding(name='cl100k_base', pat_str=CL100K_BASE_PAT_STR, mergeable_ranks=mergeable_ranks, special_tokens=CL100K_BASE_SPECIAL_TOKENS)
+
+def save_encoding_file(path=None):
+    """Download the cl100k_base file to the tokenizer data folder, run it once on a machine with network access."""
+    from tiktoken.load import read_file
+    path = path or get_encoding_file_path()
+    data = read_file(CL100K_BASE_URL)
+    if hashlib.sha256(data).hexdigest() != CL100K_BASE_SHA256:
+        raise ValueError(f'{CL100K_BASE_URL} does not match the sha256 of cl100k_base')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+    return path
+
+def get_encoding():
+    path = get_encoding_file_path()
+    if os.path.exists(path):
+        return load_local_encoding(path)
+
+    logger.warning(f"{path} does not exist, downloading the encoding with tiktoken.")
+    import tiktoken
     try:
         # we only support a few models for now, and they all use the same encoding
         model = "gpt-3.5-turbo-0613"
-        encoding = tiktoken.encoding_for_model(model)
+        return tiktoken.encoding_for_model(model)
     except KeyError:
         logger.warning("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
+        return tiktoken.get_encoding("cl100k_base")
 
-    tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-    tokens_per_name = -1  # if there's a name, the role is omitted
+class TokenCounter:
+    '''
+    token counter which loads the encoding on first use and memoizes the token count of each message by its content hash
+    '''
+    def __init__(self, max_cached_messages=10000) -> None:
+        self._encoding = None
+        self._encoding_failed = False
+        self._encoding_lock = threading.Lock()
+        self.max_cached_messages = max_cached_messages
+        self._message_tokens = OrderedDict()
+        self._function_tokens = {}
 
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            with self._encoding_lock:
+                if self._encoding is None and not self._encoding_failed:
+                    try:
+                        self._encoding = get_encoding()
+                    except Exception as ex:
+                        # an offline machine without the encoding file still gets usable, approximate counts
+                        logger.warning(f"failed to load the tokenizer, token counts are approximated: {ex}")
+                        self._encoding_failed = True
+        return self._encoding
+
+    def warmup(self):
+        '''
+        load the encoding ahead of the first count, it can be called from a worker thread
+        '''
+        return self.encoding
+
+    def count_text(self, text):
+        if not text:
+            return 0
+        encoding = self.encoding
+        if encoding is None:
+            return approximate_token_count(text)
+        return len(encoding.encode(text))
+
+    def count_message(self, message):
+        """Return the number of tokens used by a single message, excluding the reply priming tokens."""
+        key = hashlib.sha1(json.dumps(message, sort_keys=True).encode('utf-8')).hexdigest()
+        if key in self._message_tokens:
+            self._message_tokens.move_to_end(key)
+            return self._message_tokens[key]
+
+        num_tokens = tokens_per_message
+        for key_name, value in message.items():
+            num_tokens += self.count_text(value)
+            if key_name == "name":
                 num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
 
-def num_tokens_from_functions(functions):
+        self._message_tokens[key] = num_tokens
+        if len(self._message_tokens) > self.max_cached_messages:
+            self._message_tokens.popitem(last=False)
+        return num_tokens
+
+    def count_messages(self, messages):
+        """Return the number of tokens used by a list of messages."""
+        return sum(self.count_message(message) for message in messages) + tokens_per_reply
+
+    def count_functions(self, functions):
         """Return the number of tokens used by a list of functions."""
-        try:
-            # we only support a few models for now, and they all use the same encoding
-            model = "gpt-3.5-turbo-0613"
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            logger.warning("Warning: model not found. Using cl100k_base encoding.")
-            encoding = tiktoken.get_encoding("cl100k_base")
-        
-        num_tokens = 0
-        for function in functions:
-            function_tokens = len(encoding.encode(function['name']))
-            function_tokens += len(encoding.encode(function['description']))
-            
-            if 'parameters' in function:
-                parameters = function['parameters']
-                if 'properties' in parameters:
-                    for propertiesKey in parameters['properties']:
-                        function_tokens += len(encoding.encode(propertiesKey))
-                        v = parameters['properties'][propertiesKey]
-                        for field in v:
-                            if field == 'type':
-                                function_tokens += 2
-                                function_tokens += len(encoding.encode(v['type']))
-                            elif field == 'description':
-                                function_tokens += 2
-                                function_tokens += len(encoding.encode(v['description']))
-                            elif field == 'items':
-                                function_tokens -= 3
-                                for _, o in v['items'].items():
-                                    function_tokens += 2
-                                    if isinstance(o, str):
-                                        function_tokens += len(encoding.encode(o))
-                                    elif isinstance(o, dict):
-                                        for _, oo in o.items():
-                                            function_tokens += 2
-                                            function_tokens += len(encoding.encode(oo))
-                            else:
-                                logger.warning(f"Warning: not supported field {field}")
-                    function_tokens += 11
-
-            num_tokens += function_tokens
-
-        num_tokens += 12 
+        if functions is None:
+            return 0
+        return sum(self.count_function(function) for function in functions) + 12
+
+    def count_function(self, function):
+        """Return the number of tokens used by a single function schema, the schema token cost is computed once and cached."""
+        cached = self._function_tokens.get(function['name'])
+        if cached is not None and cached[0] is function:
+            return cached[1]
+
+        num_tokens = sum(tokens for _, tokens in self.function_token_breakdown(function))
+        self._function_tokens[function['name']] = (function, num_tokens)
         return num_tokens
 
-def num_tokens_from_completions(completion_text):
-    """Return the number of tokens used by a list of functions."""
-    try:
-        # we only support a few models for now, and they all use the same encoding
-        model = "gpt-3.5-turbo-0613"
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        logger.warning("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    
-    if not completion_text:
+    def function_token_breakdown(self, function):
+        """Return a list of (path, tokens) of a function schema, the tokens sum up to the token cost of the schema."""
+        breakdown = [
+            ('name', self.count_text(function['name'])),
+            ('description', self.count_text(function['description']))
+        ]
+
+        if 'parameters' in function:
+            parameters = function['parameters']
+            if 'properties' in parameters:
+                for propertiesKey in parameters['properties']:
+                    property_tokens = self.count_text(propertiesKey)
+                    v = parameters['properties'][propertiesKey]
+                    for field in v:
+                        if field == 'type':
+                            property_tokens += 2
+                            property_tokens += self.count_text(v['type'])
+                        elif field == 'description':
+                            property_tokens += 2
+                            property_tokens += self.count_text(v['description'])
+                        elif field == 'items':
+                            property_tokens -= 3
+                            for item_key, o in v['items'].items():
+                                item_tokens = 2
+                                if isinstance(o, str):
+                                    item_tokens += self.count_text(o)
+                                elif isinstance(o, dict):
+                                    for _, oo in o.items():
+                                        if isinstance(oo, str):
+                                            item_tokens += 2
+                                            item_tokens += self.count_text(oo)
+                                        else:
+                                            logger.warning(f"Warning: not supported nested items in {function['name']}.{propertiesKey}.{item_key}")
+                                breakdown.append((f'parameters.{propertiesKey}.items.{item_key}', item_tokens))
+                        else:
+                            logger.warning(f"Warning: not supported field {field}")
+                    breakdown.append((f'parameters.{propertiesKey}', property_tokens))
+                breakdown.append(('parameters', 11))
+
+        return breakdown
+
+    def function_tokens_report(self, functions):
+        """Return a report of the token cost of each function schema and each of its properties."""
+        lines = []
+        for function in sorted(functions, key=self.count_function, reverse=True):
+            lines.append(f"{function['name']}: {self.count_function(function)}")
+            for path, tokens in self.function_token_breakdown(function):
+                lines.append(f"    {path}: {tokens}")
+        lines.append(f"total with function list overhead: {self.count_functions(functions)}")
+        return '\n'.join(lines)
+
+    def count_completion(self, completion_text):
+        """Return the number of tokens used by a completion."""
+        return self.count_text(completion_text)
+
+# ascii characters per token of the approximate counter. `python token_utils.py --calibrate` measures it on the prompts,
+# function schemas and flow templates of the copilot: the best fit is 4.26 chars per token with errors from -11% to +18%,
+# 3.8 is used instead so that the estimate never under counts those texts, it over counts them by 0% to +32%, 14% on average
+APPROXIMATE_CHARS_PER_TOKEN = 3.8
+
+def approximate_token_count(text, chars_per_token=APPROXIMATE_CHARS_PER_TOKEN):
+    """Return an estimate of the tokens of a text without tokenizing it, every non ascii character is counted as one token."""
+    if not text:
         return 0
+    if text.isascii():
+        return math.ceil(len(text) / chars_per_token)
+    non_ascii_chars = sum(1 for c in text if ord(c) > 127)
+    return math.ceil((len(text) - non_ascii_chars) / chars_per_token) + non_ascii_chars
+
+class ApproximateTokenCounter(TokenCounter):
+    '''
+    token counter which estimates the tokens from the number of characters, it is several times faster than the exact counter
+    and needs no encoding, use it where the counts only drive budget decisions. see calibrate_approximate_counter for its error bounds
+    '''
+    def __init__(self, chars_per_token=APPROXIMATE_CHARS_PER_TOKEN, max_cached_messages=10000) -> None:
+        super().__init__(max_cached_messages)
+        self.chars_per_token = chars_per_token
+
+    def warmup(self):
+        return None
+
+    def count_text(self, text):
+        return approximate_token_count(text, self.chars_per_token)
+
+def calibrate_approximate_counter(texts, token_counter=None):
+    """
+    Fit the chars per token of the approximate counter to the exact counts of the texts, and return it together with
+    the relative error of the approximate count of each text with the fitted and the current chars per token.
+    """
+    token_counter = token_counter or get_token_counter()
+    exact_counts = [token_counter.count_text(text) for text in texts]
+    non_ascii_chars = [sum(1 for c in text if ord(c) > 127) for text in texts]
+    ascii_chars = sum(len(text) - non_ascii for text, non_ascii in zip(texts, non_ascii_chars))
+    ascii_tokens = sum(exact - non_ascii for exact, non_ascii in zip(exact_counts, non_ascii_chars))
+    fitted_chars_per_token = round(ascii_chars / max(ascii_tokens, 1), 2)
+
+    def relative_errors(chars_per_token):
+        return [(approximate_token_count(text, chars_per_token) - exact) / exact for text, exact in zip(texts, exact_counts) if exact]
+
+    def summary(errors):
+        return {'min': min(errors), 'max': max(errors), 'mean_abs': sum(abs(e) for e in errors) / len(errors)} if errors else {}
+
+    return {
+        'texts': len(texts),
+        'tokens': sum(exact_counts),
+        'fitted_chars_per_token': fitted_chars_per_token,
+        'fitted_relative_error': summary(relative_errors(fitted_chars_per_token)),
+        'current_chars_per_token': APPROXIMATE_CHARS_PER_TOKEN,
+        'current_relative_error': summary(relative_errors(APPROXIMATE_CHARS_PER_TOKEN)),
+    }
+
+# text files of the calibration corpus, the globs also match folders and compiled python files which are skipped
+CALIBRATION_FILE_SUFFIXES = ('.jinja2', '.md', '.py', '.yaml', '.yml', '.json', '.jsonl', '.txt')
+
+def calibration_corpus(root=None, min_chars=200):
+    """Return the texts of the prompts, flow templates and function schemas of the copilot."""
+    import glob
+    import function_calls
+    root = root or os.path.dirname(os.path.abspath(__file__))
+    texts = []
+    for pattern in ('prompts/*.jinja2', 'evaluation_template/*', 'prompt_flows/**/*.*', '*.md'):
+        for path in sorted(glob.glob(os.path.join(root, pattern), recursive=True)):
+            if not os.path.isfile(path) or not path.endswith(CALIBRATION_FILE_SUFFIXES):
+                continue
+            with open(path, encoding='utf-8') as f:
+                texts.append(f.read())
+    texts.extend(json.dumps(v) for v in vars(function_calls).values() if isinstance(v, dict) and 'name' in v and 'parameters' in v)
+    return [text for text in texts if len(text) >= min_chars]
+
+class TokenCountedMessages(list):
+    '''
+    list of chat messages which keeps a running total of their tokens as messages are added or removed.
+    the token count of every message is kept next to it, so removing messages never counts them again
+    '''
+    def __init__(self, token_counter, messages=()):
+        super().__init__()
+        self.token_counter = token_counter
+        self._message_tokens = []
+        self._message_tokens_total = 0
+        self.extend(messages)
+
+    @property
+    def num_tokens(self):
+        """Return the number of tokens used by the messages, same as TokenCounter.count_messages."""
+        return self._message_tokens_total + tokens_per_reply
+
+    def message_tokens(self, index):
+        """Return the number of tokens of the message at index, same as TokenCounter.count_message."""
+        return self._message_tokens[index]
+
+    def append(self, message):
+        message_tokens = self.token_counter.count_message(message)
+        super().append(message)
+        self._message_tokens.append(message_tokens)
+        self._message_tokens_total += message_tokens
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def __iadd__(self, messages):
+        self.extend(messages)
+        return self
+
+    def insert(self, index, message):
+        message_tokens = self.token_counter.count_message(message)
+        super().insert(index, message)
+        self._message_tokens.insert(index, message_tokens)
+        self._message_tokens_total += message_tokens
+
+    def remove(self, message):
+        del self[self.index(message)]
+
+    def pop(self, index=-1):
+        message = self[index]
+        del self[index]
+        return message
+
+    def clear(self):
+        super().clear()
+        self._message_tokens = []
+        self._message_tokens_total = 0
+
+    def delete_indexes(self, indexes):
+        '''
+        delete the messages at indexes in a single pass
+        '''
+        indexes = set(indexes)
+        if not indexes:
+            return
+        kept_count = 0
+        for index in range(len(self)):
+            if index in indexes:
+                self._message_tokens_total -= self._message_tokens[index]
+            else:
+                super().__setitem__(kept_count, super().__getitem__(index))
+                self._message_tokens[kept_count] = self._message_tokens[index]
+                kept_count += 1
+        super().__delitem__(slice(kept_count, None))
+        del self._message_tokens[kept_count:]
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = list(value)
+            value_tokens = [self.token_counter.count_message(message) for message in value]
+            super().__setitem__(index, value)
+            self._message_tokens_total += sum(value_tokens) - sum(self._message_tokens[index])
+            self._message_tokens[index] = value_tokens
+        else:
+            message_tokens = self.token_counter.count_message(value)
+            super().__setitem__(index, value)
+            self._message_tokens_total += message_tokens - self._message_tokens[index]
+            self._message_tokens[index] = message_tokens
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        if isinstance(index, slice):
+            self._message_tokens_total -= sum(self._message_tokens[index])
+        else:
+            self._message_tokens_total -= self._message_tokens[index]
+        del self._message_tokens[index]
+
+_token_counter = None
+_approximate_token_counter = None
+
+def get_token_counter():
+    global _token_counter
+    if _token_counter is None:
+        _token_counter = TokenCounter()
+    return _token_counter
+
+def get_approximate_token_counter():
+    global _approximate_token_counter
+    if _approximate_token_counter is None:
+        _approximate_token_counter = ApproximateTokenCounter()
+    return _approximate_token_counter
+
+def num_tokens_from_messages(messages):
+    """Return the number of tokens used by a list of messages."""
+    return get_token_counter().count_messages(messages)
+
+def num_tokens_from_functions(functions):
+    """Return the number of tokens used by a list of functions."""
+    return get_token_counter().count_functions(functions)
+
+def num_tokens_from_completions(completion_text):
+    """Return the number of tokens used by a completion."""
+    return get_token_counter().count_completion(completion_text)
 
-    num_tokens = len(encoding.encode(completion_text))
-    return num_tokens
\ No newline at end of file
+if __name__ == '__main__':
+    import sys
+    if '--save-encoding' in sys.argv:
+        print(f'saved {save_encoding_file()}')
+    elif '--calibrate' in sys.argv:
+        print(json.dumps(calibrate_approximate_counter(calibration_corpus()), indent=2))
+    else:
+        import function_calls
+        schemas = [v for v in vars(function_calls).values() if isinstance(v, dict) and 'name' in v and 'parameters' in v]
+        print(get_token_counter().function_tokens_report(schemas))